@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the former BrowserID assertion parsing, which decoded every
+fragment, with the bounded and the memoized parsers.
+
+USAGE: python scripts/benchmark-assertion.py [ITERATIONS]
+"""
+from __future__ import print_function
+import json
+import sys
+import timeit
+
+from syncto import authentication
+from syncto.tests.support import BID_ASSERTION
+
+
+def decode_every_fragment(assertion):
+    exp = None
+    for fragment in assertion.split('.'):
+        try:
+            payload = json.loads(authentication.base64url_decode(fragment))
+        except ValueError:
+            payload = {}
+        if 'exp' in payload:
+            exp = min(payload['exp'], exp or payload['exp'])
+    return exp
+
+
+def bounded_parser(assertion):
+    return authentication.parse_bid_assertion(assertion, use_cache=False)
+
+
+def memoized_parser(assertion):
+    return authentication.parse_bid_assertion(assertion)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    for func in (decode_every_fragment, bounded_parser, memoized_parser):
+        duration = timeit.timeit(lambda: func(BID_ASSERTION),
+                                 number=iterations)
+        print("%-22s %8.2f µs/op" % (func.__name__,
+                                     duration * 1e6 / iterations))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the size and CPU cost of the hex and compact credentials cache
+formats.
+
+USAGE: python scripts/benchmark-cache-format.py [ITERATIONS]
+"""
+from __future__ import print_function
+import json
+import sys
+import timeit
+
+from syncto import crypto
+
+CLIENT_STATE = '601c4497372419ee1789bf931f8c68f5'
+HMAC_SECRET = ('70a73e5719a5f844cfb5dc02d8b370f7'
+               '18ced6fe9b93d81b8c42c5ee417b6bbb')
+CREDENTIALS = {
+    "api_endpoint": "https://sync-1-us-west-2.sync.services.mozilla.com/"
+                    "1.5/12345678",
+    "uid": 12345678,
+    "hashalg": "sha256",
+    "id": "eyJub2RlIjogImh0dHBzOi8vc3luYy0xLXVzLXdlc3QtMi5zeW5jLnNlcn" * 3,
+    "key": "K0VAtW5lFcaa7T0mOhiIkYfDEGnZ4sDX-9wTmRsExQo=",
+    "duration": 3600,
+    "hashed_fxa_uid": "0f6cb0e6e3e7c8e8ac2bc1c0b0d1c1ea",
+}
+
+
+def hex_format():
+    encrypted = crypto.encrypt(json.dumps(CREDENTIALS), CLIENT_STATE,
+                               HMAC_SECRET)
+    json.loads(crypto.decrypt(encrypted, CLIENT_STATE, HMAC_SECRET))
+    return encrypted
+
+
+def compact_format():
+    encrypted = crypto.encrypt_value(CREDENTIALS, CLIENT_STATE, HMAC_SECRET)
+    crypto.decrypt_value(encrypted, CLIENT_STATE, HMAC_SECRET)
+    return encrypted
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    for func in (hex_format, compact_format):
+        # The Redis cache backend stores values as JSON strings.
+        size = len(json.dumps(func()))
+        duration = timeit.timeit(func, number=iterations)
+        print("%-15s %5d bytes %8.2f µs/op (encrypt + decrypt)" % (
+            func.__name__, size, duration * 1e6 / iterations))
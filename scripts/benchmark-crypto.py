@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare credentials encryption with and without memoized secret boxes.
+
+USAGE: python scripts/benchmark-crypto.py [ITERATIONS]
+"""
+from __future__ import print_function
+import json
+import sys
+import timeit
+
+from syncto import crypto
+
+CLIENT_STATE = '601c4497372419ee1789bf931f8c68f5'
+HMAC_SECRET = ('70a73e5719a5f844cfb5dc02d8b370f7'
+               '18ced6fe9b93d81b8c42c5ee417b6bbb')
+CREDENTIALS = json.dumps({
+    "api_endpoint": "https://sync-1-us-west-2.sync.services.mozilla.com/"
+                    "1.5/12345678",
+    "uid": 12345678,
+    "hashalg": "sha256",
+    "id": "eyJub2RlIjogImh0dHBzOi8vc3luYy0xLXVzLXdlc3QtMi5zeW5jLnNlcn" * 3,
+    "key": "K0VAtW5lFcaa7T0mOhiIkYfDEGnZ4sDX-9wTmRsExQo=",
+    "duration": 3600
+})
+
+
+def derive_and_decrypt(encrypted):
+    box = crypto._get_nacl_secret_box(CLIENT_STATE, HMAC_SECRET,
+                                      use_cache=False)
+    return crypto.decrypt_with_box(encrypted, box)
+
+
+def memoized_decrypt(encrypted):
+    return crypto.decrypt(encrypted, CLIENT_STATE, HMAC_SECRET)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    encrypted = crypto.encrypt(CREDENTIALS, CLIENT_STATE, HMAC_SECRET)
+
+    for func in (derive_and_decrypt, memoized_decrypt):
+        duration = timeit.timeit(lambda: func(encrypted), number=iterations)
+        print("%-20s %8.2f µs/op" % (func.__name__,
+                                     duration * 1e6 / iterations))
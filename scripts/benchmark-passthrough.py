@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the conversion of Sync collection pages into Kinto responses,
+decoding and encoding every record or rewriting the body in place.
+
+USAGE: python scripts/benchmark-passthrough.py [ITERATIONS]
+"""
+from __future__ import print_function
+import base64
+import json
+import os
+import sys
+import timeit
+
+from cliquet.utils import json as cliquet_json, json_serializer
+
+from syncto.records import rewrite_records_body
+
+
+def build_body(size):
+    def b64(length):
+        return base64.b64encode(os.urandom(length)).decode('ascii')
+
+    records = [{
+        "id": base64.urlsafe_b64encode(os.urandom(9)).decode('ascii'),
+        "modified": 1454000000.12 + i,
+        "payload": json.dumps({"ciphertext": b64(600), "IV": b64(16),
+                               "hmac": b64(32)}),
+        "sortindex": 100,
+        "ttl": 2100000
+    } for i in range(size)]
+    return json.dumps(records).encode('utf-8')
+
+
+def decode_and_encode(body):
+    records = cliquet_json.loads(body.decode('utf-8'))
+    for r in records:
+        r['last_modified'] = int(r.pop('modified') * 1000)
+    return json_serializer({'data': records}).encode('utf-8')
+
+
+def lexical_rewrite(body):
+    return rewrite_records_body(body)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    for size in (100, 1000, 10000):
+        body = build_body(size)
+        for func in (decode_and_encode, lexical_rewrite):
+            duration = timeit.timeit(lambda: func(body), number=iterations)
+            print("%6d records  %-18s %10.2f ms/op" % (
+                size, func.__name__, duration * 1e3 / iterations))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the validation of record PUT bodies through the colander schema,
+as done by Cornice, with the fast path of ``validate_payload``.
+
+USAGE: python scripts/benchmark-payload.py [ITERATIONS]
+"""
+from __future__ import print_function
+import base64
+import json
+import os
+import sys
+import timeit
+
+from cornice.errors import Errors
+from cornice.schemas import validate_colander_schema
+from cornice.util import extract_json_data
+from pyramid.registry import Registry
+from pyramid.request import Request
+
+from syncto import DEFAULT_SETTINGS
+from syncto.views.record import PAYLOAD_SCHEMA, validate_payload
+
+
+def build_body(payload_size):
+    def b64(length):
+        return base64.b64encode(os.urandom(length)).decode('ascii')
+
+    payload = json.dumps({"ciphertext": b64(payload_size), "IV": b64(16),
+                          "hmac": b64(32)})
+    record = {"payload": payload, "sortindex": 100, "ttl": 2100000}
+    return json.dumps({"data": record}).encode('utf-8')
+
+
+def build_request(registry, body):
+    request = Request.blank('/', method='PUT', body=body,
+                            content_type='application/json')
+    request.registry = registry
+    request.errors = Errors(request)
+    request.validated = {}
+    return request
+
+
+def colander_schema(request):
+    validate_colander_schema(PAYLOAD_SCHEMA, request)
+
+
+def fast_path(request):
+    validate_payload(request)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    registry = Registry()
+    registry.settings = dict(DEFAULT_SETTINGS)
+    registry.cornice_deserializers = {'application/json': extract_json_data}
+
+    for payload_size in (100, 1000, 10000):
+        body = build_body(payload_size)
+        for func in (colander_schema, fast_path):
+            requests = [build_request(registry, body)
+                        for _ in range(iterations)]
+            requests_iter = iter(requests)
+            duration = timeit.timeit(lambda: func(next(requests_iter)),
+                                     number=iterations)
+            assert not requests[0].errors
+            print("%6d bytes  %-16s %8.2f µs/op" % (
+                len(body), func.__name__, duration * 1e6 / iterations))
@@ -1,8 +1,11 @@
 import os
+import threading
 import pkg_resources
 
 import cliquet
 from pyramid.config import Configurator
+from syncto.cache import LRUCache, SingleFlight
+from syncto.client import CircuitBreaker, SessionPool
 from syncto.heartbeat import ping_sync_cluster
 
 # Module version, as defined in PEP-0396.
@@ -25,9 +28,38 @@ DEFAULT_SETTINGS = {
     'project_docs': 'https://syncto.readthedocs.io/',
     'cache_hmac_secret': None,
     'cache_credentials_ttl_seconds': 300,
+    'cache_credentials_local_max_size': 1000,
+    'cache_credentials_local_ttl_seconds': 60,
+    'cache_credentials_lock_ttl_seconds': 10,
+    'cache_credentials_refresh_ratio': 0,
+    'cache_credentials_ttl_jitter_ratio': 0.1,
+    'cache_credentials_error_ttl_seconds': 30,
+    'cache_info_collections_ttl_seconds': 0,
+    'cache_collection_pages_ttl_seconds': 0,
+    'cache_collection_pages_max_bytes': 512 * 1024,
+    'cache_collection_snapshots_ttl_seconds': 0,
+    'cache_collection_snapshots_max_bytes': 10 * 1024 * 1024,
+    'cache_prefetched_pages_ttl_seconds': 0,
+    'cache_records_ttl_seconds': 0,
+    'cache_records_bodies_collections': 'meta crypto',
+    'cache_records_missing_ttl_seconds': 0,
     'token_server_url': 'https://token.services.mozilla.com/',
     'token_server_heartbeat_timeout_seconds': 5,
+    'token_server_breaker_max_failures': 5,
+    'token_server_breaker_reset_timeout_seconds': 30,
     'certificate_ca_bundle': None,
+    'sync_pool_size': 10,
+    'sync_pool_idle_timeout_seconds': 60,
+    'sync_pool_max_age_seconds': 300,
+    'sync_max_ids_per_request': 100,
+    'sync_max_parallel_requests': 4,
+    'sync_max_prefetches': 10,
+    'sync_max_post_records': 100,
+    'sync_max_post_bytes': 2 * 1024 * 1024,
+    'record_put_max_body_bytes': 512 * 1024,
+    'collection_get_streaming_enabled': False,
+    'collection_get_passthrough_enabled': False,
+    'collection_get_ids_only_enabled': False,
 }
 
 
@@ -60,5 +92,30 @@ def main(global_config, **settings):
             'certificate_ca_bundle': ca_bundle_abspath
         })
 
+    # Share connections to Sync storage nodes within this process.
+    config.registry.sync_sessions = SessionPool(
+        pool_size=int(settings['sync_pool_size']),
+        idle_timeout=int(settings['sync_pool_idle_timeout_seconds']),
+        max_age=int(settings['sync_pool_max_age_seconds']))
+
+    # Keep recently used credentials decrypted in this process.
+    config.registry.credentials_cache = LRUCache(
+        max_size=int(settings['cache_credentials_local_max_size']),
+        max_ttl=int(settings['cache_credentials_local_ttl_seconds']))
+
+    # Coalesce concurrent tokenserver exchanges of the same assertion.
+    config.registry.tokenserver_flights = SingleFlight()
+
+    # Fail fast while the tokenserver is unavailable.
+    config.registry.tokenserver_breaker = CircuitBreaker(
+        max_failures=int(settings['token_server_breaker_max_failures']),
+        reset_timeout=int(
+            settings['token_server_breaker_reset_timeout_seconds']))
+
+    # Bound the number of pages prefetched at a time by this process.
+    config.registry.prefetch_flights = SingleFlight()
+    config.registry.prefetch_budget = threading.BoundedSemaphore(
+        int(settings['sync_max_prefetches']))
+
     config.scan("syncto.views")
     return config.make_wsgi_app()
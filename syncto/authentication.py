@@ -1,19 +1,42 @@
 import base64
 import binascii
+import hashlib
 import json
+import random
 import time
+import uuid
 
+import requests
 from pyramid import httpexceptions
 from pyramid.security import forget
+from pyramid.settings import aslist_cronly
+from requests.exceptions import HTTPError
 from six import text_type
 
+from cliquet import logger
 from cliquet.errors import http_error, ERRORS, send_alert
+from cliquet.statsd import statsd_count
 from cliquet import utils
-from syncclient.client import SyncClient, TokenserverClient
+from syncclient.client import TokenserverClient
 
 from syncto import (AUTHORIZATION_HEADER, CLIENT_STATE_HEADER,
                     CLIENT_STATE_LENGTH)
-from syncto.crypto import encrypt, decrypt
+from syncto.cache import LRUCache
+from syncto.client import SyncClient
+from syncto.crypto import encrypt_value, decrypt_value
+
+
+LOCK_POLL_INTERVAL_SECONDS = 0.05
+
+# Certificates payloads are around 1KB, larger ones are not decoded.
+MAX_ASSERTION_PAYLOAD_LENGTH = 4096
+
+PARSED_ASSERTIONS_CACHE_SIZE = 1024
+PARSED_ASSERTIONS_CACHE_TTL_SECONDS = 3600
+
+# Parsed assertions, keyed by their digest.
+_parsed_assertions = LRUCache(max_size=PARSED_ASSERTIONS_CACHE_SIZE,
+                              max_ttl=PARSED_ASSERTIONS_CACHE_TTL_SECONDS)
 
 
 def build_sync_client(request):
@@ -65,44 +88,301 @@ def build_sync_client(request):
     settings = request.registry.settings
     cache = request.registry.cache
     statsd = request.registry.statsd
-    token_server_url = settings['token_server_url']
 
-    hmac_secret = settings['cache_hmac_secret']
+    # Subrequests of a batch share the clients built for their credentials.
+    shared_clients = request.bound_data.get('sync_clients')
+    shared_key = (bid_assertion, client_state)
+    if shared_clients is not None and shared_key in shared_clients:
+        sync_client = shared_clients[shared_key].clone()
+        if statsd:
+            statsd.watch_execution_time(sync_client, prefix="syncclient")
+        return sync_client
+
+    # Secrets are rotated: the first one is used to store credentials, the
+    # others are only used to read credentials stored before the rotation.
+    hmac_secrets = get_cache_hmac_secrets(settings)
+    hmac_secret = hmac_secrets[0]
     cache_key = 'credentials_%s' % utils.hmac_digest(hmac_secret,
                                                      bid_assertion)
     ca_bundle = settings['certificate_ca_bundle']
 
-    encrypted_credentials = cache.get(cache_key)
+    # Look for already decrypted credentials in this process first.
+    credentials_cache = request.registry.credentials_cache
+    local_cache_key = (cache_key, client_state)
+    cached = credentials_cache.get(local_cache_key)
+
+    settings_ttl = int(settings['cache_credentials_ttl_seconds'])
+    refresh_ratio = float(settings['cache_credentials_refresh_ratio'])
+    bid_ttl = None
+
+    if cached is None:
+        statsd_count(request, "credentials_cache.miss")
 
-    if not encrypted_credentials:
-        settings_ttl = int(settings['cache_credentials_ttl_seconds'])
         bid_ttl = _extract_bid_assertion_ttl(bid_assertion)
         ttl = min(settings_ttl, bid_ttl or settings_ttl)
 
-        tokenserver = TokenserverClient(bid_assertion, client_state,
-                                        token_server_url, verify=ca_bundle)
-        if statsd:
-            statsd.watch_execution_time(tokenserver, prefix="tokenserver")
-        credentials = tokenserver.get_hawk_credentials(duration=ttl)
-        encrypted = encrypt(json.dumps(credentials), client_state, hmac_secret)
-        cache.set(cache_key, encrypted, ttl)
+        credentials = _get_cached_credentials(request, bid_assertion,
+                                              client_state, hmac_secrets,
+                                              ttl)
+
+        if credentials is None:
+            jitter_ratio = settings['cache_credentials_ttl_jitter_ratio']
+            ttl = _apply_ttl_jitter(ttl, jitter_ratio)
+            # Only one exchange per assertion at a time in this process.
+            tokenserver_flights = request.registry.tokenserver_flights
+            credentials = tokenserver_flights.do(
+                local_cache_key, _exchange_credentials, request,
+                bid_assertion, client_state, cache_key, ttl)
+        else:
+            # Do not keep credentials longer than the shared entry, whose
+            # token expires with it.
+            remaining_ttl = cache.ttl(cache_key)
+            if remaining_ttl >= 0:
+                ttl = min(ttl, remaining_ttl)
+
+        expires_at = time.time() + ttl
+        credentials_cache.set(local_cache_key, (credentials, expires_at), ttl)
     else:
-        credentials = json.loads(
-            decrypt(encrypted_credentials, client_state, hmac_secret))
+        statsd_count(request, "credentials_cache.hit")
+        credentials, expires_at = cached
+
+    # Renew credentials in the background before they expire.
+    refresh_window = refresh_ratio * settings_ttl
+    if expires_at - time.time() < refresh_window:
+        if bid_ttl is None:
+            bid_ttl = _extract_bid_assertion_ttl(bid_assertion)
+        # Only if the assertion outlives the current credentials.
+        if bid_ttl is None or bid_ttl > refresh_window:
+            ttl = min(settings_ttl, bid_ttl or settings_ttl)
+            # Renewed credentials must not expire together either.
+            jitter_ratio = settings['cache_credentials_ttl_jitter_ratio']
+            ttl = _apply_ttl_jitter(ttl, jitter_ratio)
+            # Not shared with exchanges, which must not wait for a refresh
+            # that may give up.
+            refresh_key = ('refresh',) + local_cache_key
+            request.registry.tokenserver_flights.start(
+                refresh_key, _refresh_credentials, request,
+                bid_assertion, client_state, cache_key, ttl, refresh_window)
 
     if statsd:
         timer = statsd.timer("syncclient.start_time")
         timer.start()
 
     sync_client = SyncClient(verify=ca_bundle, **credentials)
+    sync_client.client_state = client_state
+    # Reuse the connections opened to this storage node.
+    sync_sessions = request.registry.sync_sessions
+    sync_client.session = sync_sessions.get(credentials['api_endpoint'])
 
     if statsd:
         timer.stop()
         statsd.watch_execution_time(sync_client, prefix="syncclient")
 
+    if shared_clients is not None:
+        shared_clients[shared_key] = sync_client
+
     return sync_client
 
 
+def get_cache_hmac_secrets(settings):
+    """Return the list of configured ``cache_hmac_secret`` values, one per
+    line, newest first.
+    """
+    secrets = settings['cache_hmac_secret']
+    if isinstance(secrets, (list, tuple)):
+        return list(secrets)
+    return aslist_cronly(secrets)
+
+
+def _get_cached_credentials(request, bid_assertion, client_state,
+                            hmac_secrets, ttl):
+    """Read credentials from the cache backend.
+
+    Credentials stored with a previous ``cache_hmac_secret`` are re-encrypted
+    with the current one, so that rotating the secret does not invalidate
+    the whole cache at once.
+    """
+    cache = request.registry.cache
+    is_rotating = len(hmac_secrets) > 1
+
+    for i, hmac_secret in enumerate(hmac_secrets):
+        cache_key = 'credentials_%s' % utils.hmac_digest(hmac_secret,
+                                                         bid_assertion)
+        encrypted = cache.get(cache_key)
+        if not encrypted:
+            continue
+
+        credentials = decrypt_value(encrypted, client_state, hmac_secret)
+
+        if i == 0:
+            if is_rotating:
+                statsd_count(request, "credentials_cache.rotation.current")
+            return credentials
+
+        # Move the entry under the current secret.
+        remaining_ttl = cache.ttl(cache_key)
+        if remaining_ttl > 0:
+            ttl = min(ttl, remaining_ttl)
+        current_secret = hmac_secrets[0]
+        current_key = 'credentials_%s' % utils.hmac_digest(current_secret,
+                                                           bid_assertion)
+        encrypted = encrypt_value(credentials, client_state, current_secret)
+        cache.set(current_key, encrypted, ttl)
+        cache.delete(cache_key)
+        statsd_count(request, "credentials_cache.rotation.migrated")
+        return credentials
+
+    return None
+
+
+def _exchange_credentials(request, bid_assertion, client_state, cache_key,
+                          ttl, wait=True):
+    """Trade the BID assertion for Hawk credentials on the tokenserver and
+    store them encrypted in the cache.
+
+    A short-lived lock is taken in the cache backend, so that workers
+    receiving the same assertion wait for the first exchange to complete
+    instead of issuing their own, and do not retry the assertion if it was
+    refused. If `wait` is ``False``, ``None`` is returned when another
+    worker holds the lock.
+    """
+    settings = request.registry.settings
+    cache = request.registry.cache
+    statsd = request.registry.statsd
+    hmac_secret = get_cache_hmac_secrets(settings)[0]
+    ca_bundle = settings['certificate_ca_bundle']
+    lock_key = 'lock_%s' % cache_key
+    lock_ttl = float(settings['cache_credentials_lock_ttl_seconds'])
+
+    # Do not retry assertions that were just refused by the tokenserver.
+    error_key = 'credentials_error_%s' % utils.hmac_digest(
+        hmac_secret, '%s %s' % (client_state, bid_assertion))
+    _raise_cached_error(request, cache, error_key)
+
+    is_locked = _acquire_cache_lock(cache, lock_key, lock_ttl)
+    if not is_locked:
+        if not wait:
+            return None
+        encrypted = _wait_for_cache_value(cache, cache_key, lock_key,
+                                          lock_ttl)
+        if encrypted:
+            statsd_count(request, "tokenserver.coalesced")
+            return decrypt_value(encrypted, client_state, hmac_secret)
+        # The other exchange failed or timed out: it may have been refused.
+        _raise_cached_error(request, cache, error_key)
+        is_locked = _acquire_cache_lock(cache, lock_key, lock_ttl)
+
+    try:
+        tokenserver = TokenserverClient(bid_assertion, client_state,
+                                        settings['token_server_url'],
+                                        verify=ca_bundle)
+        if statsd:
+            statsd.watch_execution_time(tokenserver, prefix="tokenserver")
+        breaker = request.registry.tokenserver_breaker
+        credentials = breaker.call(tokenserver.get_hawk_credentials,
+                                   duration=ttl)
+        encrypted = encrypt_value(credentials, client_state, hmac_secret)
+        cache.set(cache_key, encrypted, ttl)
+    except HTTPError as e:
+        error_ttl = float(settings['cache_credentials_error_ttl_seconds'])
+        # Cache backends keep entries without a TTL forever.
+        is_refused = (e.response is not None and
+                      e.response.status_code in (401, 403))
+        if is_refused and error_ttl > 0:
+            error = {'status': e.response.status_code,
+                     'reason': e.response.reason,
+                     'text': e.response.text}
+            cache.set(error_key, error, error_ttl)
+        raise
+    finally:
+        if is_locked:
+            cache.delete(lock_key)
+
+    return credentials
+
+
+def _raise_cached_error(request, cache, error_key):
+    """Raise the tokenserver refusal stored in the cache, if any."""
+    error = cache.get(error_key)
+    if error:
+        statsd_count(request, "tokenserver.refused_from_cache")
+        raise _build_http_error(error)
+
+
+def _build_http_error(error):
+    """Rebuild the tokenserver error response stored in the cache."""
+    response = requests.models.Response()
+    response.status_code = error['status']
+    response.reason = error['reason']
+    response._content = error['text'].encode('utf-8')
+    response.encoding = 'utf-8'
+    message = '%s %s' % (response.status_code, response.reason)
+    return HTTPError(message, response=response)
+
+
+def _refresh_credentials(request, bid_assertion, client_state, cache_key,
+                         ttl, refresh_window):
+    """Renew cached credentials ahead of their expiration. Runs outside of
+    the request cycle, hence errors are only logged.
+    """
+    settings = request.registry.settings
+    cache = request.registry.cache
+    credentials_cache = request.registry.credentials_cache
+
+    try:
+        remaining_ttl = cache.ttl(cache_key)
+        if remaining_ttl > refresh_window:
+            # Already renewed by another worker.
+            encrypted = cache.get(cache_key)
+            hmac_secret = get_cache_hmac_secrets(settings)[0]
+            credentials = decrypt_value(encrypted, client_state, hmac_secret)
+            ttl = remaining_ttl
+        else:
+            credentials = _exchange_credentials(request, bid_assertion,
+                                                client_state, cache_key, ttl,
+                                                wait=False)
+            if credentials is None:
+                return
+            statsd_count(request, "tokenserver.refreshed")
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return
+
+    expires_at = time.time() + ttl
+    credentials_cache.set((cache_key, client_state),
+                          (credentials, expires_at), ttl)
+
+
+def _apply_ttl_jitter(ttl, ratio):
+    """Shorten the `ttl` by a random fraction up to `ratio`, so that entries
+    created at the same time do not all expire at once.
+    """
+    return ttl * (1 - random.uniform(0, float(ratio)))
+
+
+def _acquire_cache_lock(cache, lock_key, ttl):
+    """Best effort lock on top of the cache backend, which does not provide
+    an atomic *set if not exists* operation.
+    """
+    if cache.get(lock_key) is not None:
+        return False
+    token = uuid.uuid4().hex
+    cache.set(lock_key, token, ttl)
+    return cache.get(lock_key) == token
+
+
+def _wait_for_cache_value(cache, key, lock_key, timeout):
+    """Poll the cache until `key` is set, the lock is released or
+    `timeout` seconds have elapsed.
+    """
+    deadline = time.time() + timeout
+    while True:
+        value = cache.get(key)
+        if value or cache.get(lock_key) is None or time.time() > deadline:
+            return value
+        time.sleep(LOCK_POLL_INTERVAL_SECONDS)
+
+
 def base64url_decode(value):
     """Pad base64 value with == and decode from base64 using URL-safe
     alphabet substitutions.
@@ -118,19 +398,56 @@ def base64url_decode(value):
         raise ValueError(str(e))
 
 
-def _extract_bid_assertion_ttl(bid_assertion):
-    """A BrowserID assertion is a list of base64 blocks separated with ``.``.
-    Return the smallest ttl from the JSON block that contain an expiration
-    timestamp.
+def parse_bid_assertion(bid_assertion, use_cache=True):
+    """A BrowserID assertion is a list of certificates and an assertion,
+    separated with ``~``, each of them being a JWS (``header.payload.sig``).
+
+    Only the payloads are decoded, and skipped if larger than
+    ``MAX_ASSERTION_PAYLOAD_LENGTH``. Return a dict with the smallest
+    expiration timestamp (in milliseconds) and the audience and issuer of
+    the assertion, any of them being ``None`` if not found.
     """
-    ttl = None
-    for fragment in bid_assertion.split('.'):
+    if isinstance(bid_assertion, text_type):
+        bid_assertion = bid_assertion.encode('utf-8')
+    digest = hashlib.sha256(bid_assertion).hexdigest()
+
+    if use_cache:
+        parsed = _parsed_assertions.get(digest)
+        if parsed is not None:
+            return parsed
+
+    parsed = {'exp': None, 'aud': None, 'iss': None}
+    for chunk in bid_assertion.split(b'~'):
+        segments = chunk.split(b'.')
+        if len(segments) != 3:
+            continue
+        payload = segments[1]
+        if len(payload) > MAX_ASSERTION_PAYLOAD_LENGTH:
+            continue
         try:
-            decoded_fragment = base64url_decode(fragment)
-            payload = json.loads(decoded_fragment)
+            payload = json.loads(base64url_decode(payload))
         except ValueError:
-            payload = {}
-        if 'exp' in payload:
-            exp = (payload['exp'] / 1000) - time.time()  # UTC
-            ttl = min(exp, ttl or exp)
-    return ttl
+            continue
+        if not isinstance(payload, dict):
+            continue
+        exp = payload.get('exp')
+        if isinstance(exp, (int, float)):
+            parsed['exp'] = min(exp, parsed['exp'] or exp)
+        # The issuer is given by the certificates, the audience by the
+        # assertion itself, which comes last.
+        parsed['iss'] = parsed['iss'] or payload.get('iss')
+        parsed['aud'] = payload.get('aud', parsed['aud'])
+
+    if use_cache:
+        _parsed_assertions.set(digest, parsed)
+    return parsed
+
+
+def _extract_bid_assertion_ttl(bid_assertion):
+    """Return the number of seconds until the assertion or one of its
+    certificates expires.
+    """
+    exp = parse_bid_assertion(bid_assertion)['exp']
+    if exp is None:
+        return None
+    return (exp / 1000.0) - time.time()  # UTC
@@ -0,0 +1,278 @@
+import json
+import threading
+from collections import defaultdict, OrderedDict
+
+from pyramid.interfaces import IRoutesMapper
+from requests.structures import CaseInsensitiveDict
+
+from syncto import AUTHORIZATION_HEADER, CLIENT_STATE_HEADER
+from syncto.info_collections import invalidate_collections_timestamps
+from syncto.page_cache import CachedSyncResponse
+from syncto.record_cache import invalidate_records
+from syncto.snapshots import invalidate_snapshot
+
+# Headers of record reads that have to be sent to Sync one by one.
+PRECONDITION_HEADERS = ('If-Match', 'If-None-Match')
+
+
+class _SyncBatch(object):
+    """Sync request shared by several subrequests of a batch, sent by the
+    first of them. Its outcome, results or error, is kept for the others.
+    """
+    def __init__(self):
+        self._results = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self._results is None and self._error is None:
+                try:
+                    self._results = func(*args)
+                except Exception as e:
+                    self._error = e
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+
+class RecordBatch(_SyncBatch):
+    """Records of a collection read by several subrequests of a batch,
+    fetched from Sync with a single ``ids`` query on first use.
+    """
+    def __init__(self, ids):
+        super(RecordBatch, self).__init__()
+        self.ids = ids
+
+    def get_record(self, request, sync_client, collection_name, record_id,
+                   headers):
+        """Return the record, or ``None`` if it does not exist, along with a
+        stand-in Sync response for :func:`syncto.headers.export_headers`.
+        """
+        records, sync_headers = self._run(self._fetch, request, sync_client,
+                                          collection_name, headers)
+        record = records.get(record_id)
+        if record is None:
+            return None, None
+
+        sync_headers = CaseInsensitiveDict(sync_headers)
+        sync_headers['X-Last-Modified'] = '%.2f' % record['modified']
+        return dict(record), CachedSyncResponse(sync_headers)
+
+    def _fetch(self, request, sync_client, collection_name, headers):
+        settings = request.registry.settings
+        records = sync_client.get_records_by_ids(
+            collection_name, self.ids, full=True, headers=headers,
+            chunk_size=int(settings['sync_max_ids_per_request']),
+            max_workers=int(settings['sync_max_parallel_requests']))
+
+        sync_headers = CaseInsensitiveDict(sync_client.raw_resp.headers)
+        for name in ('X-Weave-Records', 'X-Weave-Next-Offset'):
+            sync_headers.pop(name, None)
+        return dict((r['id'], r) for r in records), sync_headers
+
+
+class RecordWriteBatch(_SyncBatch):
+    """Records of a collection written by consecutive subrequests of a
+    batch, sent to Sync with ``POST`` requests on first use.
+    """
+    def __init__(self):
+        super(RecordWriteBatch, self).__init__()
+        self.records = OrderedDict()
+
+    def put_record(self, request, sync_client, collection_name, record_id,
+                   headers):
+        """Return the new timestamp of the record, or the reasons why Sync
+        did not store it, along with a stand-in Sync response for
+        :func:`syncto.headers.export_headers`.
+        """
+        results = self._run(self._post, request, sync_client,
+                            collection_name, headers)
+        outcome = results[record_id]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def _post(self, request, sync_client, collection_name, headers):
+        """Return the outcome of each record, or the error of its chunk:
+        records of the other chunks may have been stored by Sync.
+        """
+        results = {}
+        try:
+            for chunk in self._chunks(request):
+                try:
+                    result = sync_client.post_records(collection_name, chunk,
+                                                      headers=headers)
+                except Exception as e:
+                    for record in chunk:
+                        results[record['id']] = e
+                    continue
+                sync_response = CachedSyncResponse(
+                    CaseInsensitiveDict(sync_client.raw_resp.headers))
+                success = set(result.get('success', []))
+                failed = result.get('failed', {})
+                for record in chunk:
+                    if record['id'] in success:
+                        outcome = (result['modified'], None)
+                    else:
+                        reasons = failed.get(record['id']) or ['unknown']
+                        outcome = (None, reasons)
+                    results[record['id']] = outcome + (sync_response,)
+        finally:
+            invalidate_collections_timestamps(request, sync_client)
+            invalidate_records(request, sync_client, collection_name,
+                               list(self.records))
+        return results
+
+    def _chunks(self, request):
+        """Split the records in chunks of at most ``sync_max_post_records``
+        records and ``sync_max_post_bytes`` bytes once serialized.
+        """
+        settings = request.registry.settings
+        max_records = int(settings['sync_max_post_records'])
+        max_bytes = int(settings['sync_max_post_bytes'])
+
+        # Sizes of the JSON list sent by SyncClient.post_records().
+        chunk, size = [], 2
+        for record in self.records.values():
+            record_size = len(json.dumps(record)) + 2
+            if chunk and (len(chunk) >= max_records or
+                          size + record_size > max_bytes):
+                yield chunk
+                chunk, size = [], 2
+            chunk.append(record)
+            size += record_size
+        if chunk:
+            yield chunk
+
+
+class RecordDeleteBatch(_SyncBatch):
+    """Records of a collection deleted by consecutive subrequests of a
+    batch, deleted from Sync with ``ids`` queries on first use.
+    """
+    def __init__(self):
+        super(RecordDeleteBatch, self).__init__()
+        self.records = OrderedDict()
+
+    def delete_record(self, request, sync_client, collection_name, record_id,
+                      headers):
+        """Return whether the record existed before its deletion."""
+        deleted = self._run(self._delete, request, sync_client,
+                            collection_name, headers)
+        return record_id in deleted
+
+    def _delete(self, request, sync_client, collection_name, headers):
+        deleted, _ = delete_records(request, sync_client, collection_name,
+                                    list(self.records), headers)
+        return set(deleted)
+
+
+def delete_records(request, sync_client, collection_name, ids, headers):
+    """Delete the records of the collection with the given `ids`, with one
+    listing and one deletion per chunk of ``sync_max_ids_per_request`` ids.
+
+    :returns: the ids of the records that existed, and the last Sync
+              response.
+    """
+    settings = request.registry.settings
+    chunk_size = int(settings['sync_max_ids_per_request'])
+    headers = dict(headers)
+
+    deleted = []
+    sync_response = None
+    try:
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            existing = set(sync_client.get_records(collection_name,
+                                                   full=False, ids=chunk,
+                                                   headers=headers))
+            sync_response = sync_client.raw_resp
+            chunk = [record_id for record_id in chunk if record_id in existing]
+            if not chunk:
+                continue
+            result = sync_client.delete_records(collection_name, chunk,
+                                                headers=headers)
+            sync_response = sync_client.raw_resp
+            deleted.extend(chunk)
+            # The precondition applies to the collection before the deletion.
+            if 'X-If-Unmodified-Since' in headers:
+                headers['X-If-Unmodified-Since'] = '%.2f' % result['modified']
+    finally:
+        invalidate_collections_timestamps(request, sync_client)
+        invalidate_snapshot(request, sync_client, collection_name)
+        invalidate_records(request, sync_client, collection_name, ids)
+    return deleted, sync_response
+
+
+def record_batch_key(bucket_id, collection_name, headers):
+    """Subrequests sharing this key can be sent to Sync together."""
+    return (bucket_id, collection_name, headers.get(AUTHORIZATION_HEADER),
+            headers.get(CLIENT_STATE_HEADER))
+
+
+def match_subrequest(request, subrequest, route_name):
+    """Return the matchdict of the `subrequest` if it targets the
+    `route_name` route, without querystring nor preconditions, or ``None``.
+    """
+    if subrequest.query_string:
+        return None
+    if any(name in subrequest.headers for name in PRECONDITION_HEADERS):
+        return None
+    mapper = request.registry.getUtility(IRoutesMapper)
+    info = mapper(subrequest)
+    if info['route'] is None or info['route'].name != route_name:
+        return None
+    return info['match']
+
+
+def plan_record_batches(request, subrequests, route_name):
+    """Group the reads of records of the same collection, with the same
+    credentials, among the `subrequests` of a batch.
+
+    :returns: the :class:`RecordBatch` of each group of several records.
+    """
+    ids = defaultdict(list)
+    for subrequest in subrequests:
+        if subrequest.method != 'GET':
+            continue
+        match = match_subrequest(request, subrequest, route_name)
+        if match is None:
+            continue
+        key = record_batch_key(match['bucket_id'], match['collection_name'],
+                               subrequest.headers)
+        if match['record_id'] not in ids[key]:
+            ids[key].append(match['record_id'])
+
+    return dict((key, RecordBatch(record_ids))
+                for key, record_ids in ids.items() if len(record_ids) > 1)
+
+
+def get_record_write_batch(request, collection_name):
+    """Return the :class:`RecordWriteBatch` or :class:`RecordDeleteBatch`
+    planned for the record written by this subrequest, or ``None``.
+    """
+    record_writes = request.bound_data.get('record_writes')
+    if not record_writes:
+        return None
+    # Write batches are only planned for groups of subrequests writing
+    # different records with the same key.
+    key = record_batch_key(request.matchdict['bucket_id'], collection_name,
+                           request.headers)
+    return record_writes.get((request.method, key))
+
+
+def get_record_batch(request, collection_name, record_id):
+    """Return the :class:`RecordBatch` planned for the record read by this
+    subrequest, or ``None``.
+    """
+    record_batches = request.bound_data.get('record_batches')
+    if not record_batches:
+        return None
+    if any(name in request.headers for name in PRECONDITION_HEADERS):
+        return None
+    key = record_batch_key(request.matchdict['bucket_id'], collection_name,
+                           request.headers)
+    record_batch = record_batches.get(key)
+    if record_batch is None or record_id not in record_batch.ids:
+        return None
+    return record_batch
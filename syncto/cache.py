@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded in-process cache with a per-entry expiration.
+
+    The least recently used entry is evicted when ``max_size`` is reached,
+    and entries never live longer than ``max_ttl`` seconds.
+    """
+    def __init__(self, max_size=1000, max_ttl=60):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._store.pop(key, None)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return None
+            # Mark as most recently used.
+            self._store[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if self.max_size <= 0:
+            return
+        ttl = self.max_ttl if ttl is None else min(ttl, self.max_ttl)
+        with self._lock:
+            self._store.pop(key, None)
+            self._store[key] = (value, time.time() + ttl)
+            while len(self._store) > self.max_size:
+                self._store.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._store.pop(key, None)
+
+    def flush(self):
+        with self._lock:
+            self._store.clear()
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls sharing the same key: the first caller
+    runs the function while the others wait for its outcome.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def start(self, key, func, *args, **kwargs):
+        """Run the call in a background thread, unless one is already
+        pending for this key.
+
+        :returns: ``True`` if the call was started.
+        """
+        with self._lock:
+            if key in self._calls:
+                return False
+            call = self._calls[key] = _Call()
+
+        def run():
+            try:
+                call.result = func(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
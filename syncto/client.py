@@ -0,0 +1,356 @@
+import codecs
+import copy
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from six.moves.http_cookiejar import DefaultCookiePolicy
+from six.moves.urllib.parse import urlparse
+from syncclient import client as syncclient
+
+from syncto.records import sort_records
+
+
+# Size of the chunks read from streamed Sync responses.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+class SessionPool(object):
+    """Keep one ``requests.Session`` per Sync storage node, so that
+    connections (and their TLS handshakes) are reused between requests of
+    every user whose credentials point to the same node.
+    """
+    def __init__(self, pool_size=10, idle_timeout=60, max_age=300):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _create_session(self):
+        session = requests.Session()
+        # Sessions are shared by users: cookies must not be replayed.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, api_endpoint):
+        """Return the session of the storage node behind `api_endpoint`.
+
+        Sessions that were idle for too long or that reached their maximum
+        age are replaced. They are not closed, since other threads may still
+        be using them: their connections are released once they are
+        garbage-collected.
+        """
+        parsed = urlparse(api_endpoint)
+        node = '%s://%s' % (parsed.scheme, parsed.netloc)
+        now = time.time()
+
+        with self._lock:
+            entry = self._sessions.get(node)
+            if entry is not None:
+                session, created, last_used = entry
+                too_old = (now - created) > self.max_age
+                too_idle = (now - last_used) > self.idle_timeout
+                if too_old or too_idle:
+                    entry = None
+
+            if entry is None:
+                session, created = self._create_session(), now
+
+            self._sessions[node] = (session, created, now)
+        return session
+
+    def close(self):
+        with self._lock:
+            for session, _, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+class SyncClient(syncclient.SyncClient):
+    """SyncClient issuing its requests through a pooled session when one
+    is assigned.
+    """
+    session = None
+    # Client state of the user, used to encrypt what is cached on its behalf.
+    client_state = None
+
+    def _request(self, method, url, stream=False, **kwargs):
+        url = self.api_endpoint.rstrip('/') + '/' + url.lstrip('/')
+        kwargs.setdefault('verify', self.verify)
+        if stream:
+            kwargs['stream'] = True
+        http = self.session or requests
+        self.raw_resp = http.request(method, url, auth=self.auth, **kwargs)
+        self.raw_resp.raise_for_status()
+
+        if self.raw_resp.status_code == 304:
+            http_error_msg = '%s Client Error: %s for url: %s' % (
+                self.raw_resp.status_code,
+                self.raw_resp.reason,
+                self.raw_resp.url)
+            raise requests.exceptions.HTTPError(http_error_msg,
+                                                response=self.raw_resp)
+        if stream:
+            return self.raw_resp
+        return self.raw_resp.json()
+
+    def stream_records(self, collection, **kwargs):
+        """Same as ``get_records(full=True)``, except that the response body
+        is parsed incrementally: records are yielded one at a time.
+
+        The request is sent, and HTTP errors raised, before iterating.
+        """
+        response = self.get_records(collection, full=True, stream=True,
+                                    **kwargs)
+        return _iter_response_records(response)
+
+    def clone(self):
+        """Return a client sharing the credentials and the session of this
+        one, in order to issue requests concurrently: each client keeps the
+        last response in ``raw_resp``.
+        """
+        clone = object.__new__(self.__class__)
+        for name in ('user_id', 'api_endpoint', 'auth', 'verify', 'session',
+                     'client_state'):
+            setattr(clone, name, getattr(self, name))
+        return clone
+
+    def get_records_by_ids(self, collection, ids, chunk_size=100,
+                           max_workers=4, full=True, sort=None, **kwargs):
+        """Same as ``get_records(ids=ids)``, except that `ids` are fetched by
+        chunks of `chunk_size`, up to `max_workers` chunks concurrently.
+
+        Records are merged in the `sort` order, and ``raw_resp`` headers
+        describe the merged result.
+        """
+        chunks = [ids[i:i + chunk_size]
+                  for i in range(0, len(ids), chunk_size)]
+        clients = [self.clone() for _ in chunks]
+
+        def fetch(client, chunk):
+            return client.get_records(collection, full=full, ids=chunk,
+                                      sort=sort, **kwargs)
+
+        results = run_concurrently(
+            [(fetch, client, chunk) for client, chunk in zip(clients, chunks)],
+            max_workers=max_workers)
+
+        records = [record for result in results for record in result]
+        if full:
+            records = sort_records(records, sort)
+
+        responses = [client.raw_resp for client in clients]
+        self.raw_resp = copy.copy(responses[-1])
+        headers = CaseInsensitiveDict(self.raw_resp.headers)
+        headers.pop('X-Weave-Next-Offset', None)
+        headers['X-Weave-Records'] = str(len(records))
+        last_modified = [r.headers['X-Last-Modified'] for r in responses
+                         if 'X-Last-Modified' in r.headers]
+        if last_modified:
+            headers['X-Last-Modified'] = max(last_modified, key=float)
+        self.raw_resp.headers = headers
+        return records
+
+    def post_records(self, collection, records, **kwargs):
+        """Create or update several records at once.
+
+        :returns: the Sync result, giving the new ``modified`` timestamp, the
+                  ``success`` ids and the ``failed`` ids with their reasons.
+        """
+        headers = dict(kwargs.pop('headers', {}))
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        return self._request('post', '/storage/%s' % collection.lower(),
+                             data=json.dumps(records), headers=headers,
+                             **kwargs)
+
+    def delete_records(self, collection, ids, **kwargs):
+        """Delete the records of the collection with the given `ids`.
+
+        :returns: the Sync result, giving the new ``modified`` timestamp.
+        """
+        return self._request('delete', '/storage/%s' % collection.lower(),
+                             params={'ids': ','.join(ids)}, **kwargs)
+
+    def get_raw_records(self, collection, **kwargs):
+        """Same as ``get_records(full=True)``, except that the response body
+        is returned as bytes, without being decoded.
+        """
+        response = self.get_records(collection, full=True, stream=True,
+                                    **kwargs)
+        return response.content
+
+
+def run_concurrently(calls, max_workers=4):
+    """Run the ``(func, arg1, arg2, ...)`` `calls` in up to `max_workers`
+    threads, and return their results in order.
+
+    Once every call completed, the first error is raised if any failed.
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    pending = list(enumerate(calls))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                i, call = pending.pop(0)
+            func, args = call[0], call[1:]
+            try:
+                results[i] = func(*args)
+            except Exception as e:
+                errors[i] = e
+
+    workers = min(max_workers, len(calls))
+    threads = [threading.Thread(target=worker) for _ in range(workers - 1)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # The current thread takes part too.
+    worker()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+def _iter_response_records(response):
+    try:
+        chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        for record in iter_json_array(chunks):
+            yield record
+    finally:
+        response.close()
+
+
+def iter_json_array(chunks):
+    """Incrementally parse a JSON array of objects from an iterable of
+    UTF-8 encoded `chunks`, yielding its items one at a time.
+
+    Only the item being parsed is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+    incomplete = False
+
+    for chunk in chunks:
+        text = text_decoder.decode(chunk)
+        buffer += text
+        # An incomplete item cannot be decoded until it is closed.
+        if incomplete and '}' not in text:
+            continue
+        incomplete = False
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('Expecting a JSON array.')
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                incomplete = True
+                break
+            yield item
+        buffer = buffer[pos:]
+
+    raise ValueError('Unterminated JSON array.')
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling a service considered as unavailable."""
+    def __init__(self, retry_after, *args, **kwargs):
+        super(CircuitOpenError, self).__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Stop calling an upstream service after consecutive failures.
+
+    Once ``max_failures`` consecutive calls failed, the circuit opens and
+    calls fail fast with :class:`CircuitOpenError` for ``reset_timeout``
+    seconds. A single probe call is then let through: the circuit closes if
+    it succeeds and opens again otherwise.
+    """
+    def __init__(self, max_failures=5, reset_timeout=30):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            elapsed = time.time() - self.opened_at
+            if elapsed < self.reset_timeout or self._probing:
+                retry_after = max(int(self.reset_timeout - elapsed), 1)
+                raise CircuitOpenError(retry_after,
+                                       "Circuit open, retry later.")
+            # Half-open: let this call probe the service.
+            self._probing = True
+
+    def _after_call(self, failed):
+        with self._lock:
+            was_probing, self._probing = self._probing, False
+            if failed is None:
+                # Not an answer of a healthy service: a failed probe.
+                if was_probing:
+                    self.opened_at = time.time()
+                return
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if was_probing or self.failures >= self.max_failures:
+                self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        """Run `func` unless the circuit is open.
+
+        Connection errors and ``5XX`` responses count as failures. Other
+        errors, like garbled responses, leave the failures count unchanged
+        but fail probes.
+        """
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except requests.exceptions.HTTPError as e:
+            response = e.response
+            self._after_call(failed=response is None or
+                             response.status_code >= 500)
+            raise
+        except requests.exceptions.RequestException:
+            self._after_call(failed=True)
+            raise
+        except Exception:
+            self._after_call(failed=None)
+            raise
+        self._after_call(failed=False)
+        return result
@@ -1,31 +1,100 @@
+import binascii
 import codecs
+import json
+
 import nacl.secret
 import nacl.utils
 from hkdf import Hkdf
 from six import text_type
 
+from syncto.cache import LRUCache
+
+
+# Values starting with this prefix are stored in the compact format.
+# Others are hex-encoded ciphertexts of a JSON document.
+COMPACT_FORMAT_PREFIX = 'v2:'
+
+_compact_json = json.JSONEncoder(separators=(',', ':'))
+
+SECRET_BOXES_CACHE_SIZE = 1024
+SECRET_BOXES_CACHE_TTL_SECONDS = 3600
+
+# Derived boxes, keyed by secret and HMAC secret.
+_secret_boxes = LRUCache(max_size=SECRET_BOXES_CACHE_SIZE,
+                         max_ttl=SECRET_BOXES_CACHE_TTL_SECONDS)
+
 
-def _get_nacl_secret_box(secret, hmac_secret):
+def _get_nacl_secret_box(secret, hmac_secret, use_cache=True):
     if isinstance(secret, text_type):
         secret = secret.encode("utf-8")
 
     if isinstance(hmac_secret, text_type):
         hmac_secret = hmac_secret.encode("utf-8")
 
+    cache_key = (secret, hmac_secret)
+    if use_cache:
+        box = _secret_boxes.get(cache_key)
+        if box is not None:
+            return box
+
     secret_key = Hkdf(b"", hmac_secret).expand(secret)
     box = nacl.secret.SecretBox(secret_key)
+
+    if use_cache:
+        _secret_boxes.set(cache_key, box)
     return box
 
 
-def encrypt(message, secret, hmac_secret):
-    box = _get_nacl_secret_box(secret, hmac_secret)
+def get_secret_box(secret, hmac_secret):
+    """Return the box used to encrypt values with `secret`, derived from
+    `hmac_secret`. Boxes are memoized since key derivation is costly.
+    """
+    return _get_nacl_secret_box(secret, hmac_secret)
+
+
+def encrypt_with_box(message, box):
     message_bytes = message.encode('utf-8')
     nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
     return codecs.encode(box.encrypt(message_bytes, nonce),
                          'hex_codec').decode('utf-8')
 
 
-def decrypt(encrypted, secret, hmac_secret):
-    box = _get_nacl_secret_box(secret, hmac_secret)
+def decrypt_with_box(encrypted, box):
     message_bytes = box.decrypt(codecs.decode(encrypted, 'hex_codec'))
     return message_bytes.decode('utf-8')
+
+
+def encrypt(message, secret, hmac_secret):
+    box = get_secret_box(secret, hmac_secret)
+    return encrypt_with_box(message, box)
+
+
+def decrypt(encrypted, secret, hmac_secret):
+    box = get_secret_box(secret, hmac_secret)
+    return decrypt_with_box(encrypted, box)
+
+
+def encrypt_value(value, secret, hmac_secret):
+    """Serialize and encrypt `value` in the compact format: the base64
+    ciphertext of its compact JSON representation.
+    """
+    box = get_secret_box(secret, hmac_secret)
+    message_bytes = _compact_json.encode(value).encode('utf-8')
+    nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
+    encoded = binascii.b2a_base64(box.encrypt(message_bytes, nonce))
+    return COMPACT_FORMAT_PREFIX + encoded.decode('ascii').rstrip('\n')
+
+
+def decrypt_value(encrypted, secret, hmac_secret):
+    """Decrypt and deserialize a value encrypted with :func:`encrypt_value`
+    or with :func:`encrypt` from a JSON document.
+    """
+    if isinstance(encrypted, bytes):
+        encrypted = encrypted.decode('ascii')
+
+    if not encrypted.startswith(COMPACT_FORMAT_PREFIX):
+        return json.loads(decrypt(encrypted, secret, hmac_secret))
+
+    box = get_secret_box(secret, hmac_secret)
+    ciphertext = binascii.a2b_base64(encrypted[len(COMPACT_FORMAT_PREFIX):])
+    return json.loads(box.decrypt(ciphertext).decode('utf-8'))
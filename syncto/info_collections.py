@@ -0,0 +1,83 @@
+from pyramid import httpexceptions
+
+from cliquet import utils
+from cliquet.statsd import statsd_count
+
+from syncto.authentication import get_cache_hmac_secrets
+
+
+def _cache_key(request, sync_client):
+    hmac_secret = get_cache_hmac_secrets(request.registry.settings)[0]
+    return 'info_collections_%s' % utils.hmac_digest(hmac_secret,
+                                                     sync_client.api_endpoint)
+
+
+def get_collections_timestamps(request, sync_client):
+    """Return the last modification timestamps of the user collections, as
+    given by Sync ``info/collections`` and cached for a short while.
+    """
+    settings = request.registry.settings
+    ttl = int(settings['cache_info_collections_ttl_seconds'])
+    if ttl <= 0:
+        return sync_client.info_collections()
+
+    cache = request.registry.cache
+    cache_key = _cache_key(request, sync_client)
+
+    timestamps = cache.get(cache_key)
+    if timestamps is None:
+        statsd_count(request, "info_collections_cache.miss")
+        timestamps = sync_client.info_collections()
+        cache.set(cache_key, timestamps, ttl)
+    else:
+        statsd_count(request, "info_collections_cache.hit")
+    return timestamps
+
+
+def invalidate_collections_timestamps(request, sync_client):
+    """Forget the cached timestamps after the user collections changed."""
+    settings = request.registry.settings
+    if int(settings['cache_info_collections_ttl_seconds']) > 0:
+        request.registry.cache.delete(_cache_key(request, sync_client))
+
+
+def get_not_modified_response(request, sync_client, collection_name,
+                              headers, record_id=None):
+    """Return a ``304 Not Modified`` response, to be answered without
+    querying the collection if the Sync ``X-If-Modified-Since`` header
+    converted from ``If-None-Match`` is not older than the collection
+    timestamp, or ``None``.
+
+    The response is returned rather than raised, since Pyramid follows
+    raised redirections in batch subrequests.
+
+    For a `record_id`, the record timestamp is unknown: the ``ETag`` of the
+    response is the ``If-None-Match`` value of the request.
+
+    The timestamps being cached, writes made by other Sync clients are only
+    seen once the ``cache_info_collections_ttl_seconds`` have elapsed.
+    """
+    settings = request.registry.settings
+    if int(settings['cache_info_collections_ttl_seconds']) <= 0:
+        return None
+
+    modified_since = headers.get('X-If-Modified-Since')
+    if modified_since is None:
+        return None
+
+    timestamps = get_collections_timestamps(request, sync_client)
+    collection_timestamp = timestamps.get(collection_name)
+    if collection_timestamp is None:
+        return None
+
+    if round(collection_timestamp, 2) <= float(modified_since):
+        statsd_count(request, "info_collections_cache.not_modified")
+        response = httpexceptions.HTTPNotModified()
+        if record_id is None:
+            etag = '"%s"' % int(collection_timestamp * 1000)
+        else:
+            etag = request.headers['If-None-Match']
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache'
+        return utils.reapply_cors(request, response)
+    return None
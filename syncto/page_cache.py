@@ -0,0 +1,92 @@
+import json
+
+from cliquet import utils
+from cliquet.statsd import statsd_count
+
+from syncto.authentication import get_cache_hmac_secrets
+from syncto.crypto import encrypt_value, decrypt_value
+from syncto.info_collections import get_collections_timestamps
+
+# Sync response headers from which the Kinto headers are rebuilt. Alerts
+# and backoff instructions are not replayed.
+CACHED_SYNC_HEADERS = ('X-Last-Modified', 'X-Weave-Next-Offset',
+                       'X-Weave-Records', 'X-Weave-Quota-Remaining')
+
+
+class CachedSyncResponse(object):
+    """Stand-in for the Sync response of a cached page, to be given to
+    :func:`syncto.headers.export_headers`.
+    """
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def get_page_cache_key(request, sync_client, collection_name, params,
+                       headers):
+    """Return the cache key of the collection page requested with the Sync
+    `params`, or ``None`` if the page should not be cached.
+
+    The key changes with the collection timestamp, hence entries are never
+    invalidated explicitly. Since this timestamp is read from the cached
+    ``info/collections``, pages are not cached when it is disabled.
+    """
+    settings = request.registry.settings
+    if int(settings['cache_collection_pages_ttl_seconds']) <= 0:
+        return None
+    if int(settings['cache_info_collections_ttl_seconds']) <= 0:
+        return None
+
+    # Preconditions have to be checked by Sync.
+    if 'X-If-Unmodified-Since' in headers:
+        return None
+
+    timestamps = get_collections_timestamps(request, sync_client)
+    collection_timestamp = timestamps.get(collection_name)
+    if collection_timestamp is None:
+        return None
+
+    normalized = dict(params)
+    if 'ids' in normalized:
+        normalized['ids'] = sorted(normalized['ids'])
+    page = '%s %s %s %s' % (sync_client.api_endpoint, collection_name,
+                            collection_timestamp,
+                            json.dumps(normalized, sort_keys=True))
+    hmac_secret = get_cache_hmac_secrets(settings)[0]
+    return 'collection_page_%s' % utils.hmac_digest(hmac_secret, page)
+
+
+def get_cached_page(request, sync_client, cache_key):
+    """Return the Sync headers and the body of the cached page, or ``None``.
+    """
+    settings = request.registry.settings
+    encrypted = request.registry.cache.get(cache_key)
+    if not encrypted:
+        statsd_count(request, "collection_pages_cache.miss")
+        return None
+
+    statsd_count(request, "collection_pages_cache.hit")
+    hmac_secret = get_cache_hmac_secrets(settings)[0]
+    page = decrypt_value(encrypted, sync_client.client_state, hmac_secret)
+    return CachedSyncResponse(page['headers']), page['body'].encode('utf-8')
+
+
+def cache_page(request, sync_client, cache_key, sync_response, body):
+    """Store the `body` of a page encrypted with the user client state,
+    along with the headers of its `sync_response`. Pages larger than
+    ``cache_collection_pages_max_bytes`` are not stored.
+    """
+    settings = request.registry.settings
+    if len(body) > int(settings['cache_collection_pages_max_bytes']):
+        return
+
+    sync_headers = sync_response.headers
+    page = {
+        'headers': dict((name, sync_headers[name])
+                        for name in CACHED_SYNC_HEADERS
+                        if name in sync_headers),
+        'body': body.decode('utf-8')
+    }
+    hmac_secret = get_cache_hmac_secrets(settings)[0]
+    encrypted = encrypt_value(page, sync_client.client_state, hmac_secret)
+    ttl = int(settings['cache_collection_pages_ttl_seconds'])
+    request.registry.cache.set(cache_key, encrypted, ttl)
@@ -0,0 +1,114 @@
+import json
+
+from cliquet import logger
+from cliquet import utils
+from cliquet.statsd import statsd_count
+
+from syncto.authentication import get_cache_hmac_secrets
+from syncto.crypto import encrypt_value, decrypt_value
+from syncto.page_cache import CACHED_SYNC_HEADERS, CachedSyncResponse
+
+# Sync headers that can be honoured when serving a prefetched page.
+PREFETCH_HEADERS = ('User-Agent',)
+
+
+def get_prefetch_key(request, sync_client, collection_name, params, full,
+                     headers):
+    """Return the cache key of the page requested with the Sync `params`,
+    or ``None`` if it cannot be prefetched.
+    """
+    settings = request.registry.settings
+    if int(settings['cache_prefetched_pages_ttl_seconds']) <= 0:
+        return None
+
+    # Preconditions have to be checked by Sync.
+    if set(headers) - set(PREFETCH_HEADERS):
+        return None
+
+    page = '%s %s %s %s' % (sync_client.api_endpoint, collection_name, full,
+                            json.dumps(params, sort_keys=True))
+    hmac_secret = get_cache_hmac_secrets(settings)[0]
+    return 'collection_prefetch_%s' % utils.hmac_digest(hmac_secret, page)
+
+
+def get_prefetched_page(request, sync_client, cache_key):
+    """Return the Sync headers and records prefetched for this page, or
+    ``None``. A prefetch still running in this process is waited for.
+
+    Prefetched pages are only served once.
+    """
+    flights = request.registry.prefetch_flights
+    encrypted = flights.do(cache_key, request.registry.cache.get, cache_key)
+    if not encrypted:
+        statsd_count(request, "collection_prefetch.miss")
+        return None
+
+    statsd_count(request, "collection_prefetch.hit")
+    request.registry.cache.delete(cache_key)
+    hmac_secret = get_cache_hmac_secrets(request.registry.settings)[0]
+    page = decrypt_value(encrypted, sync_client.client_state, hmac_secret)
+    return CachedSyncResponse(page['headers']), page['records']
+
+
+def prefetch_next_page(request, sync_client, collection_name, params, full,
+                       headers, sync_response):
+    """Fetch the page following `sync_response` in the background, as long
+    as this process does not already run ``sync_max_prefetches`` of them.
+    """
+    settings = request.registry.settings
+    if int(settings['cache_prefetched_pages_ttl_seconds']) <= 0:
+        return
+
+    next_offset = sync_response.headers.get('X-Weave-Next-Offset')
+    if next_offset is None:
+        return
+
+    params = dict(params, offset=str(next_offset))
+    cache_key = get_prefetch_key(request, sync_client, collection_name,
+                                 params, full, headers)
+    if cache_key is None:
+        return
+
+    budget = request.registry.prefetch_budget
+    if not budget.acquire(False):
+        statsd_count(request, "collection_prefetch.skipped")
+        return
+
+    started = request.registry.prefetch_flights.start(
+        cache_key, _prefetch_page, request, sync_client.clone(),
+        collection_name, params, full, dict(headers), cache_key, budget)
+    if started:
+        statsd_count(request, "collection_prefetch.started")
+    else:
+        budget.release()
+
+
+def _prefetch_page(request, sync_client, collection_name, params, full,
+                   headers, cache_key, budget):
+    """Store the page encrypted with the user client state. Runs outside of
+    the request cycle, hence errors are only logged.
+
+    :returns: the encrypted page, or ``None``.
+    """
+    settings = request.registry.settings
+    try:
+        records = sync_client.get_records(collection_name, full=full,
+                                          headers=headers, **params)
+        sync_headers = sync_client.raw_resp.headers
+        page = {
+            'headers': dict((name, sync_headers[name])
+                            for name in CACHED_SYNC_HEADERS
+                            if name in sync_headers),
+            'records': records
+        }
+        hmac_secret = get_cache_hmac_secrets(settings)[0]
+        encrypted = encrypt_value(page, sync_client.client_state, hmac_secret)
+        if len(encrypted) > int(settings['cache_collection_pages_max_bytes']):
+            return None
+        ttl = int(settings['cache_prefetched_pages_ttl_seconds'])
+        request.registry.cache.set(cache_key, encrypted, ttl)
+        return encrypted
+    except Exception as e:
+        logger.error(e, exc_info=True)
+    finally:
+        budget.release()
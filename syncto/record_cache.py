@@ -0,0 +1,152 @@
+from pyramid import httpexceptions
+from pyramid.settings import aslist
+
+from cliquet import utils
+from cliquet.statsd import statsd_count
+
+from syncto.authentication import get_cache_hmac_secrets
+from syncto.crypto import encrypt_value, decrypt_value
+from syncto.page_cache import CachedSyncResponse
+
+# Sync headers that can be honoured from a cached record.
+RECORD_CACHE_HEADERS = ('User-Agent', 'X-If-Modified-Since')
+
+
+def _cache_key(request, sync_client, collection_name, record_id,
+               prefix='record'):
+    hmac_secret = get_cache_hmac_secrets(request.registry.settings)[0]
+    record = '%s %s %s' % (sync_client.api_endpoint, collection_name,
+                           record_id)
+    return '%s_%s' % (prefix, utils.hmac_digest(hmac_secret, record))
+
+
+def _is_enabled(request, setting='cache_records_ttl_seconds'):
+    settings = request.registry.settings
+    return int(settings[setting]) > 0
+
+
+def get_cached_record(request, sync_client, collection_name, record_id,
+                      headers):
+    """Return the cached record, along with a stand-in Sync response for
+    :func:`syncto.headers.export_headers`, or ``None``.
+
+    Return a ``304 Not Modified`` response instead if the Sync
+    ``X-If-Modified-Since`` header converted from ``If-None-Match`` is not
+    older than the last timestamp seen for the record. It is not raised,
+    since Pyramid follows raised redirections in batch subrequests.
+
+    Bodies are only cached for the collections of the
+    ``cache_records_bodies_collections`` setting.
+
+    As for collections, changes made by other Sync clients are only seen
+    once the ``cache_records_ttl_seconds`` have elapsed.
+    """
+    if not _is_enabled(request):
+        return None
+
+    # Preconditions have to be checked by Sync.
+    if set(headers) - set(RECORD_CACHE_HEADERS):
+        return None
+
+    cache_key = _cache_key(request, sync_client, collection_name, record_id)
+    encrypted = request.registry.cache.get(cache_key)
+    if not encrypted:
+        statsd_count(request, "records_cache.miss")
+        return None
+
+    hmac_secret = get_cache_hmac_secrets(request.registry.settings)[0]
+    entry = decrypt_value(encrypted, sync_client.client_state, hmac_secret)
+    modified = entry['modified']
+
+    modified_since = headers.get('X-If-Modified-Since')
+    if modified_since is not None and modified <= float(modified_since):
+        statsd_count(request, "records_cache.not_modified")
+        response = httpexceptions.HTTPNotModified()
+        response.headers['ETag'] = '"%s"' % int(modified * 1000)
+        response.headers['Cache-Control'] = 'no-cache'
+        return utils.reapply_cors(request, response)
+
+    if entry['record'] is None:
+        statsd_count(request, "records_cache.miss")
+        return None
+
+    statsd_count(request, "records_cache.hit")
+    sync_headers = {'X-Last-Modified': '%.2f' % modified}
+    return entry['record'], CachedSyncResponse(sync_headers)
+
+
+def cache_record(request, sync_client, collection_name, record_id,
+                 modified, record=None):
+    """Store the `modified` timestamp of the record, as well as the `record`
+    read from Sync for the collections of
+    ``cache_records_bodies_collections``, encrypted with the user client
+    state.
+
+    Sync only updates the fields given on writes, hence written records are
+    not cached, only their timestamp.
+    """
+    if not _is_enabled(request):
+        return
+
+    settings = request.registry.settings
+    entry = {'modified': modified, 'record': None}
+    bodies_collections = aslist(settings['cache_records_bodies_collections'])
+    if collection_name in bodies_collections:
+        entry['record'] = record
+
+    cache_key = _cache_key(request, sync_client, collection_name,
+                           record_id)
+    hmac_secret = get_cache_hmac_secrets(settings)[0]
+    encrypted = encrypt_value(entry, sync_client.client_state, hmac_secret)
+    ttl = int(settings['cache_records_ttl_seconds'])
+    request.registry.cache.set(cache_key, encrypted, ttl)
+
+
+def is_record_missing(request, sync_client, collection_name, record_id,
+                      headers):
+    """Return whether Sync recently answered ``404 Not Found`` for the
+    record, for instance when clients probe for ``meta/global``.
+    """
+    if not _is_enabled(request, 'cache_records_missing_ttl_seconds'):
+        return False
+
+    # Preconditions have to be checked by Sync.
+    if set(headers) - set(RECORD_CACHE_HEADERS):
+        return False
+
+    cache_key = _cache_key(request, sync_client, collection_name, record_id,
+                           prefix='record_missing')
+    if not request.registry.cache.get(cache_key):
+        return False
+
+    statsd_count(request, "records_missing_cache.hit")
+    return True
+
+
+def cache_missing_record(request, sync_client, collection_name, record_id):
+    """Remember that the record does not exist for
+    ``cache_records_missing_ttl_seconds``.
+    """
+    if not _is_enabled(request, 'cache_records_missing_ttl_seconds'):
+        return
+
+    settings = request.registry.settings
+    cache_key = _cache_key(request, sync_client, collection_name, record_id,
+                           prefix='record_missing')
+    ttl = int(settings['cache_records_missing_ttl_seconds'])
+    request.registry.cache.set(cache_key, True, ttl)
+
+
+def invalidate_records(request, sync_client, collection_name, ids):
+    """Forget the cached records after they were modified or deleted."""
+    prefixes = []
+    if _is_enabled(request):
+        prefixes.append('record')
+    if _is_enabled(request, 'cache_records_missing_ttl_seconds'):
+        prefixes.append('record_missing')
+
+    for record_id in ids:
+        for prefix in prefixes:
+            cache_key = _cache_key(request, sync_client, collection_name,
+                                   record_id, prefix=prefix)
+            request.registry.cache.delete(cache_key)
@@ -0,0 +1,47 @@
+import re
+
+
+_MODIFIED_FIELD = re.compile(
+    br'"modified"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)')
+
+_ARRAY_START = re.compile(br'\s*\[')
+
+_SORT_KEYS = {
+    'newest': (lambda r: r['modified'], True),
+    'oldest': (lambda r: r['modified'], False),
+    'index': (lambda r: r.get('sortindex') or 0, True),
+}
+
+
+def sort_records(records, sort=None):
+    """Sort Sync records the way Sync does for the `sort` parameter
+    (``newest`` by default).
+    """
+    key, reverse = _SORT_KEYS[sort or 'newest']
+    return sorted(records, key=key, reverse=reverse)
+
+
+def _rewrite_modified(match):
+    # In valid JSON, a quote that is not preceded by a backslash is never
+    # part of a string content: this is the key itself, and not the inside
+    # of a string such as the encrypted payload.
+    start = match.start()
+    if match.string[start - 1:start] == b'\\':
+        return match.group(0)
+    last_modified = int(float(match.group(1)) * 1000)
+    return b'"last_modified":' + str(last_modified).encode('ascii')
+
+
+def rewrite_records_body(body):
+    """Turn the body of a Sync collection response, a JSON array of flat
+    records, into the ``{"data": [...]}`` body of a Kinto response.
+
+    The ``modified`` seconds timestamp of each record is replaced by a
+    ``last_modified`` milliseconds timestamp with a lexical scan of the
+    body: records are not decoded and the bytes of every other field,
+    notably the encrypted ``payload``, are copied untouched.
+    """
+    if not _ARRAY_START.match(body):
+        raise ValueError('Expecting a JSON array.')
+    rewritten = _MODIFIED_FIELD.sub(_rewrite_modified, body)
+    return b'{"data":' + rewritten + b'}'
@@ -0,0 +1,130 @@
+from cliquet import utils
+from requests.structures import CaseInsensitiveDict
+from cliquet.statsd import statsd_count
+
+from syncto.authentication import get_cache_hmac_secrets
+from syncto.crypto import encrypt_value, decrypt_value
+from syncto.page_cache import CachedSyncResponse
+from syncto.records import sort_records
+
+# Sync parameters and headers that can be honoured from a snapshot. Sync
+# answers filtered requests without reading the whole collection.
+SNAPSHOT_PARAMS = ('sort', 'limit')
+SNAPSHOT_HEADERS = ('User-Agent',)
+
+# Kept instead of snapshots larger than the maximum size.
+SNAPSHOT_TOO_LARGE = 'too-large'
+
+
+def _cache_key(request, sync_client, collection_name):
+    hmac_secret = get_cache_hmac_secrets(request.registry.settings)[0]
+    snapshot = '%s %s' % (sync_client.api_endpoint, collection_name)
+    return 'collection_snapshot_%s' % utils.hmac_digest(hmac_secret, snapshot)
+
+
+def invalidate_snapshot(request, sync_client, collection_name):
+    """Forget the snapshot after records were deleted from the collection.
+    """
+    settings = request.registry.settings
+    if int(settings['cache_collection_snapshots_ttl_seconds']) > 0:
+        cache_key = _cache_key(request, sync_client, collection_name)
+        request.registry.cache.delete(cache_key)
+
+
+def get_snapshot_records(request, sync_client, collection_name, params,
+                         headers):
+    """Return the records of the collection from the snapshot of the
+    collection, sorted according to the Sync `params`, along with a
+    stand-in Sync response for :func:`syncto.headers.export_headers`.
+
+    The snapshot is brought up to date with the records modified since it
+    was taken. Records deleted in the meantime are detected by comparing the
+    number of records with the Sync ``info/collection_counts``, in which
+    case the whole collection is fetched again.
+
+    Return ``None`` if the request cannot be answered entirely from a
+    snapshot: filtered or paginated requests, pages that may not contain
+    the whole collection, collections that Sync paginated and collections
+    too large to be kept are read from Sync directly.
+    """
+    settings = request.registry.settings
+    ttl = int(settings['cache_collection_snapshots_ttl_seconds'])
+    if ttl <= 0:
+        return None
+
+    if set(params) - set(SNAPSHOT_PARAMS):
+        return None
+    if set(headers) - set(SNAPSHOT_HEADERS):
+        return None
+
+    cache = request.registry.cache
+    cache_key = _cache_key(request, sync_client, collection_name)
+    hmac_secret = get_cache_hmac_secrets(settings)[0]
+
+    encrypted = cache.get(cache_key)
+    if encrypted == SNAPSHOT_TOO_LARGE:
+        statsd_count(request, "collection_snapshots.too_large")
+        return None
+
+    snapshot = None
+    if encrypted:
+        snapshot = decrypt_value(encrypted, sync_client.client_state,
+                                 hmac_secret)
+
+    # Without a snapshot, the size of the collection is not known.
+    limit = params.get('limit')
+    if snapshot is None and limit is not None:
+        return None
+
+    records = None
+    if snapshot is not None:
+        count = sync_client.get_collection_counts().get(collection_name, 0)
+        if limit is not None and count > int(limit):
+            return None
+        changes = sync_client.get_records(collection_name, full=True,
+                                          newer='%.2f' % snapshot['timestamp'],
+                                          headers=headers)
+        if _is_paginated(sync_client.raw_resp):
+            return None
+        records = dict((r['id'], r) for r in snapshot['records'])
+        records.update((r['id'], r) for r in changes)
+        if len(records) == count:
+            statsd_count(request, "collection_snapshots.merged")
+        else:
+            statsd_count(request, "collection_snapshots.outdated")
+            records = None
+
+    if records is None:
+        statsd_count(request, "collection_snapshots.full")
+        fetched = sync_client.get_records(collection_name, full=True,
+                                          headers=headers)
+        if _is_paginated(sync_client.raw_resp):
+            # Sync did not give the whole collection.
+            return None
+        records = dict((r['id'], r) for r in fetched)
+
+    sync_headers = CaseInsensitiveDict(sync_client.raw_resp.headers)
+
+    last_modified = sync_headers.get('X-Last-Modified')
+    if last_modified is not None:
+        snapshot = {'timestamp': float(last_modified),
+                    'records': list(records.values())}
+        encrypted = encrypt_value(snapshot, sync_client.client_state,
+                                  hmac_secret)
+        max_bytes = int(settings['cache_collection_snapshots_max_bytes'])
+        if len(encrypted) > max_bytes:
+            # Do not download the whole collection on every read.
+            encrypted = SNAPSHOT_TOO_LARGE
+        cache.set(cache_key, encrypted, ttl)
+
+    if limit is not None and len(records) > int(limit):
+        # Sync pagination tokens cannot be forged.
+        return None
+
+    sync_headers['X-Weave-Records'] = str(len(records))
+    return (CachedSyncResponse(sync_headers),
+            sort_records(records.values(), params.get('sort')))
+
+
+def _is_paginated(sync_response):
+    return 'X-Weave-Next-Offset' in CaseInsensitiveDict(sync_response.headers)
@@ -1,29 +1,49 @@
+import itertools
 import mock
 import json
+import threading
 
+from cliquet import utils
 from cliquet.cache.memory import Cache
 from cliquet.tests.support import DummyRequest
 from nacl.exceptions import CryptoError
 from pyramid.httpexceptions import HTTPUnauthorized
+from requests.exceptions import ConnectionError, HTTPError
 
 from syncto import AUTHORIZATION_HEADER, CLIENT_STATE_HEADER
-from syncto.authentication import build_sync_client, base64url_decode
-from syncto.tests.support import unittest, ENCRYPTED_CREDENTIALS
+from syncto.authentication import (build_sync_client, base64url_decode,
+                                   get_cache_hmac_secrets,
+                                   parse_bid_assertion, _acquire_cache_lock,
+                                   _refresh_credentials, _parsed_assertions)
+from syncto.cache import LRUCache, SingleFlight
+from syncto.client import CircuitBreaker, CircuitOpenError, SessionPool
+from syncto.crypto import encrypt_value, decrypt_value
+from syncto.tests.support import (unittest, BID_ASSERTION,
+                                  ENCRYPTED_CREDENTIALS)
 
 
 class BuildSyncClientTest(unittest.TestCase):
 
     def setUp(self):
         self.request = DummyRequest()
+        self.request.bound_data = {}
         self.request.registry.settings.update({
             'project_docs': 'https://syncto.readthedocs.io/',
             'cache_hmac_secret': 'This is not a secret',
             'cache_credentials_ttl_seconds': 300,
+            'cache_credentials_lock_ttl_seconds': 10,
+            'cache_credentials_refresh_ratio': 0,
+            'cache_credentials_ttl_jitter_ratio': 0,
+            'cache_credentials_error_ttl_seconds': 30,
             'token_server_url': 'https://token.services.mozilla.com/',
             'certificate_ca_bundle': None,
         })
 
         self.request.registry.cache = Cache()
+        self.request.registry.sync_sessions = SessionPool()
+        self.request.registry.credentials_cache = LRUCache()
+        self.request.registry.tokenserver_flights = SingleFlight()
+        self.request.registry.tokenserver_breaker = CircuitBreaker()
 
         self.request.matchdict = {
             'bucket_id': 'syncto',
@@ -112,6 +132,451 @@ class BuildSyncClientTest(unittest.TestCase):
                     verify=None)
                 SyncClient.assert_called_with(verify=None, **self.credentials)
 
+    def test_decrypted_credentials_are_kept_in_process(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            with mock.patch('syncto.authentication.SyncClient') as SyncClient:
+                build_sync_client(self.request)
+                with mock.patch.object(self.request.registry.cache,
+                                       'get') as mocked_get:
+                    with mock.patch('syncto.authentication.decrypt_value') \
+                            as mocked_decrypt:
+                        build_sync_client(self.request)
+                        self.assertFalse(mocked_get.called)
+                        self.assertFalse(mocked_decrypt.called)
+                SyncClient.assert_called_with(verify=None, **self.credentials)
+        credentials_cache = self.request.registry.credentials_cache
+        self.assertEqual(credentials_cache.hits, 1)
+        self.assertEqual(credentials_cache.misses, 1)
+
+    def test_in_process_credentials_are_bound_to_the_client_state(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            build_sync_client(self.request)
+        self.request.headers[CLIENT_STATE_HEADER] = '67890'
+        self.assertRaises(CryptoError, build_sync_client, self.request)
+
+    def test_in_process_credentials_use_the_credentials_ttl(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings['cache_credentials_ttl_seconds'] = 10
+        credentials_cache = self.request.registry.credentials_cache
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            with mock.patch.object(credentials_cache, 'set') as mocked_set:
+                build_sync_client(self.request)
+                args, _ = mocked_set.call_args
+                self.assertEqual(args[-1], 10)
+
+    def test_in_process_credentials_expire_with_the_shared_entry(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set(cache_key, encrypt_value(self.credentials, '12345',
+                                           'This is not a secret'), 5)
+        credentials_cache = self.request.registry.credentials_cache
+        with mock.patch.object(credentials_cache, 'set') as mocked_set:
+            build_sync_client(self.request)
+            args, _ = mocked_set.call_args
+            self.assertLessEqual(args[-1], 5)
+
+    def test_waits_for_credentials_exchanged_by_another_worker(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set('lock_%s' % cache_key, 'other-worker', 10)
+
+        def other_worker_stores_credentials(seconds):
+            cache.set(cache_key, encrypt_value(self.credentials, '12345',
+                                               'This is not a secret'))
+
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            with mock.patch('syncto.authentication.time.sleep',
+                            side_effect=other_worker_stores_credentials):
+                client = build_sync_client(self.request)
+            self.assertFalse(TSClient.called)
+        self.assertEqual(client.api_endpoint, 'http://example.org/')
+
+    def test_exchanges_credentials_if_other_worker_lock_expires(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set('lock_%s' % cache_key, 'other-worker', 10)
+
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            with mock.patch('syncto.authentication.time') as mocked_time:
+                mocked_time.time.side_effect = itertools.count(1000, 6)
+                build_sync_client(self.request)
+            self.assertTrue(TSClient.called)
+        # The other worker lock is left untouched.
+        self.assertEqual(cache.get('lock_%s' % cache_key), 'other-worker')
+
+    def test_cache_lock_is_released_after_the_exchange(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        cache = self.request.registry.cache
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                ValueError
+            self.assertRaises(ValueError, build_sync_client, self.request)
+        self.assertEqual(cache._store, {})
+
+    def test_cache_lock_is_lost_if_another_worker_takes_it_meanwhile(self):
+        cache = self.request.registry.cache
+        with mock.patch.object(cache, 'get',
+                               side_effect=[None, 'other-worker']):
+            self.assertFalse(_acquire_cache_lock(cache, 'lock', 10))
+
+    def test_credentials_ttl_is_shortened_with_jitter(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings[
+            'cache_credentials_ttl_jitter_ratio'] = 0.1
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            with mock.patch('syncto.authentication.random.uniform',
+                            return_value=0.05) as mocked_uniform:
+                with mock.patch.object(self.request.registry.cache, 'set') \
+                        as mocked_set:
+                    build_sync_client(self.request)
+                    args, _ = mocked_set.call_args
+                    self.assertEqual(args[-1], 285)
+                mocked_uniform.assert_called_with(0, 0.1)
+
+    def test_credentials_close_to_expiration_are_refreshed_ahead(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings[
+            'cache_credentials_refresh_ratio'] = 0.5
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set(cache_key, encrypt_value(self.credentials, '12345',
+                                           'This is not a secret'), 100)
+        flights = self.request.registry.tokenserver_flights
+        with mock.patch.object(flights, 'start') as mocked_start:
+            with mock.patch('syncto.authentication.SyncClient') as SyncClient:
+                # From the cache backend.
+                build_sync_client(self.request)
+                SyncClient.assert_called_with(verify=None, **self.credentials)
+                # From the in-process cache.
+                build_sync_client(self.request)
+            self.assertEqual(mocked_start.call_count, 2)
+            args, _ = mocked_start.call_args
+            self.assertEqual(args[-2:], (300, 150))
+
+    def test_refreshed_credentials_ttl_is_shortened_with_jitter(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        settings = self.request.registry.settings
+        settings['cache_credentials_refresh_ratio'] = 0.5
+        settings['cache_credentials_ttl_jitter_ratio'] = 0.1
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set(cache_key, encrypt_value(self.credentials, '12345',
+                                           'This is not a secret'), 100)
+        flights = self.request.registry.tokenserver_flights
+        with mock.patch.object(flights, 'start') as mocked_start:
+            with mock.patch('syncto.authentication.random.uniform',
+                            return_value=0.05) as mocked_uniform:
+                build_sync_client(self.request)
+                mocked_uniform.assert_called_with(0, 0.1)
+            args, _ = mocked_start.call_args
+            self.assertEqual(args[-2:], (285, 150))
+
+    def test_credentials_far_from_expiration_are_not_refreshed(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings[
+            'cache_credentials_refresh_ratio'] = 0.5
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set(cache_key, encrypt_value(self.credentials, '12345',
+                                           'This is not a secret'), 200)
+        flights = self.request.registry.tokenserver_flights
+        with mock.patch.object(flights, 'start') as mocked_start:
+            build_sync_client(self.request)
+            self.assertFalse(mocked_start.called)
+
+    def test_credentials_are_not_refreshed_if_assertion_expires_soon(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings[
+            'cache_credentials_refresh_ratio'] = 0.5
+        flights = self.request.registry.tokenserver_flights
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            with mock.patch('syncto.authentication.'
+                            '_extract_bid_assertion_ttl', return_value=100):
+                with mock.patch.object(flights, 'start') as mocked_start:
+                    build_sync_client(self.request)
+                    build_sync_client(self.request)
+                    self.assertFalse(mocked_start.called)
+
+    def test_exchanges_do_not_join_pending_refreshes(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings[
+            'cache_credentials_refresh_ratio'] = 0.5
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set(cache_key, encrypt_value(self.credentials, '12345',
+                                           'This is not a secret'), 100)
+        refreshing = threading.Event()
+        release = threading.Event()
+
+        def get_hawk_credentials(**kwargs):
+            refreshing.set()
+            release.wait(5)
+            return self.credentials
+
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                get_hawk_credentials
+            with mock.patch('syncto.authentication.SyncClient') as SyncClient:
+                build_sync_client(self.request)
+                self.assertTrue(refreshing.wait(5))
+                # Both caches miss while the refresh is pending.
+                cache.delete(cache_key)
+                self.request.registry.credentials_cache.flush()
+                threading.Timer(0.1, release.set).start()
+                build_sync_client(self.request)
+                SyncClient.assert_called_with(verify=None, **self.credentials)
+        credentials, _ = self.request.registry.credentials_cache.get(
+            (cache_key, '12345'))
+        self.assertEqual(credentials, self.credentials)
+
+    def test_refresh_stores_renewed_credentials(self):
+        cache_key = 'credentials_abc'
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            _refresh_credentials(self.request, '1234', '12345', cache_key,
+                                 300, 150)
+        self.assertIsNotNone(self.request.registry.cache.get(cache_key))
+        credentials_cache = self.request.registry.credentials_cache
+        credentials, _ = credentials_cache.get((cache_key, '12345'))
+        self.assertEqual(credentials, self.credentials)
+
+    def test_refresh_is_skipped_if_another_worker_is_exchanging(self):
+        cache_key = 'credentials_abc'
+        self.request.registry.cache.set('lock_%s' % cache_key, 'other', 10)
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            _refresh_credentials(self.request, '1234', '12345', cache_key,
+                                 300, 150)
+            self.assertFalse(TSClient.called)
+        credentials_cache = self.request.registry.credentials_cache
+        self.assertIsNone(credentials_cache.get((cache_key, '12345')))
+
+    def test_refresh_reuses_credentials_renewed_by_another_worker(self):
+        cache_key = 'credentials_abc'
+        self.request.registry.cache.set(
+            cache_key, encrypt_value(self.credentials, '12345',
+                                     'This is not a secret'), 290)
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            _refresh_credentials(self.request, '1234', '12345', cache_key,
+                                 300, 150)
+            self.assertFalse(TSClient.called)
+        credentials_cache = self.request.registry.credentials_cache
+        credentials, _ = credentials_cache.get((cache_key, '12345'))
+        self.assertEqual(credentials, self.credentials)
+
+    def test_refresh_errors_are_logged(self):
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                ValueError
+            with mock.patch('syncto.authentication.logger') as mocked_logger:
+                _refresh_credentials(self.request, '1234', '12345',
+                                     'credentials_abc', 300, 150)
+                self.assertTrue(mocked_logger.error.called)
+
+    def test_cache_hmac_secrets_can_be_given_one_per_line(self):
+        settings = {'cache_hmac_secret': 'new secret\n  old secret\n'}
+        self.assertEqual(get_cache_hmac_secrets(settings),
+                         ['new secret', 'old secret'])
+        settings = {'cache_hmac_secret': ['new secret', 'old secret']}
+        self.assertEqual(get_cache_hmac_secrets(settings),
+                         ['new secret', 'old secret'])
+
+    def test_credentials_of_previous_secret_are_migrated_on_read(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings['cache_hmac_secret'] = [
+            'New secret', 'This is not a secret']
+        cache = self.request.registry.cache
+        previous_key = ('credentials_636130e072155efd00d8e27196500'
+                        'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        cache.set(previous_key, encrypt_value(self.credentials, '12345',
+                                              'This is not a secret'), 100)
+
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            with mock.patch('syncto.authentication.SyncClient') as SyncClient:
+                build_sync_client(self.request)
+                SyncClient.assert_called_with(verify=None, **self.credentials)
+            self.assertFalse(TSClient.called)
+
+        current_key = 'credentials_%s' % utils.hmac_digest('New secret',
+                                                           '1234')
+        self.assertIsNone(cache.get(previous_key))
+        self.assertEqual(decrypt_value(cache.get(current_key), '12345',
+                                       'New secret'), self.credentials)
+        self.assertLessEqual(cache.ttl(current_key), 100)
+
+    def test_credentials_are_stored_with_the_newest_secret(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings['cache_hmac_secret'] = [
+            'New secret', 'This is not a secret']
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            build_sync_client(self.request)
+
+        cache = self.request.registry.cache
+        current_key = 'credentials_%s' % utils.hmac_digest('New secret',
+                                                           '1234')
+        self.assertEqual(decrypt_value(cache.get(current_key), '12345',
+                                       'New secret'), self.credentials)
+
+    def test_refused_assertions_are_not_sent_again_to_tokenserver(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        response = mock.MagicMock(status_code=401, reason='Unauthorized',
+                                  text='{"status": "invalid-credentials"}')
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                HTTPError(response=response)
+            self.assertRaises(HTTPError, build_sync_client, self.request)
+            with self.assertRaises(HTTPError) as cm:
+                build_sync_client(self.request)
+            self.assertEqual(TSClient.call_count, 1)
+
+        error_response = cm.exception.response
+        self.assertEqual(error_response.status_code, 401)
+        self.assertEqual(error_response.reason, 'Unauthorized')
+        self.assertEqual(error_response.text,
+                         '{"status": "invalid-credentials"}')
+
+    def test_refused_assertions_are_not_cached_if_disabled(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.settings[
+            'cache_credentials_error_ttl_seconds'] = 0
+        response = mock.MagicMock(status_code=401, reason='Unauthorized',
+                                  text='{"status": "invalid-credentials"}')
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                HTTPError(response=response)
+            self.assertRaises(HTTPError, build_sync_client, self.request)
+            self.assertRaises(HTTPError, build_sync_client, self.request)
+            self.assertEqual(TSClient.call_count, 2)
+        self.assertEqual(self.request.registry.cache._store, {})
+
+    def test_refused_assertions_are_bound_to_the_client_state(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        response = mock.MagicMock(status_code=401, reason='Unauthorized',
+                                  text='{"status": "invalid-client-state"}')
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = [
+                HTTPError(response=response), self.credentials]
+            self.assertRaises(HTTPError, build_sync_client, self.request)
+            self.request.headers[CLIENT_STATE_HEADER] = '67890'
+            build_sync_client(self.request)
+
+    def test_waiters_do_not_retry_assertions_refused_to_another_worker(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        lock_key = 'lock_%s' % cache_key
+        cache.set(lock_key, 'other-worker', 10)
+        error_key = 'credentials_error_%s' % utils.hmac_digest(
+            'This is not a secret', '12345 1234')
+
+        def other_worker_is_refused(seconds):
+            cache.set(error_key, {'status': 401, 'reason': 'Unauthorized',
+                                  'text': '{"status": "invalid"}'}, 30)
+            cache.delete(lock_key)
+
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            with mock.patch('syncto.authentication.time.sleep',
+                            side_effect=other_worker_is_refused):
+                with self.assertRaises(HTTPError) as cm:
+                    build_sync_client(self.request)
+            self.assertFalse(TSClient.called)
+        self.assertEqual(cm.exception.response.status_code, 401)
+
+    def test_waiters_take_the_lock_if_the_other_exchange_fails(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        cache = self.request.registry.cache
+        cache_key = ('credentials_636130e072155efd00d8e27196500'
+                     'd29110fb2e8e93bcedb2a30e0aa0e5ccf61')
+        lock_key = 'lock_%s' % cache_key
+        cache.set(lock_key, 'other-worker', 10)
+        locks = []
+
+        def get_hawk_credentials(duration):
+            locks.append(cache.get(lock_key))
+            return self.credentials
+
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                get_hawk_credentials
+            with mock.patch('syncto.authentication.time.sleep',
+                            side_effect=lambda s: cache.delete(lock_key)):
+                build_sync_client(self.request)
+        self.assertNotIn(locks[0], (None, 'other-worker'))
+        self.assertIsNone(cache.get(lock_key))
+
+    def test_tokenserver_server_errors_are_not_cached(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        response = mock.MagicMock(status_code=503)
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                HTTPError(response=response)
+            self.assertRaises(HTTPError, build_sync_client, self.request)
+            self.assertRaises(HTTPError, build_sync_client, self.request)
+            self.assertEqual(TSClient.call_count, 2)
+
+    def test_tokenserver_is_not_called_while_circuit_is_open(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        self.request.registry.tokenserver_breaker = CircuitBreaker(
+            max_failures=1)
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.side_effect = \
+                ConnectionError
+            self.assertRaises(ConnectionError, build_sync_client,
+                              self.request)
+            self.assertRaises(CircuitOpenError, build_sync_client,
+                              self.request)
+            self.assertEqual(
+                TSClient.return_value.get_hawk_credentials.call_count, 1)
+
     def test_credentials_should_be_cached_encrypted(self):
         self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
                                 CLIENT_STATE_HEADER: '12345'}
@@ -119,7 +584,7 @@ class BuildSyncClientTest(unittest.TestCase):
         with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
             TSClient.return_value.get_hawk_credentials.return_value = \
                 self.credentials
-            with mock.patch('syncto.authentication.encrypt',
+            with mock.patch('syncto.authentication.encrypt_value',
                             return_value='encrypted'):
                 with mock.patch.object(self.request.registry.cache, 'set') \
                         as mocked_set:
@@ -136,7 +601,7 @@ class BuildSyncClientTest(unittest.TestCase):
                 self.request.registry.cache, 'get',
                 return_value=ENCRYPTED_CREDENTIALS):
             with mock.patch('requests.request'):
-                with mock.patch('syncto.authentication.decrypt',
+                with mock.patch('syncto.crypto.decrypt',
                                 return_value=json.dumps(self.credentials)) \
                         as mocked_decrypt:
                     build_sync_client(self.request)
@@ -186,7 +651,7 @@ class BuildSyncClientTest(unittest.TestCase):
         with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
             TSClient.return_value.get_hawk_credentials.return_value = \
                 self.credentials
-            with mock.patch('syncto.authentication.encrypt',
+            with mock.patch('syncto.authentication.encrypt_value',
                             return_value='encrypted'):
                 with mock.patch.object(self.request.registry.cache, 'set') \
                         as mocked_set:
@@ -196,37 +661,7 @@ class BuildSyncClientTest(unittest.TestCase):
                     self.assertEqual(int(ttl), 300)
 
     def test_uses_ttl_from_assertion_if_smaller_than_settings(self):
-        assertion = """
-        eyJhbGciOiJSUzI1NiJ9.eyJwdWJsaWMta2V5Ijp7ImFsZ29yaXRobSI6IkRTIiwiZyI6I
-        jY3ZTU4NjQ2MGYzMzMyNjliNzlhZmJjZDA4MmYzNjk5NGMxNGNjZGMwYWQ5NWNhMmNmMWQ
-        4MTZjMjVkZTQ5MmRiMTI2ZDkwOTc2ZmNmMWY3YWIxMmE4MTRkMTEwYzEzZWI0YmY1MjliM
-        2M3ZmE3MDViYWVkZTcyZmI5ZTY5YmYzNzMzOTkwMjYzZDMwM2I4M2YyMGM4Nzg0OGI3YTg
-        zMTg3ZWQzNjYwZTY0MThlOGY4YzAwNTE2ZWY5MGJlZmY0ODAyM2E1ZDc0NzllMjA1MGRiM
-        2FlNjBhYWZkOWRkNGEyODk1NmNiNWVlNzRmMDA0NDc2MWQ4MTc1YmQ0NTYzOSIsInEiOiJ
-        lMDc1YTgxMzEwNzAxZGFmNGE3M2E0MTRhYWJmNmNmZTRjZmI2M2UzIiwicCI6IjljYjFkZ
-        jA4N2RjMjQ5YzEyZmRhOWFkYmY2YTE4MGQ0MDZmZTUwOGJjNjI3NzEyMGRkZDdmYzRhYjU
-        xMThmYWY0ZjhmM2MyNTVmYWYwY2UyNGIzMjU5NWEwZmNkNjc1MTc0NmZiZDdmMzNjZWVlM
-        TFhOWM2NTBjN2JkMDE3NTk1ZjBiOWMxOGY3NTEyMjg5MTI4YzQ1NjQzYTA3MjAxNGM1MGN
-        jNWIxMDM4MDhkNmVmNTcwMWFiY2Q1ODAzMDgxYjIxNTIwNGI5OTIzNzNkYWIxZDVhMjdmM
-        2NiMDFjNmY4NThkZDhkNzc3ZWZjZTgwNmRhYmI2YjgyNWMxYjU3ZTciLCJ5IjoiOTYyZWQ
-        1ODE5NDcyMmNiMDQxNmE1M2E3OWQ2ZWEzOGIxYmQ2MmIxYzk2NWEwNGJmM2MzY2Q2MDQ3Y
-        jVmZjBkMGFmZWEyYmE5ZjU0YjFkODE5M2UxN2FhZjVlYWE3NzUwMDBiMDVjZTQ2YmNmZTY
-        wMzcyMTJkODI5YWFjYWRjNzFhMTA1MTMwNDk5ZGM2OWIzMzEwZTJkYzIxODAyYTQzNWFiY
-        jU0M2IwOTFmY2U1NTVmYWRiNGQyZGNiZjVjN2MxNmQ5OTU0N2QwNWMwZDAwZDhkMGJmOTJ
-        lMDE2M2UxNTRiYzQ0MmZhNTRjOGYwN2MxMjU4MzRlZDJhZDIyNmFiYiJ9LCJwcmluY2lwY
-        WwiOnsiZW1haWwiOiI0NjY1NWQxMDQyNTU0OTYzOWFhZTI5N2M2ZmM2ZDYzMkBhcGkuYWN
-        jb3VudHMuZmlyZWZveC5jb20ifSwiaWF0IjoxNDQ0MTIyNTczNTgwLCJleHAiOjE0NDQxM
-        jQzODM1ODAsImZ4YS1nZW5lcmF0aW9uIjoxNDQ0MTIyNTA4ODM2LCJmeGEtbGFzdEF1dGh
-        BdCI6MTQ0NDEyMjU4MiwiZnhhLXZlcmlmaWVkRW1haWwiOiJzeW5jdG9AcmVzdG1haWwub
-        mV0IiwiaXNzIjoiYXBpLmFjY291bnRzLmZpcmVmb3guY29tIn0.39sRjyvQyEXgoWDHTzi
-        J7LDfp8HqMyLIVXlCri0-SOSJq2QzKEdG0R3MKEdYMhH20dLKRqTqOmt1UiG1vw3XTUhHe
-        5BOmjpQxMBRLoHSXWSIrfk0OCAPVdHIRVDOarNkaD7AYJ0ADdYMpx-EHov7N3tKVGOfURn
-        _BwuM55dw7j6xeK_Qpy9iYRK59ApIlEFlxyWH4fAPvs45tThnJVwXjuBP1Bezt7O6SbLzv
-        4lgZdDRdBrEnMA6YyLrJsV1_balKy9AQkT8Ye7lsHp9ysgdf6FiSvsvWOM_ZQaRy6V8lTq
-        Ue9yTXyd5Ex5aJO62neLo-TZZ4beHNHd-XqBhkkb2bQ~eyJhbGciOiAiRFMxMjgifQ.eyJ
-        hdWQiOiAiaHR0cHM6Ly90b2tlbi5zZXJ2aWNlcy5tb3ppbGxhLmNvbS8iLCAiZXhwIjogM
-        TQ0NDEyNjE4MzAwMH0.i_0cKFEKNvRiGETGp8xNXH_JDEGsdhqguKGlcdCWeHr_EyUlUsh
-        vnw""".replace(" ", "").replace("\n", "").strip()
+        assertion = BID_ASSERTION
         self.request.registry.settings.update({
             'syncto.cache_credentials_ttl_seconds': 3600})
 
@@ -236,7 +671,7 @@ class BuildSyncClientTest(unittest.TestCase):
         with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
             TSClient.return_value.get_hawk_credentials.return_value = \
                 self.credentials
-            with mock.patch('syncto.authentication.encrypt',
+            with mock.patch('syncto.authentication.encrypt_value',
                             return_value='encrypted'):
                 with mock.patch.object(self.request.registry.cache, 'set') \
                         as mocked_set:
@@ -245,6 +680,44 @@ class BuildSyncClientTest(unittest.TestCase):
                     ttl = args[-1]
                     self.assertNotEqual(int(ttl), 3600)
 
+    def test_sync_clients_share_the_storage_node_session(self):
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            first = build_sync_client(self.request)
+            second = build_sync_client(self.request)
+        self.assertIsNotNone(first.session)
+        self.assertIs(first.session, second.session)
+
+    def test_batch_subrequests_share_sync_clients(self):
+        self.request.bound_data = {'sync_clients': {}}
+        self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
+                                CLIENT_STATE_HEADER: '12345'}
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            first = build_sync_client(self.request)
+            with mock.patch('syncto.authentication.SyncClient') as SyncClient:
+                second = build_sync_client(self.request)
+                self.assertFalse(SyncClient.called)
+        self.assertIsNot(first, second)
+        self.assertIs(first.auth, second.auth)
+        self.assertIs(first.session, second.session)
+
+    def test_shared_sync_clients_are_bound_to_credentials(self):
+        self.request.bound_data = {'sync_clients': {}}
+        with mock.patch('syncto.authentication.TokenserverClient') as TSClient:
+            TSClient.return_value.get_hawk_credentials.return_value = \
+                self.credentials
+            for assertion in ('1234', '5678'):
+                self.request.headers = {
+                    AUTHORIZATION_HEADER: 'Browserid %s' % assertion,
+                    CLIENT_STATE_HEADER: '12345'}
+                build_sync_client(self.request)
+        self.assertEqual(len(self.request.bound_data['sync_clients']), 2)
+
     def test_should_handle_the_certificate_ca_parameters(self):
         digicert_ca_bundle = '../certificates/DigiCert.Global-Root-CA.crt'
         self.request.registry.settings.update({
@@ -262,3 +735,50 @@ class BuildSyncClientTest(unittest.TestCase):
                     verify=digicert_ca_bundle)
                 SyncClient.assert_called_once_with(verify=digicert_ca_bundle,
                                                    **self.credentials)
+
+
+class ParseBIDAssertionTest(unittest.TestCase):
+
+    def setUp(self):
+        _parsed_assertions.flush()
+
+    def test_returns_smallest_expiration_audience_and_issuer(self):
+        parsed = parse_bid_assertion(BID_ASSERTION)
+        self.assertEqual(parsed, {
+            'exp': 1444124383580,
+            'aud': 'https://token.services.mozilla.com/',
+            'iss': 'api.accounts.firefox.com'
+        })
+
+    def test_signatures_are_not_decoded(self):
+        with mock.patch('syncto.authentication.base64url_decode',
+                        wraps=base64url_decode) as mocked:
+            parse_bid_assertion(BID_ASSERTION)
+        self.assertEqual(mocked.call_count, 2)
+
+    def test_large_payloads_are_skipped(self):
+        certificate = BID_ASSERTION.split('~')[0]
+        header, payload, signature = certificate.split('.')
+        assertion = BID_ASSERTION.replace(
+            certificate, '.'.join([header, payload * 5, signature]))
+        parsed = parse_bid_assertion(assertion)
+        self.assertEqual(parsed['exp'], 1444126183000)
+        self.assertIsNone(parsed['iss'])
+
+    def test_invalid_payloads_are_ignored(self):
+        parsed = parse_bid_assertion(u'a.A.b~a.WzFd.b~a.b')
+        self.assertEqual(parsed, {'exp': None, 'aud': None, 'iss': None})
+
+    def test_parsed_assertions_are_memoized(self):
+        first = parse_bid_assertion(BID_ASSERTION)
+        with mock.patch('syncto.authentication.base64url_decode') as mocked:
+            second = parse_bid_assertion(BID_ASSERTION)
+            self.assertFalse(mocked.called)
+        self.assertIs(first, second)
+
+    def test_memoization_can_be_bypassed(self):
+        parse_bid_assertion(BID_ASSERTION)
+        with mock.patch('syncto.authentication.base64url_decode',
+                        wraps=base64url_decode) as mocked:
+            parse_bid_assertion(BID_ASSERTION, use_cache=False)
+            self.assertTrue(mocked.called)
@@ -0,0 +1,124 @@
+import mock
+import threading
+
+from syncto.cache import LRUCache, SingleFlight, _Call
+from syncto.tests.support import unittest
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(max_size=2, max_ttl=60)
+
+    def test_returns_none_for_unknown_keys(self):
+        self.assertIsNone(self.cache.get('unknown'))
+
+    def test_returns_stored_values(self):
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_counts_hits_and_misses(self):
+        self.cache.set('key', 'value')
+        self.cache.get('key')
+        self.cache.get('key')
+        self.cache.get('unknown')
+        self.assertEqual(self.cache.hits, 2)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_evicts_least_recently_used_entries(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_entries_expire_after_their_ttl(self):
+        with mock.patch('syncto.cache.time.time', return_value=1000):
+            self.cache.set('key', 'value', 10)
+        with mock.patch('syncto.cache.time.time', return_value=1011):
+            self.assertIsNone(self.cache.get('key'))
+
+    def test_ttl_is_capped_by_max_ttl(self):
+        with mock.patch('syncto.cache.time.time', return_value=1000):
+            self.cache.set('key', 'value', 3600)
+        with mock.patch('syncto.cache.time.time', return_value=1061):
+            self.assertIsNone(self.cache.get('key'))
+
+    def test_nothing_is_stored_if_max_size_is_zero(self):
+        cache = LRUCache(max_size=0)
+        cache.set('key', 'value')
+        self.assertIsNone(cache.get('key'))
+
+    def test_delete_and_flush_remove_entries(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.flush()
+        self.assertEqual(len(self.cache), 0)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.func = mock.MagicMock(return_value='value')
+
+    def test_call_result_is_returned(self):
+        self.assertEqual(self.flights.do('key', self.func, 1, a=2), 'value')
+        self.func.assert_called_with(1, a=2)
+
+    def test_sequential_calls_are_run_again(self):
+        self.flights.do('key', self.func)
+        self.flights.do('key', self.func)
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_leader_errors_are_raised(self):
+        self.func.side_effect = ValueError
+        self.assertRaises(ValueError, self.flights.do, 'key', self.func)
+        self.assertEqual(self.flights._calls, {})
+
+    def test_pending_calls_are_awaited_instead_of_run(self):
+        call = _Call()
+        self.flights._calls['key'] = call
+
+        def leader():
+            call.result = 'leader value'
+            call.done.set()
+
+        threading.Timer(0.01, leader).start()
+        self.assertEqual(self.flights.do('key', self.func), 'leader value')
+        self.assertFalse(self.func.called)
+
+    def test_pending_calls_errors_are_raised_to_followers(self):
+        call = _Call()
+        call.error = ValueError()
+        call.done.set()
+        self.flights._calls['key'] = call
+        self.assertRaises(ValueError, self.flights.do, 'key', self.func)
+        self.assertFalse(self.func.called)
+
+    def test_start_runs_the_call_in_background(self):
+        self.assertTrue(self.flights.start('key', self.func, 1))
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(5)
+        self.func.assert_called_with(1)
+        self.assertEqual(self.flights._calls, {})
+
+    def test_start_does_nothing_if_a_call_is_pending(self):
+        self.flights._calls['key'] = _Call()
+        self.assertFalse(self.flights.start('key', self.func))
+        self.assertFalse(self.func.called)
+
+    def test_start_keeps_background_errors(self):
+        self.func.side_effect = ValueError
+        with mock.patch('syncto.cache.threading.Thread') as mocked_thread:
+            self.flights.start('key', self.func)
+            call = self.flights._calls['key']
+            run = mocked_thread.call_args[1]['target']
+            run()
+        self.assertIsInstance(call.error, ValueError)
+        self.assertTrue(call.done.is_set())
@@ -0,0 +1,361 @@
+import email
+import json
+import mock
+import requests
+
+from requests.cookies import extract_cookies_to_jar
+from requests.exceptions import HTTPError, ConnectionError
+
+from syncto.client import (SessionPool, SyncClient, CircuitBreaker,
+                           CircuitOpenError, iter_json_array,
+                           run_concurrently)
+from syncto.tests.support import unittest
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool(pool_size=2, idle_timeout=60, max_age=300)
+
+    def test_session_is_reused_for_the_same_storage_node(self):
+        first = self.pool.get('https://sync-1.example.org/1.5/123')
+        second = self.pool.get('https://sync-1.example.org/1.5/456')
+        self.assertIs(first, second)
+
+    def test_sessions_are_different_per_storage_node(self):
+        first = self.pool.get('https://sync-1.example.org/1.5/123')
+        second = self.pool.get('https://sync-2.example.org/1.5/123')
+        self.assertIsNot(first, second)
+
+    def test_adapter_is_configured_with_pool_size(self):
+        session = self.pool.get('https://sync-1.example.org/1.5/123')
+        adapter = session.get_adapter('https://sync-1.example.org/')
+        self.assertEqual(adapter._pool_maxsize, 2)
+
+    def test_cookies_are_not_kept_between_requests(self):
+        session = self.pool.get('https://sync-1.example.org/1.5/123')
+        request = requests.Request('GET', 'https://sync-1.example.org/1.5/123')
+        response = mock.MagicMock()
+        response._original_response.msg = email.message_from_string(
+            'Set-Cookie: lb=node-1; Domain=sync-1.example.org; Path=/\n\n')
+        extract_cookies_to_jar(session.cookies, request.prepare(), response)
+        self.assertEqual(len(session.cookies), 0)
+
+    def test_idle_sessions_are_replaced(self):
+        with mock.patch('syncto.client.time.time', return_value=1000):
+            first = self.pool.get('https://sync-1.example.org/1.5/123')
+        with mock.patch('syncto.client.time.time', return_value=1061):
+            second = self.pool.get('https://sync-1.example.org/1.5/123')
+        self.assertIsNot(first, second)
+
+    def test_old_sessions_are_replaced_even_if_used(self):
+        for now in range(1000, 1300, 30):
+            with mock.patch('syncto.client.time.time', return_value=now):
+                first = self.pool.get('https://sync-1.example.org/1.5/123')
+        with mock.patch('syncto.client.time.time', return_value=1301):
+            second = self.pool.get('https://sync-1.example.org/1.5/123')
+        self.assertIsNot(first, second)
+
+    def test_replaced_sessions_are_not_closed_while_in_use(self):
+        with mock.patch('syncto.client.time.time', return_value=1000):
+            first = self.pool.get('https://sync-1.example.org/1.5/123')
+        with mock.patch.object(first, 'close') as mocked_close:
+            with mock.patch('syncto.client.time.time', return_value=1301):
+                self.pool.get('https://sync-1.example.org/1.5/123')
+            self.assertFalse(mocked_close.called)
+
+    def test_close_closes_every_session(self):
+        session = self.pool.get('https://sync-1.example.org/1.5/123')
+        with mock.patch.object(session, 'close') as mocked_close:
+            self.pool.close()
+            mocked_close.assert_called_with()
+        other = self.pool.get('https://sync-1.example.org/1.5/123')
+        self.assertIsNot(session, other)
+
+
+class SyncClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = SyncClient(api_endpoint='https://example.org/1.5/123',
+                                 uid='123', hashalg='sha256', id='id',
+                                 key='key')
+
+    def test_requests_go_through_the_session_if_assigned(self):
+        self.client.session = mock.MagicMock()
+        self.client.session.request.return_value.status_code = 200
+        self.client.info_collections()
+        self.client.session.request.assert_called_with(
+            'get', 'https://example.org/1.5/123/info/collections',
+            auth=self.client.auth, verify=None)
+
+    def test_requests_use_requests_module_without_session(self):
+        with mock.patch('syncto.client.requests.request') as mocked:
+            mocked.return_value.status_code = 200
+            self.client.info_collections()
+            self.assertTrue(mocked.called)
+
+    def test_records_are_posted_to_the_collection(self):
+        self.client.session = mock.MagicMock()
+        self.client.session.request.return_value.status_code = 200
+        headers = {'User-Agent': 'Syncto'}
+        records = [{'id': 'abc', 'payload': 'x'}]
+        self.client.post_records('Tabs', records, headers=headers)
+        self.client.session.request.assert_called_with(
+            'post', 'https://example.org/1.5/123/storage/tabs',
+            auth=self.client.auth, verify=None, data=json.dumps(records),
+            headers={'User-Agent': 'Syncto',
+                     'Content-Type': 'application/json; charset=utf-8'})
+        self.assertEqual(headers, {'User-Agent': 'Syncto'})
+
+    def test_records_are_deleted_by_ids(self):
+        self.client.session = mock.MagicMock()
+        self.client.session.request.return_value.status_code = 200
+        self.client.delete_records('Tabs', ['abc', 'def'])
+        self.client.session.request.assert_called_with(
+            'delete', 'https://example.org/1.5/123/storage/tabs',
+            auth=self.client.auth, verify=None, params={'ids': 'abc,def'})
+
+    def test_304_responses_are_raised(self):
+        self.client.session = mock.MagicMock()
+        self.client.session.request.return_value.status_code = 304
+        self.assertRaises(HTTPError, self.client.info_collections)
+
+    def test_stream_records_requests_a_streamed_response(self):
+        self.client.session = mock.MagicMock()
+        response = self.client.session.request.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'[{"id": "a"}', b']']
+        records = self.client.stream_records('history', limit=2)
+        self.client.session.request.assert_called_with(
+            'get', 'https://example.org/1.5/123/storage/history',
+            auth=self.client.auth, verify=None, stream=True,
+            params={'full': True, 'limit': 2})
+        self.assertFalse(response.json.called)
+        self.assertEqual(list(records), [{'id': 'a'}])
+        response.close.assert_called_with()
+
+    def test_get_raw_records_returns_the_undecoded_body(self):
+        self.client.session = mock.MagicMock()
+        response = self.client.session.request.return_value
+        response.status_code = 200
+        response.content = b'[]'
+        self.assertEqual(self.client.get_raw_records('history'), b'[]')
+        self.assertFalse(response.json.called)
+
+    def test_clone_shares_credentials_and_session(self):
+        self.client.session = mock.MagicMock()
+        self.client.raw_resp = mock.sentinel.response
+        clone = self.client.clone()
+        self.assertIs(clone.auth, self.client.auth)
+        self.assertIs(clone.session, self.client.session)
+        self.assertEqual(clone.api_endpoint, self.client.api_endpoint)
+        self.assertFalse(hasattr(clone, 'raw_resp'))
+
+
+class GetRecordsByIdsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = SyncClient(api_endpoint='https://example.org/1.5/123',
+                                 uid='123', hashalg='sha256', id='id',
+                                 key='key')
+        self.client.session = mock.MagicMock()
+        self.client.session.request.side_effect = self.sync_request
+
+    def sync_request(self, method, url, params, **kwargs):
+        ids = params['ids'].split(',')
+        response = mock.MagicMock(status_code=200)
+        if params.get('full'):
+            response.json.return_value = [{'id': i, 'modified': float(i)}
+                                          for i in ids]
+        else:
+            response.json.return_value = ids
+        response.headers = {'X-Last-Modified': '%s.00' % max(map(int, ids)),
+                            'X-Weave-Records': str(len(ids)),
+                            'X-Weave-Next-Offset': 'abc'}
+        return response
+
+    def test_ids_are_fetched_by_chunks(self):
+        ids = [str(i) for i in range(250)]
+        self.client.get_records_by_ids('history', ids, chunk_size=100)
+        self.assertEqual(self.client.session.request.call_count, 3)
+        requested = sorted(len(c[1]['params']['ids'].split(','))
+                           for c in self.client.session.request.call_args_list)
+        self.assertEqual(requested, [50, 100, 100])
+
+    def test_records_are_merged_in_sort_order(self):
+        ids = [str(i) for i in range(10)]
+        records = self.client.get_records_by_ids('history', ids,
+                                                 chunk_size=3, sort='oldest')
+        self.assertEqual([r['id'] for r in records], ids)
+        records = self.client.get_records_by_ids('history', ids,
+                                                 chunk_size=3)
+        self.assertEqual([r['id'] for r in records], ids[::-1])
+
+    def test_ids_listing_keeps_chunks_order(self):
+        ids = [str(i) for i in range(10)]
+        records = self.client.get_records_by_ids('history', ids,
+                                                 chunk_size=3, full=False)
+        self.assertEqual(records, ids)
+
+    def test_response_headers_describe_the_merged_records(self):
+        ids = [str(i) for i in range(10)]
+        self.client.get_records_by_ids('history', ids, chunk_size=3)
+        headers = self.client.raw_resp.headers
+        self.assertEqual(headers['X-Weave-Records'], '10')
+        self.assertEqual(headers['X-Last-Modified'], '9.00')
+        self.assertNotIn('X-Weave-Next-Offset', headers)
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+
+    def test_results_are_returned_in_order(self):
+        calls = [(lambda x: x * 2, i) for i in range(10)]
+        self.assertEqual(run_concurrently(calls, max_workers=3),
+                         [i * 2 for i in range(10)])
+
+    def test_calls_run_in_current_thread_with_one_worker(self):
+        with mock.patch('syncto.client.threading.Thread') as mocked:
+            run_concurrently([(len, 'a'), (len, 'bc')], max_workers=1)
+            self.assertFalse(mocked.called)
+
+    def test_first_error_is_raised_once_every_call_completed(self):
+        done = []
+
+        def call(i):
+            if i in (1, 2):
+                raise ValueError(i)
+            done.append(i)
+
+        with self.assertRaises(ValueError) as cm:
+            run_concurrently([(call, i) for i in range(5)], max_workers=2)
+        self.assertEqual(cm.exception.args, (1,))
+        self.assertEqual(sorted(done), [0, 3, 4])
+
+
+class IterJSONArrayTest(unittest.TestCase):
+
+    def test_items_are_yielded_one_at_a_time(self):
+        items = iter_json_array(iter([b'[{"id": "a"}, {"id": "b"}]']))
+        self.assertEqual(next(items), {'id': 'a'})
+        self.assertEqual(next(items), {'id': 'b'})
+        self.assertRaises(StopIteration, next, items)
+
+    def test_items_can_span_several_chunks(self):
+        body = b' [ {"id": "a", "payload": "{\\"x\\": [1]}"} ,\n{"id": "b"}]'
+        chunks = [body[i:i + 3] for i in range(0, len(body), 3)]
+        self.assertEqual(list(iter_json_array(chunks)), [
+            {'id': 'a', 'payload': '{"x": [1]}'}, {'id': 'b'}])
+
+    def test_multibyte_characters_can_be_split(self):
+        body = u'[{"id": "\xe9t\xe9"}]'.encode('utf-8')
+        chunks = [body[i:i + 1] for i in range(len(body))]
+        self.assertEqual(list(iter_json_array(chunks)), [{'id': u'\xe9t\xe9'}])
+
+    def test_empty_array_yields_nothing(self):
+        self.assertEqual(list(iter_json_array([b'[', b']'])), [])
+
+    def test_raises_if_not_an_array(self):
+        self.assertRaises(ValueError, list, iter_json_array([b'{}']))
+
+    def test_raises_if_array_is_not_terminated(self):
+        self.assertRaises(ValueError, list,
+                          iter_json_array([b'[{"id": "a"}, {"id"']))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(max_failures=2, reset_timeout=30)
+        self.func = mock.MagicMock(return_value='ok')
+
+    def http_error(self, status_code):
+        return HTTPError(response=mock.MagicMock(status_code=status_code))
+
+    def open_circuit(self, now=1000):
+        self.func.side_effect = ConnectionError
+        with mock.patch('syncto.client.time.time', return_value=now):
+            for _ in range(2):
+                self.assertRaises(ConnectionError,
+                                  self.breaker.call, self.func)
+        self.func.side_effect = None
+
+    def test_calls_are_run_while_circuit_is_closed(self):
+        self.assertEqual(self.breaker.call(self.func, 1, a=2), 'ok')
+        self.func.assert_called_with(1, a=2)
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.open_circuit()
+        with mock.patch('syncto.client.time.time', return_value=1010):
+            with self.assertRaises(CircuitOpenError) as cm:
+                self.breaker.call(self.func)
+        self.assertEqual(cm.exception.retry_after, 20)
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_successes_reset_the_failures_count(self):
+        self.func.side_effect = [ConnectionError, 'ok', ConnectionError]
+        self.assertRaises(ConnectionError, self.breaker.call, self.func)
+        self.breaker.call(self.func)
+        self.assertRaises(ConnectionError, self.breaker.call, self.func)
+        self.assertIsNone(self.breaker.opened_at)
+
+    def test_server_errors_are_failures(self):
+        self.func.side_effect = self.http_error(503)
+        for _ in range(2):
+            self.assertRaises(HTTPError, self.breaker.call, self.func)
+        self.assertIsNotNone(self.breaker.opened_at)
+
+    def test_http_errors_without_response_are_failures(self):
+        self.func.side_effect = HTTPError()
+        for _ in range(2):
+            self.assertRaises(HTTPError, self.breaker.call, self.func)
+        self.assertIsNotNone(self.breaker.opened_at)
+
+    def test_client_errors_are_not_failures(self):
+        self.func.side_effect = self.http_error(401)
+        for _ in range(3):
+            self.assertRaises(HTTPError, self.breaker.call, self.func)
+        self.assertIsNone(self.breaker.opened_at)
+
+    def test_other_errors_are_not_failures(self):
+        self.func.side_effect = ValueError
+        for _ in range(3):
+            self.assertRaises(ValueError, self.breaker.call, self.func)
+        self.assertIsNone(self.breaker.opened_at)
+
+    def test_other_errors_do_not_reset_the_failures_count(self):
+        self.func.side_effect = [ConnectionError, ValueError]
+        self.assertRaises(ConnectionError, self.breaker.call, self.func)
+        self.assertRaises(ValueError, self.breaker.call, self.func)
+        self.assertEqual(self.breaker.failures, 1)
+
+    def test_probe_other_error_opens_the_circuit_again(self):
+        self.open_circuit()
+        self.func.side_effect = ValueError
+        with mock.patch('syncto.client.time.time', return_value=1031):
+            self.assertRaises(ValueError, self.breaker.call, self.func)
+        with mock.patch('syncto.client.time.time', return_value=1032):
+            self.assertRaises(CircuitOpenError, self.breaker.call, self.func)
+        self.assertEqual(self.breaker.failures, 2)
+
+    def test_probe_success_closes_the_circuit(self):
+        self.open_circuit()
+        with mock.patch('syncto.client.time.time', return_value=1031):
+            self.assertEqual(self.breaker.call(self.func), 'ok')
+        self.assertIsNone(self.breaker.opened_at)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_probe_failure_opens_the_circuit_again(self):
+        self.open_circuit()
+        self.func.side_effect = ConnectionError
+        with mock.patch('syncto.client.time.time', return_value=1031):
+            self.assertRaises(ConnectionError, self.breaker.call, self.func)
+        with mock.patch('syncto.client.time.time', return_value=1032):
+            self.assertRaises(CircuitOpenError, self.breaker.call, self.func)
+
+    def test_only_one_probe_is_let_through(self):
+        self.open_circuit()
+        self.breaker._probing = True
+        with mock.patch('syncto.client.time.time', return_value=1031):
+            with self.assertRaises(CircuitOpenError) as cm:
+                self.breaker.call(self.func)
+        self.assertEqual(cm.exception.retry_after, 1)
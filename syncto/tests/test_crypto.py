@@ -1,4 +1,6 @@
 from __future__ import unicode_literals
+import json
+import mock
 import nacl.secret
 import re
 from six import text_type
@@ -34,3 +36,53 @@ class CryptoTest(unittest.TestCase):
         encrypted = crypto.encrypt(message, "Client State", "Secret")
         decrypted = crypto.decrypt(encrypted, "Client State", "Secret")
         self.assertIsInstance(decrypted, text_type)
+
+    def test_get_nacl_secret_box_is_memoized(self):
+        first = crypto._get_nacl_secret_box("Client State", "HMAC secret")
+        second = crypto._get_nacl_secret_box(b"Client State", b"HMAC secret")
+        self.assertIs(first, second)
+
+    def test_get_nacl_secret_box_memoization_can_be_bypassed(self):
+        first = crypto._get_nacl_secret_box("Client State", "HMAC secret")
+        second = crypto._get_nacl_secret_box("Client State", "HMAC secret",
+                                             use_cache=False)
+        self.assertIsNot(first, second)
+
+    def test_secret_boxes_are_derived_once(self):
+        crypto._secret_boxes.flush()
+        with mock.patch('syncto.crypto.Hkdf', wraps=crypto.Hkdf) as hkdf:
+            crypto.encrypt("Salut", "Client State", "Secret")
+            crypto.encrypt("Salut", "Client State", "Secret")
+            self.assertEqual(hkdf.call_count, 1)
+
+    def test_encrypt_with_box_can_be_decrypted_with_box(self):
+        box = crypto.get_secret_box("Client State", "Secret")
+        encrypted = crypto.encrypt_with_box("Salut", box)
+        self.assertEqual(crypto.decrypt_with_box(encrypted, box), "Salut")
+        decrypted = crypto.decrypt(encrypted, "Client State", "Secret")
+        self.assertEqual(decrypted, "Salut")
+
+    def test_encrypt_value_can_be_decrypted(self):
+        value = {"key": "I am not a secure key", "uid": 123456}
+        encrypted = crypto.encrypt_value(value, "Client State", "Secret")
+        decrypted = crypto.decrypt_value(encrypted, "Client State", "Secret")
+        self.assertEqual(decrypted, value)
+
+    def test_encrypt_value_uses_the_compact_format(self):
+        value = {"key": "I am not a secure key", "uid": 123456}
+        encrypted = crypto.encrypt_value(value, "Client State", "Secret")
+        legacy = crypto.encrypt(json.dumps(value), "Client State", "Secret")
+        self.assertTrue(encrypted.startswith('v2:'))
+        self.assertLess(len(encrypted), len(legacy))
+
+    def test_decrypt_value_reads_the_hex_format(self):
+        value = {"key": "I am not a secure key", "uid": 123456}
+        legacy = crypto.encrypt(json.dumps(value), "Client State", "Secret")
+        decrypted = crypto.decrypt_value(legacy, "Client State", "Secret")
+        self.assertEqual(decrypted, value)
+
+    def test_decrypt_value_accepts_bytes(self):
+        encrypted = crypto.encrypt_value([1, 2], "Client State", "Secret")
+        decrypted = crypto.decrypt_value(encrypted.encode('ascii'),
+                                         "Client State", "Secret")
+        self.assertEqual(decrypted, [1, 2])
@@ -1,16 +1,21 @@
 import mock
 import os
+import threading
+import time
 from contextlib import contextmanager
 from uuid import uuid4
 
 from cliquet.errors import ERRORS
 from cliquet.tests.support import FormattedErrorMixin
+from pyramid.request import Request
 from requests.exceptions import HTTPError, ConnectionError
 
 from syncto import __version__
 from syncto import AUTHORIZATION_HEADER, CLIENT_STATE_HEADER
 from syncto import main as testapp
+from syncto.client import CircuitOpenError, run_concurrently
 from syncto.heartbeat import ping_sync_cluster
+from syncto.info_collections import get_collections_timestamps
 
 from .support import BaseWebTest, unittest
 
@@ -21,6 +26,7 @@ MANDATORY_SETTINGS = {
 }
 
 COLLECTION_URL = "/buckets/syncto/collections/tabs/records"
+RECORDS_URL = "/buckets/syncto/records"
 RECORD_URL = "/buckets/syncto/collections/tabs/records/%s" % uuid4()
 
 RECORD_EXAMPLE = {
@@ -148,6 +154,17 @@ class ErrorsTest(FormattedErrorMixin, BaseWebTest, unittest.TestCase):
         self.assertFormattedError(
             resp, 503, ERRORS.BACKEND, "Service Unavailable", "retry later")
 
+    def test_open_circuit_returns_a_503_with_retry_after(self):
+        headers = self.headers.copy()
+        headers['Authorization'] = "BrowserID valid-browser-id-assertion"
+        headers['X-Client-State'] = "ValidClientState"
+        with mock.patch("syncto.authentication.TokenserverClient",
+                        side_effect=CircuitOpenError(12)):
+            resp = self.app.get(COLLECTION_URL, headers=headers, status=503)
+
+        self.assertEqual(resp.headers['Retry-After'], '12')
+        self.assertEqual(resp.json['errno'], ERRORS.BACKEND)
+
     def test_error_with_syncclient_server_request(self):
         headers = self.headers.copy()
         headers['Authorization'] = "BrowserID valid-browser-id-assertion"
@@ -192,6 +209,9 @@ class BaseViewTest(BaseWebTest, unittest.TestCase):
         headers['X-Weave-Quota-Remaining'] = '125'
         self.sync_client.return_value.raw_resp.headers = headers
         self.sync_client.return_value.put_record.return_value = last_modified
+        self.sync_client.return_value.api_endpoint = (
+            'https://example.org/1.5/123456')
+        self.sync_client.return_value.info_collections.return_value = {}
 
         self.addCleanup(p.stop)
 
@@ -321,6 +341,47 @@ class CollectionTest(FormattedErrorMixin, BaseViewTest):
                      params={'in_ids': '123,456,789'},
                      headers=self.headers, status=200)
 
+    def test_collection_removes_duplicate_ids(self):
+        self.app.get(COLLECTION_URL, params={'in_ids': '123,456,123'},
+                     headers=self.headers, status=200)
+        self.sync_client.return_value.get_records.assert_called_with(
+            "tabs", full=True, ids=['123', '456'],
+            headers=_DEFAULT_SYNC_HEADERS)
+
+    def test_collection_splits_large_lists_of_ids(self):
+        get_records_by_ids = self.sync_client.return_value.get_records_by_ids
+        get_records_by_ids.return_value = []
+        ids = ['%012d' % i for i in range(150)]
+        self.app.get(COLLECTION_URL, params={'in_ids': ','.join(ids),
+                                             '_sort': 'oldest'},
+                     headers=self.headers, status=200)
+        get_records_by_ids.assert_called_with(
+            "tabs", ids, full=True, sort='oldest', chunk_size=100,
+            max_workers=4, headers=_DEFAULT_SYNC_HEADERS)
+        self.assertFalse(self.sync_client.return_value.get_records.called)
+
+    def test_collection_splits_large_lists_of_ids_only(self):
+        get_records_by_ids = self.sync_client.return_value.get_records_by_ids
+        get_records_by_ids.return_value = ['abc']
+        ids = ['%012d' % i for i in range(150)]
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_ids_only_enabled': True}):
+            resp = self.app.get(COLLECTION_URL,
+                                params={'in_ids': ','.join(ids),
+                                        '_fields': 'id'},
+                                headers=self.headers, status=200)
+        self.assertEqual(resp.json, {'data': [{'id': 'abc'}]})
+
+    def test_collection_does_not_split_paginated_lists_of_ids(self):
+        ids = ['%012d' % i for i in range(150)]
+        self.app.get(COLLECTION_URL, params={'in_ids': ','.join(ids),
+                                             '_limit': '10'},
+                     headers=self.headers, status=200)
+        self.sync_client.return_value.get_records.assert_called_with(
+            "tabs", full=True, ids=ids, limit='10',
+            headers=_DEFAULT_SYNC_HEADERS)
+
     def test_collection_returns_empty_list(self):
         self.sync_client.return_value.get_records.return_value = []
         resp = self.app.get(COLLECTION_URL,
@@ -354,6 +415,59 @@ class CollectionTest(FormattedErrorMixin, BaseViewTest):
         resp = self.app.get(COLLECTION_URL, headers=self.headers, status=304)
         self.assertEqual(resp.body, b'')
 
+    def test_collection_keeps_timestamps_if_only_ids_are_requested(self):
+        self.sync_client.return_value.get_records.return_value = [{
+            "id": "abc", "modified": 1.5, "payload": "x"}]
+        resp = self.app.get(COLLECTION_URL + '?_fields=id',
+                            headers=self.headers, status=200)
+        self.sync_client.return_value.get_records.assert_called_with(
+            "tabs", full=True, headers=_DEFAULT_SYNC_HEADERS)
+        self.assertEqual(resp.json, {'data': [
+            {'id': 'abc', 'last_modified': 1500}]})
+
+    def test_collection_lists_ids_only_if_only_ids_are_requested(self):
+        self.sync_client.return_value.get_records.return_value = ['abc']
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_ids_only_enabled': True}):
+            resp = self.app.get(COLLECTION_URL + '?_fields=id',
+                                headers=self.headers, status=200)
+        self.sync_client.return_value.get_records.assert_called_with(
+            "tabs", full=False, headers=_DEFAULT_SYNC_HEADERS)
+        self.assertEqual(resp.json, {'data': [{'id': 'abc'}]})
+        self.assertIn('ETag', resp.headers)
+
+    def test_ids_only_records_have_no_timestamp(self):
+        self.sync_client.return_value.get_records.return_value = ['abc']
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_ids_only_enabled': True}):
+            resp = self.app.get(COLLECTION_URL + '?_fields=id',
+                                headers=self.headers, status=200)
+        self.assertNotIn('last_modified', resp.json['data'][0])
+
+    def test_collection_strips_fields_that_were_not_requested(self):
+        self.sync_client.return_value.get_records.return_value = [{
+            "id": "abc", "modified": 1.5, "payload": "x", "sortindex": 2}]
+        resp = self.app.get(COLLECTION_URL + '?_fields=payload',
+                            headers=self.headers, status=200)
+        self.sync_client.return_value.get_records.assert_called_with(
+            "tabs", full=True, headers=_DEFAULT_SYNC_HEADERS)
+        self.assertEqual(resp.json, {'data': [
+            {"id": "abc", "last_modified": 1500, "payload": "x"}]})
+
+    def test_projection_is_applied_to_passthrough_pages(self):
+        self.sync_client.return_value.get_records.return_value = [{
+            "id": "abc", "modified": 1.5, "payload": "x", "sortindex": 2}]
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_passthrough_enabled': True}):
+            resp = self.app.get(COLLECTION_URL + '?_fields=sortindex',
+                                headers=self.headers, status=200)
+        self.assertFalse(self.sync_client.return_value.get_raw_records.called)
+        self.assertEqual(resp.json, {'data': [
+            {"id": "abc", "last_modified": 1500, "sortindex": 2}]})
+
     def test_collection_correctly_generate_next_page_header(self):
         resp = self.app.get(COLLECTION_URL+'?_limit=2&sort=index',
                             headers=self.headers, status=200)
@@ -363,6 +477,1425 @@ class CollectionTest(FormattedErrorMixin, BaseViewTest):
         self.assertEquals(resp.headers['Next-Page'], next_page)
 
 
+class CollectionStreamingTest(BaseViewTest):
+
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(CollectionStreamingTest, self).setUp()
+        self.stream_records = self.sync_client.return_value.stream_records
+        self.stream_records.side_effect = lambda *args, **kwargs: iter([
+            {"id": "Y_-5-LEeQBuh60IT0MyWEQ", "modified": 14377478425.69},
+            {"id": "Z_-5-LEeQBuh60IT0MyWEQ", "modified": 14377478426.69}])
+
+    def get_app_settings(self, extra=None):
+        settings = super(CollectionStreamingTest, self).get_app_settings(extra)
+        settings['collection_get_streaming_enabled'] = True
+        return settings
+
+    def test_records_are_streamed_from_sync(self):
+        self.app.get(COLLECTION_URL + '?_limit=2', headers=self.headers)
+        self.stream_records.assert_called_with(
+            "tabs", headers=mock.ANY, limit='2')
+        self.assertFalse(self.sync_client.return_value.get_records.called)
+
+    def test_streamed_records_are_converted(self):
+        resp = self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.json, {'data': [
+            {"id": "Y_-5-LEeQBuh60IT0MyWEQ", "last_modified": 14377478425690},
+            {"id": "Z_-5-LEeQBuh60IT0MyWEQ", "last_modified": 14377478426690}
+        ]})
+
+    def test_streamed_body_is_sent_by_chunks(self):
+        records = [{"id": "%s" % i, "payload": "x" * 1000, "modified": 1.0}
+                   for i in range(50)]
+        self.stream_records.side_effect = lambda *a, **kw: iter(records)
+        resp = self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertEqual(len(resp.json['data']), 50)
+        self.assertEqual(resp.json['data'][49]['last_modified'], 1000)
+
+    def test_streamed_empty_collection_returns_empty_list(self):
+        self.stream_records.side_effect = lambda *a, **kw: iter([])
+        resp = self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertEqual(resp.json, {'data': []})
+
+    def test_projection_is_applied_to_streamed_records(self):
+        resp = self.app.get(COLLECTION_URL + '?_fields=last_modified',
+                            headers=self.headers, status=200)
+        self.assertEqual(resp.json['data'][0], {
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ", "last_modified": 14377478425690})
+
+    def test_ids_are_listed_without_streaming(self):
+        self.sync_client.return_value.get_records.return_value = ['abc']
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_ids_only_enabled': True}):
+            resp = self.app.get(COLLECTION_URL + '?_fields=id',
+                                headers=self.headers, status=200)
+        self.assertFalse(self.stream_records.called)
+        self.assertEqual(resp.json, {'data': [{'id': 'abc'}]})
+
+    def test_streaming_keeps_sync_headers(self):
+        resp = self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertEqual(resp.headers['Total-Records'], '1')
+        self.assertEqual(resp.headers['Quota-Remaining'], '125')
+
+
+class CollectionPassthroughTest(BaseViewTest):
+
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(CollectionPassthroughTest, self).setUp()
+        get_raw_records = self.sync_client.return_value.get_raw_records
+        get_raw_records.return_value = (
+            b'[{"id": "Y_-5-LEeQBuh60IT0MyWEQ", "modified": 14377478425.69,'
+            b' "payload": "{\\"modified\\": 1}"}]')
+
+    def get_app_settings(self, extra=None):
+        settings = super(CollectionPassthroughTest,
+                         self).get_app_settings(extra)
+        settings['collection_get_passthrough_enabled'] = True
+        return settings
+
+    def test_records_body_is_rewritten(self):
+        resp = self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.json, {'data': [{
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ",
+            "last_modified": 14377478425690,
+            "payload": '{"modified": 1}'}]})
+        self.assertFalse(self.sync_client.return_value.get_records.called)
+
+    def test_passthrough_keeps_sync_headers(self):
+        resp = self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertEqual(resp.headers['Total-Records'], '1')
+        self.assertEqual(resp.headers['Quota-Remaining'], '125')
+
+
+class InfoCollectionsNotModifiedTest(BaseViewTest):
+
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(InfoCollectionsNotModifiedTest, self).setUp()
+        p = mock.patch("syncto.views.record.build_sync_client",
+                       self.sync_client)
+        p.start()
+        self.addCleanup(p.stop)
+
+        self.client = self.sync_client.return_value
+        self.client.info_collections.return_value = {'tabs': 14377478425.69}
+        self.client.get_record.return_value = {
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ",
+            "modified": 14377478425.69
+        }
+        self.headers['If-None-Match'] = '"14377478425690"'
+
+    def get_app_settings(self, extra=None):
+        settings = super(InfoCollectionsNotModifiedTest,
+                         self).get_app_settings(extra)
+        settings['cache_info_collections_ttl_seconds'] = 10
+        return settings
+
+    def test_collection_returns_304_if_collection_is_not_modified(self):
+        resp = self.app.get(COLLECTION_URL, headers=self.headers, status=304)
+        self.assertEqual(resp.headers['ETag'], '"14377478425690"')
+        self.assertFalse(self.client.get_records.called)
+
+    def test_invalid_querystring_is_reported_if_not_modified(self):
+        self.app.get(COLLECTION_URL + '?_sort=size', headers=self.headers,
+                     status=400)
+
+    def test_record_returns_304_if_collection_is_not_modified(self):
+        self.app.get(RECORD_URL, headers=self.headers, status=304)
+        self.assertFalse(self.client.get_record.called)
+
+    def test_batch_subrequests_return_304_if_collection_is_not_modified(self):
+        body = {'defaults': {'headers': self.headers},
+                'requests': [{'path': COLLECTION_URL}, {'path': RECORD_URL}]}
+        resp = self.app.post_json('/batch', body, status=200)
+        statuses = [r['status'] for r in resp.json['responses']]
+        self.assertEqual(statuses, [304, 304])
+        self.assertFalse(self.client.get_records.called)
+        self.assertFalse(self.client.get_record.called)
+
+    def test_record_304_gives_back_the_etag_of_the_request(self):
+        self.client.info_collections.return_value = {'tabs': 14377478420.00}
+        resp = self.app.get(RECORD_URL, headers=self.headers, status=304)
+        self.assertEqual(resp.headers['ETag'], '"14377478425690"')
+
+    def test_collection_is_fetched_if_modified(self):
+        self.client.info_collections.return_value = {'tabs': 14377478426.69}
+        self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertTrue(self.client.get_records.called)
+
+    def test_collection_is_fetched_if_unknown(self):
+        self.client.info_collections.return_value = {}
+        self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertTrue(self.client.get_records.called)
+
+    def test_info_collections_is_not_fetched_without_if_none_match(self):
+        del self.headers['If-None-Match']
+        self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+        self.assertFalse(self.client.info_collections.called)
+
+    def test_info_collections_is_cached(self):
+        self.app.get(COLLECTION_URL, headers=self.headers, status=304)
+        self.app.get(RECORD_URL, headers=self.headers, status=304)
+        self.assertEqual(self.client.info_collections.call_count, 1)
+
+    def test_cache_is_invalidated_on_put(self):
+        self.app.get(COLLECTION_URL, headers=self.headers, status=304)
+        headers = self.headers.copy()
+        del headers['If-None-Match']
+        self.app.put_json(RECORD_URL, RECORD_EXAMPLE, headers=headers)
+        self.app.get(COLLECTION_URL, headers=self.headers, status=304)
+        self.assertEqual(self.client.info_collections.call_count, 2)
+
+    def test_cache_is_invalidated_on_delete(self):
+        self.app.get(COLLECTION_URL, headers=self.headers, status=304)
+        headers = self.headers.copy()
+        del headers['If-None-Match']
+        self.app.delete(RECORD_URL, headers=headers, status=204)
+        self.app.get(COLLECTION_URL, headers=self.headers, status=304)
+        self.assertEqual(self.client.info_collections.call_count, 2)
+
+    def test_timestamps_are_not_cached_when_disabled(self):
+        request = mock.MagicMock()
+        request.registry = self.app.app.registry
+        settings = request.registry.settings
+        with mock.patch.dict(settings,
+                             {'cache_info_collections_ttl_seconds': 0}):
+            get_collections_timestamps(request, self.client)
+            get_collections_timestamps(request, self.client)
+        self.assertEqual(self.client.info_collections.call_count, 2)
+        cache_keys = request.registry.cache._store.keys()
+        self.assertFalse([key for key in cache_keys
+                          if key.startswith('info_collections_')])
+
+    def test_short_circuit_can_be_disabled(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'cache_info_collections_ttl_seconds': 0}):
+            self.app.get(COLLECTION_URL, headers=self.headers, status=200)
+            del self.headers['If-None-Match']
+            self.app.delete(RECORD_URL, headers=self.headers, status=204)
+        self.assertFalse(self.client.info_collections.called)
+
+
+class CollectionPageCacheTest(BaseViewTest):
+
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(CollectionPageCacheTest, self).setUp()
+        self.client = self.sync_client.return_value
+        self.client.client_state = '12345'
+        self.client.info_collections.return_value = {'tabs': 14377478425.69}
+        self.client.get_records.side_effect = lambda *a, **kw: [{
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ",
+            "modified": 14377478425.69
+        }]
+        self.cache = self.app.app.registry.cache
+
+    def get_app_settings(self, extra=None):
+        settings = super(CollectionPageCacheTest, self).get_app_settings(extra)
+        settings['cache_info_collections_ttl_seconds'] = 10
+        settings['cache_collection_pages_ttl_seconds'] = 60
+        return settings
+
+    def cached_pages(self):
+        return [key for key in self.cache._store.keys()
+                if key.startswith('collection_page_')]
+
+    def test_unchanged_pages_are_served_from_cache(self):
+        first = self.app.get(COLLECTION_URL, headers=self.headers)
+        second = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 1)
+        self.assertEqual(first.json, second.json)
+        self.assertEqual(second.json['data'][0]['last_modified'],
+                         14377478425690)
+        for header in ('ETag', 'Total-Records', 'Next-Page',
+                       'Quota-Remaining'):
+            self.assertEqual(first.headers[header], second.headers[header])
+
+    def test_pages_are_not_cached_without_info_collections_cache(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'cache_info_collections_ttl_seconds': 0}):
+            self.app.get(COLLECTION_URL, headers=self.headers)
+            self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+        self.assertFalse(self.client.info_collections.called)
+        self.assertEqual(self.cached_pages(), [])
+
+    def test_pages_are_stored_encrypted(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        cached, = self.cached_pages()
+        encrypted = self.cache.get(cached)
+        self.assertTrue(encrypted.startswith('v2:'))
+        self.assertNotIn('Y_-5-LEeQBuh60IT0MyWEQ', encrypted)
+
+    def test_next_page_is_built_from_the_current_request(self):
+        self.app.get(COLLECTION_URL + '?_sort=newest', headers=self.headers)
+        resp = self.app.get(COLLECTION_URL + '?_sort=-last_modified',
+                            headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 1)
+        self.assertIn('_sort=-last_modified', resp.headers['Next-Page'])
+
+    def test_alerts_are_not_replayed(self):
+        self.client.raw_resp.headers['X-Weave-Alert'] = 'Hey'
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        resp = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertNotIn('Alert', resp.headers)
+
+    def test_pages_are_not_shared_between_parameters(self):
+        self.app.get(COLLECTION_URL + '?_limit=2', headers=self.headers)
+        resp = self.app.get(COLLECTION_URL + '?_limit=3',
+                            headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+        self.assertNotIn('Total-Records', resp.headers)
+
+    def test_pages_are_not_shared_between_projections(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        resp = self.app.get(COLLECTION_URL + '?_fields=payload',
+                            headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+        self.assertEqual(resp.json['data'][0], {
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ", "last_modified": 14377478425690})
+
+    def test_ids_order_does_not_matter(self):
+        self.app.get(COLLECTION_URL + '?in_ids=a,b', headers=self.headers)
+        self.app.get(COLLECTION_URL + '?in_ids=b,a', headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 1)
+
+    def test_pages_are_not_reused_once_collection_changed(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.app.app.registry.cache.flush()
+        self.client.info_collections.return_value = {'tabs': 14377478426.69}
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+
+    def test_pages_of_unknown_collections_are_not_cached(self):
+        self.client.info_collections.return_value = {}
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertEqual(self.cached_pages(), [])
+
+    def test_preconditions_are_checked_by_sync(self):
+        headers = self.headers.copy()
+        headers['If-Match'] = '"14377478425690"'
+        self.app.get(COLLECTION_URL, headers=headers)
+        self.app.get(COLLECTION_URL, headers=headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+
+    def test_large_pages_are_not_cached(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'cache_collection_pages_max_bytes': 10}):
+            self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertEqual(self.cached_pages(), [])
+
+    def test_passthrough_pages_are_cached(self):
+        self.client.get_raw_records.return_value = (
+            b'[{"id": "abc", "modified": 14377478425.69}]')
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_passthrough_enabled': True}):
+            self.app.get(COLLECTION_URL, headers=self.headers)
+            resp = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertEqual(self.client.get_raw_records.call_count, 1)
+        self.assertEqual(resp.json, {'data': [
+            {'id': 'abc', 'last_modified': 14377478425690}]})
+
+    def test_streamed_pages_are_not_cached(self):
+        self.client.stream_records.side_effect = lambda *a, **kw: iter([])
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_streaming_enabled': True}):
+            self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertEqual(self.cached_pages(), [])
+        self.assertFalse(self.client.info_collections.called)
+
+
+class CollectionSnapshotTest(BaseViewTest):
+
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(CollectionSnapshotTest, self).setUp()
+        p = mock.patch("syncto.views.record.build_sync_client",
+                       self.sync_client)
+        p.start()
+        self.addCleanup(p.stop)
+
+        self.client = self.sync_client.return_value
+        self.client.client_state = '12345'
+        self.client.get_collection_counts.return_value = {'tabs': 3}
+        # Collections are given entirely by Sync.
+        del self.client.raw_resp.headers['X-Weave-Next-Offset']
+        self.records = [
+            {"id": "a", "modified": 10.0, "sortindex": 3},
+            {"id": "b", "modified": 20.0, "sortindex": 1},
+        ]
+        self.changes = [
+            {"id": "b", "modified": 30.0, "sortindex": 1},
+            {"id": "c", "modified": 40.0, "sortindex": 2},
+        ]
+
+        def get_records(collection, newer=None, **kwargs):
+            if newer is None:
+                return [dict(r) for r in self.records]
+            return [dict(r) for r in self.changes]
+        self.client.get_records.side_effect = get_records
+
+    def get_app_settings(self, extra=None):
+        settings = super(CollectionSnapshotTest, self).get_app_settings(extra)
+        settings['cache_collection_snapshots_ttl_seconds'] = 3600
+        return settings
+
+    def ids(self, resp):
+        return [r['id'] for r in resp.json['data']]
+
+    def test_collection_is_fetched_entirely_without_snapshot(self):
+        resp = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.get_records.assert_called_once_with(
+            "tabs", full=True, headers=mock.ANY)
+        self.assertEqual(self.ids(resp), ['b', 'a'])
+        self.assertEqual(resp.headers['Total-Records'], '2')
+        self.assertNotIn('Next-Page', resp.headers)
+
+    def test_changes_are_merged_into_the_snapshot(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        resp = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, newer='14377478425.69', headers=mock.ANY)
+        self.assertEqual(self.client.get_records.call_count, 2)
+        self.assertEqual(self.ids(resp), ['c', 'b', 'a'])
+        self.assertEqual(resp.json['data'][1]['last_modified'], 30000)
+        self.assertEqual(resp.headers['ETag'], '"14377478425690"')
+
+    def test_collection_is_fetched_again_if_records_were_deleted(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.get_collection_counts.return_value = {'tabs': 2}
+        resp = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, headers=mock.ANY)
+        self.assertEqual(self.client.get_records.call_count, 3)
+        self.assertEqual(self.ids(resp), ['b', 'a'])
+
+    def test_paginated_collections_are_not_kept(self):
+        self.client.raw_resp.headers['X-Weave-Next-Offset'] = '12345'
+        resp = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertIn('Next-Page', resp.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+        cache_keys = self.app.app.registry.cache._store.keys()
+        self.assertFalse([key for key in cache_keys
+                          if key.startswith('collection_snapshot_')])
+
+    def test_paginated_changes_are_not_merged(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.raw_resp.headers['X-Weave-Next-Offset'] = '12345'
+        resp = self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, headers=mock.ANY)
+        self.assertEqual(self.client.get_records.call_count, 3)
+        self.assertIn('Next-Page', resp.headers)
+
+    def test_records_are_sorted_from_snapshot(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.get_records.side_effect = [[]]
+        self.client.get_collection_counts.return_value = {'tabs': 2}
+        resp = self.app.get(COLLECTION_URL + '?_sort=oldest',
+                            headers=self.headers)
+        self.assertEqual(self.ids(resp), ['a', 'b'])
+        self.assertEqual(self.client.get_records.call_count, 2)
+
+    def test_filtered_requests_are_not_served_from_snapshot(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.app.get(COLLECTION_URL + '?_since=15000', headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, newer='15.00', headers=mock.ANY)
+        self.app.get(COLLECTION_URL + '?in_ids=a,b', headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, ids=['a', 'b'], headers=mock.ANY)
+        self.assertEqual(self.client.get_records.call_count, 3)
+        self.assertFalse(self.client.get_collection_counts.called)
+
+    def test_pages_are_fetched_without_snapshot(self):
+        self.app.get(COLLECTION_URL + '?_limit=2', headers=self.headers)
+        self.client.get_records.assert_called_once_with(
+            "tabs", full=True, limit='2', headers=mock.ANY)
+
+    def test_pages_smaller_than_the_collection_are_fetched(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, limit='1', headers=mock.ANY)
+        self.assertEqual(self.client.get_records.call_count, 2)
+
+    def test_pages_containing_the_collection_are_served(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        resp = self.app.get(COLLECTION_URL + '?_limit=3',
+                            headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+        self.assertEqual(self.ids(resp), ['c', 'b', 'a'])
+
+    def test_pages_are_fetched_if_the_collection_grew_meanwhile(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.client.get_collection_counts.return_value = {'tabs': 2}
+        self.records.append({"id": "c", "modified": 40.0, "sortindex": 2})
+        self.app.get(COLLECTION_URL + '?_limit=2', headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, limit='2', headers=mock.ANY)
+        self.assertEqual(self.client.get_records.call_count, 4)
+
+    def test_paginated_requests_are_not_served_from_snapshot(self):
+        self.app.get(COLLECTION_URL + '?_token=abc', headers=self.headers)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, offset='abc', headers=mock.ANY)
+        self.assertEqual(self.client.get_records.call_count, 1)
+
+    def test_preconditions_are_not_checked_from_snapshot(self):
+        headers = self.headers.copy()
+        headers['If-Match'] = '"14377478425690"'
+        self.app.get(COLLECTION_URL, headers=headers)
+        self.app.get(COLLECTION_URL, headers=headers)
+        self.assertFalse(self.client.get_collection_counts.called)
+
+    def test_snapshot_is_invalidated_on_delete(self):
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.app.delete(RECORD_URL, headers=self.headers, status=204)
+        self.app.get(COLLECTION_URL, headers=self.headers)
+        self.assertFalse(self.client.get_collection_counts.called)
+
+    def test_large_snapshots_are_not_stored(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'cache_collection_snapshots_max_bytes': 10}):
+            self.app.get(COLLECTION_URL, headers=self.headers)
+            self.app.get(COLLECTION_URL, headers=self.headers)
+            self.app.get(COLLECTION_URL + '?_limit=2', headers=self.headers)
+        self.assertFalse(self.client.get_collection_counts.called)
+        self.assertEqual(self.client.get_records.call_count, 3)
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, limit='2', headers=mock.ANY)
+
+
+class CollectionPrefetchTest(BaseViewTest):
+
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(CollectionPrefetchTest, self).setUp()
+        self.client = self.sync_client.return_value
+        self.client.client_state = '12345'
+        self.prefetcher = mock.MagicMock()
+        self.prefetcher.client_state = '12345'
+        self.client.get_records.side_effect = lambda *a, **kw: [{
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ",
+            "modified": 14377478425.69
+        }]
+        self.prefetcher.raw_resp.headers = {
+            'X-Last-Modified': '14377478426.69',
+            'X-Weave-Records': '2'
+        }
+
+        def get_records(collection, full, **kwargs):
+            if not full:
+                return ['next']
+            return [{"id": "next", "modified": 14377478426.69}]
+        self.prefetcher.get_records.side_effect = get_records
+        self.client.clone.return_value = self.prefetcher
+        self.registry = self.app.app.registry
+
+    def get_app_settings(self, extra=None):
+        settings = super(CollectionPrefetchTest, self).get_app_settings(extra)
+        settings['cache_prefetched_pages_ttl_seconds'] = 30
+        return settings
+
+    def wait_for_prefetches(self):
+        while self.registry.prefetch_flights._calls:
+            time.sleep(0.01)
+
+    def prefetched_pages(self):
+        return [key for key in self.registry.cache._store.keys()
+                if key.startswith('collection_prefetch_')]
+
+    def test_next_page_is_prefetched(self):
+        self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+        self.wait_for_prefetches()
+        self.prefetcher.get_records.assert_called_with(
+            "tabs", full=True, limit='1', offset='12345',
+            headers=_DEFAULT_SYNC_HEADERS)
+
+    def test_next_page_is_served_from_prefetch(self):
+        self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+        resp = self.app.get(COLLECTION_URL + '?_limit=1&_token=12345',
+                            headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 1)
+        self.assertEqual(resp.json, {'data': [
+            {'id': 'next', 'last_modified': 14377478426690}]})
+        self.assertEqual(resp.headers['ETag'], '"14377478426690"')
+        self.assertNotIn('Next-Page', resp.headers)
+
+    def test_prefetched_pages_are_served_once(self):
+        self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+        self.app.get(COLLECTION_URL + '?_limit=1&_token=12345',
+                     headers=self.headers)
+        self.app.get(COLLECTION_URL + '?_limit=1&_token=12345',
+                     headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+
+    def test_prefetched_pages_are_stored_encrypted(self):
+        self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+        self.wait_for_prefetches()
+        prefetched, = self.prefetched_pages()
+        encrypted = self.registry.cache.get(prefetched)
+        self.assertTrue(encrypted.startswith('v2:'))
+        self.assertNotIn('next', encrypted)
+
+    def test_prefetched_pages_are_not_shared_between_parameters(self):
+        self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+        self.app.get(COLLECTION_URL + '?_limit=2&_token=12345',
+                     headers=self.headers)
+        self.assertEqual(self.client.get_records.call_count, 2)
+
+    def test_ids_listings_are_prefetched(self):
+        self.client.get_records.side_effect = None
+        self.client.get_records.return_value = ['abc']
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'collection_get_ids_only_enabled': True}):
+            self.app.get(COLLECTION_URL + '?_limit=1&_fields=id',
+                         headers=self.headers)
+            resp = self.app.get(COLLECTION_URL + '?_limit=1&_fields=id'
+                                '&_token=12345', headers=self.headers)
+        self.assertEqual(resp.json, {'data': [{'id': 'next'}]})
+
+    def test_preconditions_are_checked_by_sync(self):
+        headers = self.headers.copy()
+        headers['If-Match'] = '"14377478425690"'
+        self.app.get(COLLECTION_URL + '?_limit=1', headers=headers)
+        self.assertFalse(self.prefetcher.get_records.called)
+
+    def test_prefetches_are_bounded_per_process(self):
+        with mock.patch.object(self.registry, 'prefetch_budget',
+                               threading.BoundedSemaphore(0)):
+            self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+        self.assertFalse(self.prefetcher.get_records.called)
+
+    def test_pending_prefetches_are_not_started_twice(self):
+        budget = threading.BoundedSemaphore(1)
+        flights = self.registry.prefetch_flights
+        with mock.patch.object(self.registry, 'prefetch_budget', budget):
+            with mock.patch.object(flights, 'start', return_value=False):
+                self.app.get(COLLECTION_URL + '?_limit=1',
+                             headers=self.headers)
+        self.assertTrue(budget.acquire(False))
+
+    def test_prefetch_errors_are_logged(self):
+        self.prefetcher.get_records.side_effect = ValueError
+        with mock.patch('syncto.prefetch.logger') as logger:
+            self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+            self.app.get(COLLECTION_URL + '?_limit=1&_token=12345',
+                         headers=self.headers)
+            self.assertTrue(logger.error.called)
+        self.assertEqual(self.client.get_records.call_count, 2)
+
+    def test_large_pages_are_not_prefetched(self):
+        settings = self.registry.settings
+        with mock.patch.dict(settings,
+                             {'cache_collection_pages_max_bytes': 10}):
+            self.app.get(COLLECTION_URL + '?_limit=1', headers=self.headers)
+            self.wait_for_prefetches()
+        self.assertEqual(self.prefetched_pages(), [])
+
+
+class RecordCacheTest(BaseViewTest):
+
+    def setUp(self):
+        super(RecordCacheTest, self).setUp()
+        self.client = self.sync_client.return_value
+        self.client.client_state = '12345'
+        self.client.get_record.side_effect = lambda c, record_id, **kw: {
+            'id': record_id, 'payload': 'keys', 'modified': 14377478425.69}
+        self.client.raw_resp.headers = {'X-Last-Modified': '14377478425.69'}
+        self.keys_url = '/buckets/syncto/collections/crypto/records/keys'
+        self.cache = self.app.app.registry.cache
+
+    def get_app_settings(self, extra=None):
+        settings = super(RecordCacheTest, self).get_app_settings(extra)
+        settings['cache_records_ttl_seconds'] = 60
+        settings['record_crypto_put_enabled'] = True
+        return settings
+
+    def test_bodies_are_served_from_cache(self):
+        first = self.app.get(self.keys_url, headers=self.headers)
+        second = self.app.get(self.keys_url, headers=self.headers)
+        self.assertEqual(self.client.get_record.call_count, 1)
+        self.assertEqual(first.json, second.json)
+        self.assertEqual(second.headers['ETag'], '"14377478425690"')
+
+    def test_entries_are_stored_encrypted(self):
+        self.app.get(self.keys_url, headers=self.headers)
+        cached, = [key for key in self.cache._store.keys()
+                   if key.startswith('record_')]
+        encrypted = self.cache.get(cached)
+        self.assertTrue(encrypted.startswith('v2:'))
+        self.assertNotIn('keys', encrypted)
+
+    def test_other_bodies_are_read_from_sync(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        self.app.get(RECORD_URL, headers=self.headers)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_conditional_requests_are_answered_locally(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        headers = self.headers.copy()
+        headers['If-None-Match'] = '"14377478425690"'
+        resp = self.app.get(RECORD_URL, headers=headers, status=304)
+        self.assertEqual(resp.headers['ETag'], '"14377478425690"')
+        self.assertEqual(self.client.get_record.call_count, 1)
+
+    def test_batch_subrequests_are_answered_locally(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        headers = self.headers.copy()
+        headers['If-None-Match'] = '"14377478425690"'
+        body = {'defaults': {'headers': headers},
+                'requests': [{'path': RECORD_URL}]}
+        resp = self.app.post_json('/batch', body, status=200)
+        self.assertEqual(resp.json['responses'][0]['status'], 304)
+        self.assertEqual(self.client.get_record.call_count, 1)
+
+    def test_modified_records_are_read_from_sync(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        headers = self.headers.copy()
+        headers['If-None-Match'] = '"14377478420000"'
+        self.app.get(RECORD_URL, headers=headers, status=200)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_preconditions_are_checked_by_sync(self):
+        self.app.get(self.keys_url, headers=self.headers)
+        headers = self.headers.copy()
+        headers['If-Match'] = '"14377478425690"'
+        self.app.get(self.keys_url, headers=headers)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_entries_are_updated_on_put(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        self.client.put_record.return_value = 14377478430.0
+        self.app.put_json(RECORD_URL, {'data': {'payload': 'new'}},
+                          headers=self.headers)
+        headers = self.headers.copy()
+        headers['If-None-Match'] = '"14377478425690"'
+        self.app.get(RECORD_URL, headers=headers, status=200)
+        headers['If-None-Match'] = '"14377478430000"'
+        self.app.get(RECORD_URL, headers=headers, status=304)
+
+    def test_bodies_are_not_cached_on_put(self):
+        self.client.put_record.return_value = 14377478430.0
+        self.app.put_json(self.keys_url, {'data': {'sortindex': 5}},
+                          headers=self.headers)
+        resp = self.app.get(self.keys_url, headers=self.headers)
+        self.assertEqual(self.client.get_record.call_count, 1)
+        self.assertEqual(resp.json['data']['payload'], 'keys')
+
+    def test_expiring_records_are_not_cached_on_put(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        self.app.put_json(RECORD_URL, {'data': {'payload': 'new', 'ttl': 5}},
+                          headers=self.headers)
+        headers = self.headers.copy()
+        headers['If-None-Match'] = '"14377478425690"'
+        self.app.get(RECORD_URL, headers=headers, status=200)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_entries_are_invalidated_on_failed_put(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        response = mock.MagicMock(status_code=503)
+        self.client.put_record.side_effect = HTTPError(response=response)
+        self.app.put_json(RECORD_URL, {'data': {'payload': 'new'}},
+                          headers=self.headers, status=503)
+        self.app.get(RECORD_URL, headers=self.headers)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_entries_are_invalidated_on_delete(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        self.app.delete(RECORD_URL, headers=self.headers, status=204)
+        headers = self.headers.copy()
+        headers['If-None-Match'] = '"14377478425690"'
+        self.app.get(RECORD_URL, headers=headers, status=200)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_entries_are_invalidated_by_batched_writes(self):
+        self.app.get(RECORD_URL, headers=self.headers)
+        self.client.get_records.side_effect = lambda c, full, ids, **kw: ids
+        self.client.delete_records.return_value = {'modified': 14377478430.0}
+        record_id = RECORD_URL.rsplit('/', 1)[1]
+        other_url = RECORD_URL.replace(record_id, 'a'.zfill(12))
+        body = {'defaults': {'headers': self.headers, 'method': 'DELETE'},
+                'requests': [{'path': RECORD_URL}, {'path': other_url}]}
+        self.app.post_json('/batch', body, status=200)
+        headers = self.headers.copy()
+        headers['If-None-Match'] = '"14377478425690"'
+        self.app.get(RECORD_URL, headers=headers, status=200)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+
+class RecordMissingCacheTest(BaseViewTest):
+
+    def setUp(self):
+        super(RecordMissingCacheTest, self).setUp()
+        self.client = self.sync_client.return_value
+        response = mock.MagicMock(status_code=404)
+        self.client.get_record.side_effect = HTTPError(response=response)
+
+    def get_app_settings(self, extra=None):
+        settings = super(RecordMissingCacheTest, self).get_app_settings(extra)
+        settings['cache_records_missing_ttl_seconds'] = 10
+        return settings
+
+    def test_missing_records_are_not_read_again(self):
+        first = self.app.get(RECORD_URL, headers=self.headers, status=404)
+        second = self.app.get(RECORD_URL, headers=self.headers, status=404)
+        self.assertEqual(self.client.get_record.call_count, 1)
+        self.assertEqual(first.json['errno'], second.json['errno'])
+
+    def test_missing_records_are_not_shared_between_records(self):
+        self.app.get(RECORD_URL, headers=self.headers, status=404)
+        other_url = RECORD_URL.rsplit('/', 1)[0] + '/' + 'a'.zfill(12)
+        self.app.get(other_url, headers=self.headers, status=404)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_other_errors_are_not_cached(self):
+        response = mock.MagicMock(status_code=503)
+        self.client.get_record.side_effect = HTTPError(response=response)
+        self.app.get(RECORD_URL, headers=self.headers, status=503)
+        self.app.get(RECORD_URL, headers=self.headers, status=503)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_preconditions_are_checked_by_sync(self):
+        self.app.get(RECORD_URL, headers=self.headers, status=404)
+        headers = self.headers.copy()
+        headers['If-Match'] = '"14377478425690"'
+        self.app.get(RECORD_URL, headers=headers, status=404)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_entries_are_invalidated_on_put(self):
+        self.app.get(RECORD_URL, headers=self.headers, status=404)
+        self.app.put_json(RECORD_URL, {'data': {'payload': 'new'}},
+                          headers=self.headers)
+        self.app.get(RECORD_URL, headers=self.headers, status=404)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_records_missing_from_batches_are_cached(self):
+        self.client.get_records_by_ids.return_value = []
+        other_url = RECORD_URL.rsplit('/', 1)[0] + '/' + 'a'.zfill(12)
+        body = {'defaults': {'headers': self.headers, 'method': 'GET'},
+                'requests': [{'path': RECORD_URL}, {'path': other_url}]}
+        self.app.post_json('/batch', body, status=200)
+        self.app.get(RECORD_URL, headers=self.headers, status=404)
+        self.assertFalse(self.client.get_record.called)
+
+    def test_cache_can_be_disabled(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings,
+                             {'cache_records_missing_ttl_seconds': 0}):
+            self.app.get(RECORD_URL, headers=self.headers, status=404)
+            self.app.get(RECORD_URL, headers=self.headers, status=404)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+
+class RecordsTest(FormattedErrorMixin, BaseViewTest):
+
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(RecordsTest, self).setUp()
+        self.client = self.sync_client.return_value
+        self.client.clone.return_value = self.client
+        self.client.get_records.side_effect = lambda *a, **kw: [{
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ",
+            "modified": 14377478425.69
+        }]
+
+    def post(self, collections, status=200):
+        return self.app.post_json(RECORDS_URL, {'collections': collections},
+                                  headers=self.headers, status=status)
+
+    def test_records_handle_cors_headers(self):
+        resp = self.post([{'name': 'tabs'}])
+        self.assertIn('Access-Control-Allow-Origin', resp.headers)
+
+    def test_credentials_are_resolved_once(self):
+        self.post([{'name': 'tabs'}, {'name': 'history'}, {'name': 'meta'}])
+        self.assertEqual(self.sync_client.call_count, 1)
+        self.assertEqual(self.client.get_records.call_count, 3)
+
+    def test_records_are_returned_in_batch_format(self):
+        resp = self.post([{'name': 'tabs'}, {'name': 'history'}])
+        tabs, history = resp.json['responses']
+        self.assertEqual(tabs['status'], 200)
+        self.assertEqual(tabs['path'],
+                         '/v1/buckets/syncto/collections/tabs/records')
+        self.assertEqual(history['path'],
+                         '/v1/buckets/syncto/collections/history/records')
+        self.assertEqual(tabs['body'], {'data': [{
+            "id": "Y_-5-LEeQBuh60IT0MyWEQ",
+            "last_modified": 14377478425690}]})
+
+    def test_querystring_is_converted_for_each_collection(self):
+        resp = self.post([
+            {'name': 'tabs', 'querystring': {'_since': '14377478425700'}},
+            {'name': 'history', 'querystring': {'_limit': '2',
+                                                '_token': 'abc',
+                                                '_sort': 'newest'}}])
+        self.client.get_records.assert_any_call(
+            "tabs", full=True, newer='14377478425.70',
+            headers=_DEFAULT_SYNC_HEADERS)
+        self.client.get_records.assert_any_call(
+            "history", full=True, limit='2', offset='abc', sort='newest',
+            headers=_DEFAULT_SYNC_HEADERS)
+        self.assertEqual(
+            resp.json['responses'][1]['path'],
+            '/v1/buckets/syncto/collections/history/records'
+            '?_limit=2&_token=abc&_sort=newest')
+
+    def test_collection_headers_are_given_for_each_collection(self):
+        self.client.raw_resp.headers['X-Weave-Alert'] = 'Hey'
+        resp = self.post([{'name': 'tabs'},
+                          {'name': 'history', 'querystring': {'_limit': '1'}}])
+        tabs, history = resp.json['responses']
+        self.assertEqual(tabs['headers'], {
+            'Cache-Control': 'no-cache',
+            'ETag': '"14377478425690"',
+            'Last-Modified': 'Sat, 09 Aug 2425 00:00:25 GMT',
+            'Total-Records': '1',
+            'Quota-Remaining': '125',
+            'Alert': 'Hey',
+            'Next-Page': ('http://localhost/v1/buckets/syncto/collections/'
+                          'tabs/records?_token=12345')})
+        self.assertNotIn('Total-Records', history['headers'])
+        self.assertEqual(history['headers']['Next-Page'],
+                         'http://localhost/v1/buckets/syncto/collections/'
+                         'history/records?_limit=1&_token=12345')
+
+    def test_preconditions_are_not_forwarded(self):
+        self.headers['If-None-Match'] = '"14377478425690"'
+        self.post([{'name': 'tabs'}])
+        self.client.get_records.assert_called_with(
+            "tabs", full=True, headers=_DEFAULT_SYNC_HEADERS)
+
+    def test_invalid_querystring_is_reported_for_its_collection(self):
+        resp = self.post([{'name': 'tabs'},
+                          {'name': 'history',
+                           'querystring': {'_since': 'yesterday'}}],
+                         status=400)
+        self.assertEqual(resp.json['details'][0]['name'],
+                         'collections.1.querystring._since')
+        self.assertFalse(self.client.get_records.called)
+
+    def test_collection_names_are_validated(self):
+        self.post([{'name': '../info'}], status=400)
+        self.post([], status=400)
+
+    def test_number_of_collections_is_limited(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'batch_max_requests': 2}):
+            resp = self.post([{'name': 'tabs'}, {'name': 'history'},
+                              {'name': 'meta'}], status=400)
+        self.assertEqual(resp.json['details'][0]['name'], 'collections')
+
+    def test_sync_errors_are_given_for_their_collection(self):
+        def get_records(collection_name, **kwargs):
+            if collection_name == 'history':
+                response = mock.MagicMock(status_code=412, headers={})
+                raise HTTPError(response=response)
+            return []
+        self.client.get_records.side_effect = get_records
+        resp = self.post([{'name': 'tabs'}, {'name': 'history'}])
+        tabs, history = resp.json['responses']
+        self.assertEqual(tabs['status'], 200)
+        self.assertEqual(history['status'], 412)
+        self.assertEqual(history['path'],
+                         '/v1/buckets/syncto/collections/history/records')
+        self.assertEqual(history['body']['errno'], 114)
+
+    def test_unreachable_sync_is_given_for_each_collection(self):
+        self.client.get_records.side_effect = ConnectionError
+        resp = self.post([{'name': 'tabs'}, {'name': 'history'}])
+        statuses = [r['status'] for r in resp.json['responses']]
+        self.assertEqual(statuses, [503, 503])
+        self.assertIn('Retry-After', resp.json['responses'][0]['headers'])
+
+
+class BatchTest(BaseViewTest):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.client = self.sync_client.return_value
+        self.client.get_record.side_effect = lambda c, record_id, **kw: {
+            "id": record_id, "modified": 14377478425.69}
+
+        def get_records_by_ids(collection, ids, **kwargs):
+            return [{"id": record_id, "modified": 14377478400.0 + i}
+                    for i, record_id in enumerate(ids)
+                    if record_id != 'missing'.zfill(12)]
+        self.client.get_records_by_ids.side_effect = get_records_by_ids
+
+    def record_path(self, record_id, collection_name='tabs'):
+        return ('/buckets/syncto/collections/%s/records/%s' %
+                (collection_name, record_id.zfill(12)))
+
+    def batch(self, *requests, **kwargs):
+        body = {'defaults': {'headers': self.headers},
+                'requests': list(requests)}
+        return self.app.post_json('/batch', body,
+                                  status=kwargs.get('status', 200))
+
+    def test_responses_keep_the_subrequests_order(self):
+        ids = ['%012d' % i for i in range(10)]
+        resp = self.batch(*[{'path': self.record_path(i)} for i in ids])
+        self.assertEqual([r['body']['data']['id']
+                          for r in resp.json['responses']], ids)
+
+    def test_record_reads_are_fetched_at_once(self):
+        resp = self.batch({'path': self.record_path('a')},
+                          {'path': self.record_path('b')},
+                          {'path': self.record_path('a')})
+        self.client.get_records_by_ids.assert_called_once_with(
+            'tabs', ['a'.zfill(12), 'b'.zfill(12)], full=True,
+            headers=_DEFAULT_SYNC_HEADERS, chunk_size=100, max_workers=4)
+        self.assertFalse(self.client.get_record.called)
+        etags = [r['headers']['ETag'] for r in resp.json['responses']]
+        self.assertEqual(etags, ['"14377478400000"', '"14377478401000"',
+                                 '"14377478400000"'])
+        self.assertEqual(resp.json['responses'][1]['body']['data'], {
+            'id': 'b'.zfill(12), 'last_modified': 14377478401000})
+
+    def test_missing_records_of_a_batch_are_not_found(self):
+        resp = self.batch({'path': self.record_path('a')},
+                          {'path': self.record_path('missing')})
+        found, missing = resp.json['responses']
+        self.assertEqual(found['status'], 200)
+        self.assertEqual(missing['status'], 404)
+        self.assertEqual(missing['body']['errno'], 110)
+
+    def test_failed_reads_are_not_sent_again(self):
+        response = mock.MagicMock(status_code=401)
+        self.client.get_records_by_ids.side_effect = HTTPError(
+            response=response)
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_parallel_requests': 1}):
+            resp = self.batch({'path': self.record_path('a')},
+                              {'path': self.record_path('b')},
+                              {'path': self.record_path('c')})
+        statuses = [r['status'] for r in resp.json['responses']]
+        self.assertEqual(statuses, [401, 401, 401])
+        self.assertEqual(self.client.get_records_by_ids.call_count, 1)
+
+    def test_records_are_fetched_by_collection_and_credentials(self):
+        other_credentials = {'headers': {AUTHORIZATION_HEADER: 'BrowserID b',
+                                         CLIENT_STATE_HEADER: '1234'}}
+        self.batch({'path': self.record_path('a')},
+                   {'path': self.record_path('b')},
+                   {'path': self.record_path('c', 'history')},
+                   dict(other_credentials, path=self.record_path('d')))
+        self.client.get_records_by_ids.assert_called_once_with(
+            'tabs', ['a'.zfill(12), 'b'.zfill(12)], full=True,
+            headers=mock.ANY, chunk_size=mock.ANY, max_workers=mock.ANY)
+        self.assertEqual(self.client.get_record.call_count, 2)
+
+    def test_record_reads_with_preconditions_are_sent_one_by_one(self):
+        precondition = {'headers': {'If-None-Match': '"1234"'}}
+        self.batch({'path': self.record_path('a')},
+                   {'path': self.record_path('b')},
+                   dict(precondition, path=self.record_path('a')),
+                   dict(precondition, path=self.record_path('c')),
+                   {'path': self.record_path('c') + '?_fields=id'})
+        self.assertEqual(self.client.get_records_by_ids.call_count, 1)
+        self.assertEqual(self.client.get_record.call_count, 3)
+
+    def test_record_reads_are_not_fetched_across_writes(self):
+        reads = [{'path': self.record_path('a')},
+                 {'path': self.record_path('b')}]
+        write = {'path': RECORD_URL, 'method': 'PUT', 'body': RECORD_EXAMPLE}
+        self.batch(*(reads + [write] + reads))
+        self.assertEqual(self.client.get_records_by_ids.call_count, 2)
+
+    def test_batched_fetch_errors_are_mapped_for_each_record(self):
+        # Read by concurrent subrequests: no lazily created attributes.
+        response = mock.MagicMock(status_code=401, reason='Unauthorized',
+                                  text='', headers={})
+        self.client.get_records_by_ids.side_effect = HTTPError(
+            response=response)
+        resp = self.batch({'path': self.record_path('a')},
+                          {'path': self.record_path('b')})
+        statuses = [r['status'] for r in resp.json['responses']]
+        self.assertEqual(statuses, [401, 401])
+
+    def test_reads_are_run_concurrently(self):
+        calls = []
+        all_started = threading.Event()
+
+        def get_record(collection, record_id, **kwargs):
+            # Each read waits for the other one to have started.
+            calls.append(record_id)
+            if len(calls) == 2:
+                all_started.set()
+            return {"id": record_id, "modified": 14377478425.69,
+                    "concurrent": all_started.wait(5)}
+        self.client.get_record.side_effect = get_record
+
+        resp = self.batch({'path': RECORD_URL}, {'path': RECORD_URL})
+        for response in resp.json['responses']:
+            self.assertTrue(response['body']['data']['concurrent'])
+
+    def test_writes_are_run_one_at_a_time(self):
+        path = 'syncto.views.batch.run_concurrently'
+        with mock.patch(path, side_effect=run_concurrently) as mocked:
+            self.batch({'path': RECORD_URL},
+                       {'path': RECORD_URL, 'method': 'HEAD'},
+                       {'path': RECORD_URL, 'method': 'PUT',
+                        'body': RECORD_EXAMPLE},
+                       {'path': RECORD_URL, 'method': 'DELETE'},
+                       {'path': RECORD_URL})
+        self.assertEqual([len(c[0][0]) for c in mocked.call_args_list],
+                         [2, 1, 1, 1])
+
+    def test_sync_errors_are_mapped_for_each_subrequest(self):
+        response = mock.MagicMock(status_code=404)
+        self.client.get_record.side_effect = [
+            {"id": "abc", "modified": 14377478425.69},
+            HTTPError(response=response)]
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_parallel_requests': 1}):
+            resp = self.batch({'path': RECORD_URL}, {'path': RECORD_URL})
+        statuses = [r['status'] for r in resp.json['responses']]
+        self.assertEqual(statuses, [200, 404])
+        self.assertEqual(resp.json['responses'][1]['body']['errno'], 110)
+
+    def test_sync_server_errors_fail_the_batch(self):
+        response = mock.MagicMock(status_code=500)
+        self.client.get_record.side_effect = HTTPError(response=response)
+        self.batch({'path': RECORD_URL}, status=503)
+
+    def test_http_errors_are_returned_as_json(self):
+        resp = self.batch({'path': '/buckets/syncto/unknown'})
+        response, = resp.json['responses']
+        self.assertEqual(response['status'], 404)
+        self.assertEqual(response['body']['code'], 404)
+
+    def test_view_errors_are_returned(self):
+        path = '/buckets/syncto/collections/history/records/abc'
+        resp = self.batch({'path': path, 'method': 'DELETE'})
+        self.assertEqual(resp.json['responses'][0]['status'], 405)
+
+    def test_number_of_requests_is_limited(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'batch_max_requests': 1}):
+            self.batch({'path': RECORD_URL}, {'path': RECORD_URL},
+                       status=400)
+
+    def test_recursive_calls_are_forbidden(self):
+        self.batch({'path': '/batch'}, status=400)
+
+
+class BatchWriteTest(BaseViewTest):
+
+    def setUp(self):
+        super(BatchWriteTest, self).setUp()
+        self.client = self.sync_client.return_value
+
+        def post_records(collection, records, **kwargs):
+            return {'modified': 14377478430.0,
+                    'success': [r['id'] for r in records
+                                if r['payload'] != 'invalid'],
+                    'failed': {}}
+        self.client.post_records.side_effect = post_records
+
+    def put(self, record_id, collection_name='tabs', **kwargs):
+        path = ('/buckets/syncto/collections/%s/records/%s' %
+                (collection_name, record_id.zfill(12)))
+        request = {'method': 'PUT', 'path': path,
+                   'body': {'data': {'payload': kwargs.pop('payload', 'p')}}}
+        request.update(kwargs)
+        return request
+
+    def batch(self, *requests):
+        body = {'defaults': {'headers': self.headers},
+                'requests': list(requests)}
+        resp = self.app.post_json('/batch', body, status=200)
+        return resp.json['responses']
+
+    def test_record_writes_are_sent_at_once(self):
+        responses = self.batch(self.put('a'), self.put('b'), self.put('c'))
+        self.client.post_records.assert_called_once_with(
+            'tabs', [{'id': 'a'.zfill(12), 'payload': 'p'},
+                     {'id': 'b'.zfill(12), 'payload': 'p'},
+                     {'id': 'c'.zfill(12), 'payload': 'p'}],
+            headers=_DEFAULT_SYNC_HEADERS)
+        self.assertFalse(self.client.put_record.called)
+        self.assertEqual(responses[1]['status'], 200)
+        self.assertEqual(responses[1]['body']['data'], {
+            'id': 'b'.zfill(12), 'payload': 'p',
+            'last_modified': 14377478430000})
+        self.assertEqual(responses[1]['headers']['ETag'],
+                         '"14377478425690"')
+
+    def test_records_are_posted_by_chunks(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_post_records': 2}):
+            self.batch(self.put('a'), self.put('b'), self.put('c'))
+        self.assertEqual(self.client.post_records.call_count, 2)
+
+    def test_records_are_posted_by_chunks_of_bytes(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_post_bytes': 100}):
+            self.batch(self.put('a'), self.put('b'), self.put('c'))
+        calls = self.client.post_records.call_args_list
+        self.assertEqual([len(c[0][1]) for c in calls], [2, 1])
+
+    def test_records_larger_than_chunks_are_posted_alone(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_post_bytes': 10}):
+            self.batch(self.put('a'), self.put('b'))
+        self.assertEqual(self.client.post_records.call_count, 2)
+
+    def test_failed_writes_are_not_sent_again(self):
+        response = mock.MagicMock(status_code=400)
+        self.client.post_records.side_effect = HTTPError(response=response)
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_parallel_requests': 1}):
+            responses = self.batch(*[self.put(i) for i in 'abcdef'])
+        self.assertEqual([r['status'] for r in responses], [400] * 6)
+        self.assertEqual(self.client.post_records.call_count, 1)
+
+    def test_failed_chunks_only_fail_their_writes(self):
+        # Read by concurrent subrequests: no lazily created attributes.
+        response = mock.MagicMock(status_code=412, reason='Failed',
+                                  text='', headers={})
+        self.client.post_records.side_effect = [
+            {'modified': 14377478430.0,
+             'success': ['a'.zfill(12), 'b'.zfill(12)], 'failed': {}},
+            HTTPError(response=response),
+            {'modified': 14377478431.0,
+             'success': ['e'.zfill(12)], 'failed': {}}]
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_post_records': 2}):
+            responses = self.batch(*[self.put(i) for i in 'abcde'])
+        self.assertEqual([r['status'] for r in responses],
+                         [200, 200, 412, 412, 200])
+        self.assertEqual(self.client.post_records.call_count, 3)
+
+    def test_records_refused_by_sync_are_rejected(self):
+        self.client.post_records.side_effect = None
+        self.client.post_records.return_value = {
+            'modified': 14377478430.0,
+            'success': ['a'.zfill(12)],
+            'failed': {'b'.zfill(12): ['invalid ttl']}}
+        responses = self.batch(self.put('a'), self.put('b'), self.put('c'))
+        statuses = [r['status'] for r in responses]
+        self.assertEqual(statuses, [200, 400, 400])
+        self.assertIn('invalid ttl', responses[1]['body']['message'])
+        self.assertIn('unknown', responses[2]['body']['message'])
+
+    def test_writes_of_the_same_record_are_not_merged(self):
+        self.batch(self.put('a'), self.put('b'), self.put('a'))
+        self.assertEqual(self.client.post_records.call_count, 1)
+        self.assertEqual(self.client.put_record.call_count, 1)
+
+    def test_writes_with_preconditions_are_sent_one_by_one(self):
+        precondition = {'If-Match': '"14377478425690"'}
+        self.batch(self.put('a', headers=precondition),
+                   self.put('b', headers=precondition))
+        self.assertFalse(self.client.post_records.called)
+        put_headers = self.client.put_record.call_args[1]['headers']
+        self.assertEqual(put_headers['X-If-Unmodified-Since'],
+                         '14377478425.69')
+
+    def test_writes_of_disabled_collections_are_refused(self):
+        responses = self.batch(self.put('a', 'history'),
+                               self.put('b', 'history'))
+        self.assertEqual([r['status'] for r in responses], [405, 405])
+        self.assertFalse(self.client.post_records.called)
+
+    def test_invalid_records_are_refused(self):
+        invalid = self.put('a')
+        invalid['body'] = {'data': {'payload': 'p'}, 'foo': 'bar'}
+        responses = self.batch(invalid, self.put('b'), self.put('c'))
+        self.assertEqual(responses[0]['status'], 400)
+        self.client.post_records.assert_called_once_with(
+            'tabs', mock.ANY, headers=mock.ANY)
+
+    def test_sync_errors_are_mapped_for_each_record(self):
+        # Read by concurrent subrequests: no lazily created attributes.
+        response = mock.MagicMock(status_code=412, reason='Failed',
+                                  text='', headers={})
+        self.client.post_records.side_effect = HTTPError(response=response)
+        responses = self.batch(self.put('a'), self.put('b'))
+        self.assertEqual([r['status'] for r in responses], [412, 412])
+
+
+class BatchDeleteTest(BaseViewTest):
+
+    def setUp(self):
+        super(BatchDeleteTest, self).setUp()
+        self.client = self.sync_client.return_value
+        self.existing = ['a'.zfill(12), 'b'.zfill(12)]
+
+        def get_records(collection, full, ids, **kwargs):
+            return [i for i in ids if i in self.existing]
+        self.client.get_records.side_effect = get_records
+        self.client.delete_records.return_value = {'modified': 14377478430.0}
+
+    def delete(self, record_id, collection_name='tabs'):
+        path = ('/buckets/syncto/collections/%s/records/%s' %
+                (collection_name, record_id.zfill(12)))
+        return {'method': 'DELETE', 'path': path}
+
+    def batch(self, *requests):
+        body = {'defaults': {'headers': self.headers},
+                'requests': list(requests)}
+        resp = self.app.post_json('/batch', body, status=200)
+        return resp.json['responses']
+
+    def test_record_deletions_are_sent_at_once(self):
+        responses = self.batch(self.delete('a'), self.delete('b'))
+        self.client.delete_records.assert_called_once_with(
+            'tabs', ['a'.zfill(12), 'b'.zfill(12)],
+            headers=_DEFAULT_SYNC_HEADERS)
+        self.assertFalse(self.client.delete_record.called)
+        self.assertEqual([r['status'] for r in responses], [204, 204])
+
+    def test_deletions_of_unknown_records_are_rejected(self):
+        responses = self.batch(self.delete('a'), self.delete('c'))
+        self.client.delete_records.assert_called_once_with(
+            'tabs', ['a'.zfill(12)], headers=mock.ANY)
+        self.assertEqual([r['status'] for r in responses], [204, 404])
+
+    def test_deletions_of_the_same_record_are_not_merged(self):
+        self.batch(self.delete('a'), self.delete('b'), self.delete('a'))
+        self.assertEqual(self.client.delete_records.call_count, 1)
+        self.assertEqual(self.client.delete_record.call_count, 1)
+
+    def test_deletions_and_writes_are_not_merged(self):
+        put = {'method': 'PUT', 'path': RECORD_URL,
+               'body': {'data': {'payload': 'p'}}}
+        self.batch(self.delete('a'), put, self.delete('b'))
+        self.assertFalse(self.client.delete_records.called)
+        self.assertEqual(self.client.delete_record.call_count, 2)
+
+    def test_failed_deletions_are_not_sent_again(self):
+        # Read by concurrent subrequests: no lazily created attributes.
+        response = mock.MagicMock(status_code=412, reason='Failed',
+                                  text='', headers={})
+        self.client.delete_records.side_effect = HTTPError(response=response)
+        responses = self.batch(self.delete('a'), self.delete('b'))
+        self.assertEqual([r['status'] for r in responses], [412, 412])
+        self.assertEqual(self.client.delete_records.call_count, 1)
+        self.assertEqual(self.client.get_records.call_count, 1)
+
+    def test_deletions_of_disabled_collections_are_refused(self):
+        responses = self.batch(self.delete('a', 'history'),
+                               self.delete('b', 'history'))
+        self.assertEqual([r['status'] for r in responses], [405, 405])
+        self.assertFalse(self.client.delete_records.called)
+
+    def test_sync_errors_are_mapped_for_each_record(self):
+        # Read by concurrent subrequests: no lazily created attributes.
+        response = mock.MagicMock(status_code=412, reason='Failed',
+                                  text='', headers={})
+        self.client.delete_records.side_effect = HTTPError(response=response)
+        responses = self.batch(self.delete('a'), self.delete('b'))
+        self.assertEqual([r['status'] for r in responses], [412, 412])
+
+
+class CollectionDeleteTest(BaseViewTest):
+    patch_authent_for = 'collection'
+
+    def setUp(self):
+        super(CollectionDeleteTest, self).setUp()
+        self.client = self.sync_client.return_value
+        self.existing = ['abc', 'def', 'ghi']
+
+        def get_records(collection, full, ids, **kwargs):
+            return [i for i in ids if i in self.existing]
+        self.client.get_records.side_effect = get_records
+        self.client.delete_records.return_value = {'modified': 14377478430.0}
+
+    def test_records_are_deleted_with_one_sync_request(self):
+        resp = self.app.delete(COLLECTION_URL + '?in_ids=abc,def',
+                               headers=self.headers, status=200)
+        self.client.delete_records.assert_called_once_with(
+            'tabs', ['abc', 'def'], headers=_DEFAULT_SYNC_HEADERS)
+        self.assertEqual(resp.json['data'], [
+            {'id': 'abc', 'deleted': True, 'last_modified': 14377478425690},
+            {'id': 'def', 'deleted': True, 'last_modified': 14377478425690}])
+        self.assertEqual(resp.headers['ETag'], '"14377478425690"')
+
+    def test_only_existing_records_are_reported(self):
+        resp = self.app.delete(COLLECTION_URL + '?in_ids=abc,xyz',
+                               headers=self.headers, status=200)
+        self.client.delete_records.assert_called_once_with(
+            'tabs', ['abc'], headers=mock.ANY)
+        self.assertEqual([r['id'] for r in resp.json['data']], ['abc'])
+
+    def test_sync_is_not_called_if_no_record_exists(self):
+        resp = self.app.delete(COLLECTION_URL + '?in_ids=xyz',
+                               headers=self.headers, status=200)
+        self.assertFalse(self.client.delete_records.called)
+        self.assertEqual(resp.json['data'], [])
+
+    def test_records_are_deleted_by_chunks(self):
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {'sync_max_ids_per_request': 2}):
+            self.app.delete(COLLECTION_URL + '?in_ids=abc,def,ghi',
+                            headers=self.headers, status=200)
+        calls = self.client.delete_records.call_args_list
+        self.assertEqual([c[0][1] for c in calls], [['abc', 'def'], ['ghi']])
+
+    def test_precondition_is_updated_between_chunks(self):
+        settings = self.app.app.registry.settings
+        headers = self.headers.copy()
+        headers['If-Match'] = '"14377478425690"'
+        seen = []
+
+        def delete_records(collection, ids, headers):
+            seen.append(headers['X-If-Unmodified-Since'])
+            return {'modified': 14377478430.0}
+        self.client.delete_records.side_effect = delete_records
+        with mock.patch.dict(settings, {'sync_max_ids_per_request': 2}):
+            self.app.delete(COLLECTION_URL + '?in_ids=abc,def,ghi',
+                            headers=headers, status=200)
+        self.assertEqual(seen, ['14377478425.69', '14377478430.00'])
+
+    def test_in_ids_is_required(self):
+        resp = self.app.delete(COLLECTION_URL, headers=self.headers,
+                               status=400)
+        self.assertEqual(resp.json['errno'], ERRORS.INVALID_PARAMETERS)
+        self.assertEqual(resp.json['message'],
+                         "in_ids should list the records to delete.")
+
+    def test_other_querystring_parameters_are_rejected(self):
+        resp = self.app.delete(COLLECTION_URL + '?in_ids=abc&_since=123',
+                               headers=self.headers, status=400)
+        self.assertEqual(resp.json['details'][0]['name'], '_since')
+        self.assertFalse(self.client.delete_records.called)
+
+    def test_delete_is_disabled_with_record_deletions(self):
+        url = '/buckets/syncto/collections/history/records?in_ids=abc'
+        self.app.delete(url, headers=self.headers, status=405)
+
+    def test_collection_timestamps_are_invalidated(self):
+        with mock.patch('syncto.batching.'
+                        'invalidate_collections_timestamps') as mocked:
+            self.app.delete(COLLECTION_URL + '?in_ids=abc',
+                            headers=self.headers, status=200)
+        self.assertTrue(mocked.called)
+
+
 class RecordTest(BaseViewTest):
 
     def test_record_handle_cors_headers(self):
@@ -457,6 +1990,61 @@ class RecordTest(BaseViewTest):
         self.app.put_json(RECORD_URL, invalid, headers=self.headers,
                           status=400)
 
+    def test_put_record_reports_schema_errors(self):
+        invalid = {"data": {"payload": "foobar"}, "foo": "bar"}
+        resp = self.app.put_json(RECORD_URL + '?bar=baz', invalid,
+                                 headers=self.headers, status=400)
+        self.assertEqual(resp.json['errno'], ERRORS.INVALID_PARAMETERS)
+        self.assertEqual(sorted(e['name'] for e in resp.json['details']),
+                         ['bar', 'foo'])
+
+    def test_put_record_reports_invalid_json(self):
+        resp = self.app.put(RECORD_URL, '{"data": ', headers=self.headers,
+                            content_type='application/json', status=400)
+        self.assertIn('Invalid JSON', resp.json['message'])
+
+    def test_put_record_validates_sync_bodies_without_colander(self):
+        record = {"payload": "foobar", "sortindex": 2, "ttl": 300}
+        with mock.patch('syncto.views.record.'
+                        'validate_colander_schema') as mocked:
+            self.app.put_json(RECORD_URL, {'data': record},
+                              headers=self.headers, status=200)
+        self.assertFalse(mocked.called)
+        put_record = self.sync_client.return_value.put_record
+        sent = put_record.call_args[0][1]
+        for field in ('payload', 'sortindex', 'ttl'):
+            self.assertEqual(sent[field], record[field])
+
+    def test_put_record_rejects_large_bodies(self):
+        settings = self.app.app.registry.settings
+        record = {"data": {"payload": "x" * 100}}
+        with mock.patch.dict(settings, {'record_put_max_body_bytes': 100}):
+            resp = self.app.put_json(RECORD_URL, record, headers=self.headers,
+                                     status=413)
+        self.assertEqual(resp.json['errno'], ERRORS.REQUEST_TOO_LARGE)
+        self.assertFalse(self.sync_client.return_value.put_record.called)
+
+    def test_large_bodies_are_not_batched(self):
+        settings = self.app.app.registry.settings
+        record_url = RECORD_URL.rsplit('/', 1)[0] + '/%s'
+        body = {'defaults': {'headers': self.headers, 'method': 'PUT',
+                             'body': {'data': {'payload': 'x' * 100}}},
+                'requests': [{'path': record_url % 'a'.zfill(12)},
+                             {'path': record_url % 'b'.zfill(12)}]}
+        with mock.patch.dict(settings, {'record_put_max_body_bytes': 100}):
+            resp = self.app.post_json('/batch', body, status=200)
+        statuses = [r['status'] for r in resp.json['responses']]
+        self.assertEqual(statuses, [413, 413])
+        self.assertFalse(self.sync_client.return_value.post_records.called)
+
+    def test_body_size_is_read_without_content_length(self):
+        request = Request.blank('/', method='PUT', body=b'{"data": {}}')
+        del request.content_length
+        request.is_body_readable = True
+        # Views are only imported once the application is configured.
+        from syncto.views.record import _body_size
+        self.assertEqual(_body_size(request), 12)
+
     def test_put_return_a_503_in_case_of_unknown_error(self):
         response = mock.MagicMock()
         response.status_code = 500
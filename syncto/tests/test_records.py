@@ -0,0 +1,45 @@
+import json
+
+from syncto.records import rewrite_records_body
+from syncto.tests.support import unittest
+
+
+class RewriteRecordsBodyTest(unittest.TestCase):
+
+    def rewrite(self, records):
+        body = json.dumps(records).encode('utf-8')
+        return json.loads(rewrite_records_body(body).decode('utf-8'))
+
+    def test_records_are_wrapped_in_data(self):
+        self.assertEqual(rewrite_records_body(b'[]'), b'{"data":[]}')
+
+    def test_modified_is_converted_to_last_modified(self):
+        rewritten = self.rewrite([{"id": "abc", "modified": 1454000000.12},
+                                  {"id": "def", "modified": 1454000001}])
+        self.assertEqual(rewritten, {"data": [
+            {"id": "abc", "last_modified": 1454000000120},
+            {"id": "def", "last_modified": 1454000001000}]})
+
+    def test_whitespace_around_values_is_supported(self):
+        body = b' [{"id" : "abc" ,\n "modified" :\t1454000000.12}]'
+        self.assertEqual(rewrite_records_body(body),
+                         b'{"data": [{"id" : "abc" ,\n '
+                         b'"last_modified":1454000000120}]}')
+
+    def test_other_fields_are_copied_untouched(self):
+        payload = json.dumps({"ciphertext": "a\\\"b", "modified": 12})
+        body = json.dumps([{"id": "abc", "payload": payload, "ttl": 5,
+                            "modified": 1.5}]).encode('utf-8')
+        rewritten = rewrite_records_body(body)
+        self.assertIn(json.dumps(payload).encode('utf-8'), rewritten)
+        self.assertEqual(json.loads(rewritten.decode('utf-8')), {"data": [
+            {"id": "abc", "payload": payload, "ttl": 5,
+             "last_modified": 1500}]})
+
+    def test_keys_ending_with_modified_are_not_converted(self):
+        rewritten = self.rewrite([{'x"modified': 1, "modified": 1}])
+        self.assertEqual(rewritten, {"data": [
+            {'x"modified': 1, "last_modified": 1000}]})
+
+    def test_raises_if_body_is_not_an_array(self):
+        self.assertRaises(ValueError, rewrite_records_body, b'{"data": []}')
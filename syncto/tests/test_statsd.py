@@ -7,9 +7,11 @@ from requests.exceptions import HTTPError
 
 from syncto import AUTHORIZATION_HEADER, CLIENT_STATE_HEADER
 from syncto.authentication import build_sync_client
+from syncto.cache import LRUCache, SingleFlight
+from syncto.client import CircuitBreaker, CircuitOpenError
 from syncto.tests.support import unittest, ENCRYPTED_CREDENTIALS
 from syncto.views import collection, record
-from syncto.views.errors import response_error
+from syncto.views.errors import response_error, request_error
 
 COLLECTION_URL = "/buckets/syncto/collections/tabs/records"
 
@@ -24,6 +26,7 @@ class StatsdTestMixin(object):
         self.addCleanup(p.stop)
 
         self.request = DummyRequest()
+        self.request.bound_data = {}
         self.request.matchdict = {
             'bucket_id': 'syncto',
             'collection_name': 'tabs'
@@ -31,7 +34,22 @@ class StatsdTestMixin(object):
         self.request.registry.settings.update({
             'cache_hmac_secret': 'This is not a secret',
             'cache_credentials_ttl_seconds': 300,
-            'token_server_url': 'https://token.services.mozilla.com/'})
+            'cache_credentials_lock_ttl_seconds': 10,
+            'cache_credentials_refresh_ratio': 0,
+            'cache_credentials_ttl_jitter_ratio': 0,
+            'cache_credentials_error_ttl_seconds': 30,
+            'cache_info_collections_ttl_seconds': 10,
+            'cache_collection_pages_ttl_seconds': 0,
+            'cache_collection_snapshots_ttl_seconds': 0,
+            'cache_prefetched_pages_ttl_seconds': 0,
+            'cache_records_ttl_seconds': 0,
+            'cache_records_missing_ttl_seconds': 0,
+            'sync_max_ids_per_request': 100,
+            'token_server_url': 'https://token.services.mozilla.com/',
+            'certificate_ca_bundle': None,
+            'collection_get_streaming_enabled': False,
+            'collection_get_passthrough_enabled': False,
+            'collection_get_ids_only_enabled': False})
         self.request.headers = {AUTHORIZATION_HEADER: 'Browserid 1234',
                                 CLIENT_STATE_HEADER: '12345'}
         self.request.response.headers = {'Content-Type': 'application/json'}
@@ -39,6 +57,9 @@ class StatsdTestMixin(object):
         self.request.registry.cache = Cache()
         self.request.registry.cache.flush()
         self.request.registry.statsd = self.client
+        self.request.registry.credentials_cache = LRUCache()
+        self.request.registry.tokenserver_flights = SingleFlight()
+        self.request.registry.tokenserver_breaker = CircuitBreaker()
 
 
 @unittest.skipIf(not statsd.statsd_module, "statsd is not installed.")
@@ -64,6 +85,33 @@ class StatsdSyncClientTest(StatsdTestMixin, unittest.TestCase):
                 self.mocked_client.timer.assert_any_call(
                     'tokenserver.tokenserverclient.get_hawk_credentials')
 
+    def test_statsd_counts_credentials_cache_hits_and_misses(self):
+        with mock.patch('requests.request'):
+            self.mocked_client.timer()().return_value = self.credentials
+            with mock.patch('syncto.authentication.SyncClient'):
+                build_sync_client(self.request)
+                self.mocked_client.incr.assert_called_with(
+                    "credentials_cache.miss", count=1)
+                build_sync_client(self.request)
+                self.mocked_client.incr.assert_called_with(
+                    "credentials_cache.hit", count=1)
+
+    def test_statsd_counts_credentials_secret_rotation(self):
+        settings = self.request.registry.settings
+        settings['cache_hmac_secret'] = ['New secret', 'This is not a secret']
+        cache = self.request.registry.cache
+        cache.set('credentials_636130e072155efd00d8e27196500'
+                  'd29110fb2e8e93bcedb2a30e0aa0e5ccf61',
+                  ENCRYPTED_CREDENTIALS, 300)
+        with mock.patch('syncto.authentication.SyncClient'):
+            build_sync_client(self.request)
+            self.mocked_client.incr.assert_any_call(
+                "credentials_cache.rotation.migrated", count=1)
+            self.request.registry.credentials_cache.flush()
+            build_sync_client(self.request)
+            self.mocked_client.incr.assert_any_call(
+                "credentials_cache.rotation.current", count=1)
+
     def test_statsd_time_sync_client_calls(self):
         with mock.patch.object(
                 self.request.registry.cache, 'get',
@@ -179,6 +227,7 @@ class StatsdSuccessStatusCodeTest(StatsdTestMixin, unittest.TestCase):
 
             build_mock.return_value._authenticate.return_value = None
             build_mock.return_value.get_records.return_value = {}
+            build_mock.return_value.api_endpoint = 'http://example.org/'
 
             self.request.matchdict['collection_name'] = 'history'
             self.request.matchdict['record_id'] = '1234'
@@ -198,6 +247,7 @@ class StatsdSuccessStatusCodeTest(StatsdTestMixin, unittest.TestCase):
 
             build_mock.return_value._authenticate.return_value = None
             build_mock.return_value.get_records.return_value = {}
+            build_mock.return_value.api_endpoint = 'http://example.org/'
 
             self.request.matchdict['collection_name'] = 'history'
             self.request.matchdict['record_id'] = '1234'
@@ -211,3 +261,10 @@ class StatsdSuccessStatusCodeTest(StatsdTestMixin, unittest.TestCase):
 
             self.mocked_client.incr.assert_called_with(
                 "syncclient.status_code.204", count=1)
+
+    def test_request_error_counts_open_circuit_in_statsd(self):
+        self.request.registry.settings['retry_after_seconds'] = 30
+        response = request_error(CircuitOpenError(12), self.request)
+        self.mocked_client.incr.assert_called_with(
+            "tokenserver.circuit_open", count=1)
+        self.assertEqual(response.headers['Retry-After'], '12')
@@ -0,0 +1,132 @@
+from pyramid import httpexceptions
+from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.view import render_view_to_response
+
+from cliquet import errors
+from cliquet import logger
+from cliquet import Service
+from cliquet.utils import build_request, build_response
+from cliquet.views.batch import BatchPayloadSchema
+
+from syncto.batching import (plan_record_batches, RecordDeleteBatch,
+                             RecordWriteBatch)
+from syncto.client import run_concurrently
+from syncto.views.record import record, get_batched_write
+
+# Subrequests that can run concurrently with their neighbours.
+CONCURRENT_METHODS = ('GET', 'HEAD')
+
+# Batches of the record writes sent to Sync together, by method.
+WRITE_BATCHES = {'PUT': RecordWriteBatch, 'DELETE': RecordDeleteBatch}
+
+
+batch = Service(name="batch", path='/batch',
+                description="Batch operations")
+
+
+@batch.post(schema=BatchPayloadSchema, permission=NO_PERMISSION_REQUIRED)
+def post_batch(request):
+    """Same as the cliquet batch endpoint, except that consecutive reads are
+    run concurrently, up to ``sync_max_parallel_requests`` at a time, and
+    share their Sync clients. Their reads of records of the same collection
+    are fetched with a single Sync request.
+
+    Consecutive writes of records of the same collection are sent with a
+    single Sync ``POST``, and consecutive deletions with a single Sync
+    ``DELETE``. Other writes are run one at a time, in order.
+    """
+    settings = request.registry.settings
+    requests = request.validated['requests']
+    batch_size = len(requests)
+
+    limit = settings['batch_max_requests']
+    if limit and len(requests) > int(limit):
+        error_msg = 'Number of requests is limited to %s' % limit
+        request.errors.add('body', 'requests', error_msg)
+        return
+
+    if any([batch.path in req['path'] for req in requests]):
+        error_msg = 'Recursive call on %s endpoint is forbidden.' % batch.path
+        request.errors.add('body', 'requests', error_msg)
+        return
+
+    # Shared with the subrequests, see ``build_sync_client()``.
+    request.bound_data['sync_clients'] = {}
+
+    subrequests = [build_request(request, subrequest_spec)
+                   for subrequest_spec in requests]
+
+    # Consecutive reads are run concurrently, as well as consecutive writes
+    # of different records of the same collection.
+    groups = []
+    for subrequest in subrequests:
+        batched_write = get_batched_write(request, subrequest)
+        kind = None
+        if subrequest.method in CONCURRENT_METHODS:
+            kind = 'read'
+        elif batched_write is not None:
+            kind = batched_write[0]
+
+        group = groups[-1] if groups else None
+        joins = kind is not None and group and group['kind'] == kind
+        if joins and batched_write is not None:
+            joins = batched_write[1] not in group['writes'].records
+        if not joins:
+            write_batch = WRITE_BATCHES.get(subrequest.method,
+                                            RecordWriteBatch)
+            group = {'kind': kind, 'subrequests': [],
+                     'writes': write_batch()}
+            groups.append(group)
+        group['subrequests'].append(subrequest)
+        if batched_write is not None:
+            group['writes'].records[batched_write[1]] = batched_write[2]
+
+    max_workers = int(settings['sync_max_parallel_requests'])
+    responses = []
+    for group in groups:
+        # Records read or written by the same group are sent at once.
+        request.bound_data['record_batches'] = plan_record_batches(
+            request, group['subrequests'], route_name=record.name)
+        record_writes = {}
+        if len(group['writes'].records) > 1:
+            record_writes[group['kind']] = group['writes']
+        request.bound_data['record_writes'] = record_writes
+
+        calls = [(_run_subrequest, request, subrequest)
+                 for subrequest in group['subrequests']]
+        responses.extend(run_concurrently(calls, max_workers=max_workers))
+
+    # Rebind batch request for summary
+    logger.bind(path=batch.path,
+                method=request.method,
+                batch_size=batch_size,
+                agent=request.headers.get('User-Agent'),)
+
+    return {
+        'responses': responses
+    }
+
+
+def _run_subrequest(request, subrequest):
+    sublogger = logger.new()
+    sublogger.bind(path=subrequest.path,
+                   method=subrequest.method)
+    try:
+        # Invoke subrequest without individual transaction.
+        resp, subrequest = request.follow_subrequest(subrequest,
+                                                     use_tweens=False)
+    except httpexceptions.HTTPException as e:
+        if e.content_type == 'application/json':
+            resp = e
+        else:
+            # JSONify raw Pyramid errors.
+            resp = errors.http_error(e)
+    except Exception as e:
+        resp = render_view_to_response(e, subrequest)
+        if resp.status_code >= 500:
+            raise e
+
+    sublogger.bind(code=resp.status_code)
+    sublogger.info('subrequest.summary')
+
+    return build_response(resp, subrequest)
@@ -1,11 +1,31 @@
+from collections import OrderedDict
+
+import colander
+from pyramid.interfaces import IRoutesMapper
+from pyramid.request import Request
+from pyramid.response import Response
 from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.settings import asbool
+from requests.exceptions import HTTPError, RequestException
 
 from cliquet import Service
 from cliquet.statsd import statsd_count
 from cliquet.errors import raise_invalid
+from cliquet.utils import build_response, json_serializer
+from cliquet.views.batch import string_values
 
 from syncto.authentication import build_sync_client
+from syncto.batching import delete_records
+from syncto.client import run_concurrently
 from syncto.headers import import_headers, export_headers
+from syncto.info_collections import get_not_modified_response
+from syncto.page_cache import get_page_cache_key, get_cached_page, cache_page
+from syncto.prefetch import (get_prefetch_key, get_prefetched_page,
+                             prefetch_next_page)
+from syncto.records import rewrite_records_body
+from syncto.snapshots import get_snapshot_records
+from syncto.views.errors import response_error, request_error
+from syncto.views.record import assert_endpoint_enabled
 
 
 collection = Service(name='collection',
@@ -15,6 +35,30 @@ collection = Service(name='collection',
                      cors_headers=('Next-Page', 'Total-Records',
                                    'Last-Modified', 'ETag', 'Quota-Remaining'))
 
+records = Service(name='records',
+                  description='Firefox Sync records of several collections',
+                  path='/buckets/{bucket_id}/records')
+
+# Streamed bodies are sent by chunks of at least this size.
+STREAM_BODY_CHUNK_SIZE = 16 * 1024
+
+SYNC_COLLECTION_FORMAT = r'^[a-zA-Z0-9._-]{1,32}$'
+
+
+class CollectionQuerySchema(colander.MappingSchema):
+    name = colander.SchemaNode(colander.String(),
+                               validator=colander.Regex(
+                                   SYNC_COLLECTION_FORMAT))
+    querystring = colander.SchemaNode(colander.Mapping(unknown='preserve'),
+                                      validator=string_values,
+                                      missing=colander.drop)
+
+
+class RecordsPayloadSchema(colander.MappingSchema):
+    collections = colander.SchemaNode(colander.Sequence(),
+                                      CollectionQuerySchema(),
+                                      validator=colander.Length(min=1))
+
 
 @collection.get(permission=NO_PERMISSION_REQUIRED)
 def collection_get(request):
@@ -22,58 +66,357 @@ def collection_get(request):
     sync_client = build_sync_client(request)
 
     headers = import_headers(request)
+    # Invalid parameters are reported even for unmodified collections.
+    params = _get_sync_params(request, request.GET)
+
+    not_modified = get_not_modified_response(request, sync_client,
+                                             collection_name, headers)
+    if not_modified is not None:
+        return not_modified
 
+    fields = None
+    if request.GET.get('_fields'):
+        fields = [field.strip() for field in
+                  request.GET['_fields'].split(',') if field.strip()]
+
+    settings = request.registry.settings
+    # Sync can list the records ids only, without their timestamps: unlike
+    # other projections, records have no ``last_modified`` field then.
+    ids_only = (fields is not None and set(fields) == set(['id']) and
+                asbool(settings['collection_get_ids_only_enabled']))
+
+    # Large lookups are split, unless paginated.
+    max_ids = int(settings['sync_max_ids_per_request'])
+    is_paginated = 'limit' in params or 'offset' in params
+    chunked = len(params.get('ids', [])) > max_ids and not is_paginated
+
+    streaming = asbool(settings['collection_get_streaming_enabled'])
+    streaming = streaming and not ids_only and not chunked
+    passthrough = asbool(settings['collection_get_passthrough_enabled'])
+    passthrough = passthrough and not fields and not chunked
+
+    # Streamed pages are not cached, since they are not kept in memory.
+    page_cache_key = None
+    if not streaming:
+        cache_params = params.copy()
+        if fields:
+            cache_params['fields'] = sorted(fields)
+        page_cache_key = get_page_cache_key(request, sync_client,
+                                            collection_name, cache_params,
+                                            headers)
+    if page_cache_key is not None:
+        cached_page = get_cached_page(request, sync_client, page_cache_key)
+        if cached_page is not None:
+            sync_response, body = cached_page
+            _export_headers(sync_response, request)
+            return _body_response(request, body)
+
+    body = None
+    sync_response = None
+    if 'offset' in params:
+        prefetch_key = get_prefetch_key(request, sync_client,
+                                        collection_name, params,
+                                        not ids_only, headers)
+        if prefetch_key is not None:
+            prefetched = get_prefetched_page(request, sync_client,
+                                             prefetch_key)
+            if prefetched is not None:
+                sync_response, records = prefetched
+                streaming = passthrough = False
+
+    if sync_response is None and not streaming and not ids_only:
+        snapshot = get_snapshot_records(request, sync_client,
+                                        collection_name, params, headers)
+        if snapshot is not None:
+            sync_response, records = snapshot
+
+    if sync_response is None:
+        if streaming:
+            records = sync_client.stream_records(collection_name,
+                                                 headers=headers, **params)
+        elif passthrough:
+            body = sync_client.get_raw_records(collection_name,
+                                               headers=headers, **params)
+            body = rewrite_records_body(body)
+        else:
+            records = _get_records(request, sync_client, collection_name,
+                                   headers, params, full=not ids_only,
+                                   chunked=chunked)
+        sync_response = sync_client.raw_resp
+        statsd_count(request, "syncclient.status_code.200")
+
+    prefetch_next_page(request, sync_client, collection_name, params,
+                       not ids_only, headers, sync_response)
+
+    if ids_only:
+        records = [{'id': record_id} for record_id in records]
+    elif body is None and not streaming:
+        for r in records:
+            _convert_record(r)
+        if fields:
+            records = [_filter_fields(r, fields) for r in records]
+
+    # Configure headers
+    _export_headers(sync_response, request)
+
+    if streaming:
+        response = request.response
+        response.content_type = 'application/json'
+        response.app_iter = _stream_records_body(records, fields)
+        return response
+
+    if page_cache_key is None:
+        if body is not None:
+            return _body_response(request, body)
+        return {'data': records or []}
+
+    if body is None:
+        body = json_serializer({'data': records or []}).encode('utf-8')
+    cache_page(request, sync_client, page_cache_key, sync_response, body)
+    return _body_response(request, body)
+
+
+@collection.delete(permission=NO_PERMISSION_REQUIRED)
+def collection_delete(request):
+    """Delete the records listed with ``in_ids``, with one Sync ``DELETE``
+    per chunk of ``sync_max_ids_per_request`` ids.
+    """
+    collection_name = request.matchdict['collection_name']
+
+    assert_endpoint_enabled(request, collection_name)
+
+    # Filters and pagination do not apply to deletions.
+    for param in sorted(set(request.GET) - set(['in_ids'])):
+        error_msg = '%s is not supported when deleting records.' % param
+        raise_invalid(request, location='querystring', name=param,
+                      description=error_msg)
+
+    # Deleting a whole collection is not supported.
+    ids = _get_sync_params(request, request.GET).get('ids')
+    if not ids:
+        error_msg = 'in_ids should list the records to delete.'
+        raise_invalid(request, location='querystring', name='in_ids',
+                      description=error_msg)
+
+    headers = import_headers(request)
+    sync_client = build_sync_client(request)
+    deleted, sync_response = delete_records(request, sync_client,
+                                            collection_name, ids, headers)
+
+    # Sync gives the new timestamp of the collection.
+    export_headers(sync_response, request)
+    last_modified = int(float(sync_response.headers['X-Last-Modified']) * 1000)
+
+    statsd_count(request, "syncclient.status_code.200")
+
+    return {'data': [{'id': record_id, 'deleted': True,
+                      'last_modified': last_modified}
+                     for record_id in deleted]}
+
+
+@records.post(permission=NO_PERMISSION_REQUIRED, schema=RecordsPayloadSchema)
+def records_post(request):
+    """Read the records of several collections with the same credentials,
+    fetching them concurrently from Sync.
+
+    The responses are given in the format of the batch endpoint.
+    """
+    settings = request.registry.settings
+    queries = request.validated['collections']
+
+    limit = settings['batch_max_requests']
+    if limit and len(queries) > int(limit):
+        error_msg = 'Number of collections is limited to %s' % limit
+        raise_invalid(request, location='body', name='collections',
+                      description=error_msg)
+
+    sync_client = build_sync_client(request)
+    # Preconditions only apply to single collections.
+    headers = {'User-Agent': import_headers(request)['User-Agent']}
+
+    calls = []
+    for i, query in enumerate(queries):
+        params = _get_sync_params(request, query.get('querystring', {}),
+                                  location='body',
+                                  prefix='collections.%s.querystring.' % i)
+        calls.append((_fetch_collection, sync_client.clone(), query['name'],
+                      params, headers))
+    max_workers = int(settings['sync_max_parallel_requests'])
+    results = run_concurrently(calls, max_workers=max_workers)
+
+    responses = []
+    for query, (sync_response, records) in zip(queries, results):
+        subrequest = _collection_subrequest(request, query['name'],
+                                            query.get('querystring', {}))
+        if records is None:
+            # Each collection gets its own error, as with the batch endpoint.
+            error_view = (response_error if isinstance(sync_response,
+                                                       HTTPError)
+                          else request_error)
+            response = build_response(error_view(sync_response, subrequest),
+                                      subrequest)
+            response['path'] = subrequest.path_qs
+            responses.append(response)
+            continue
+
+        statsd_count(request, "syncclient.status_code.200")
+        _export_headers(sync_response, subrequest)
+        headers = dict(subrequest.response.headers)
+        # The body is only serialized with the whole response, and WebOb
+        # gives a default HTML content type to the empty one.
+        headers.pop('Content-Length', None)
+        headers.pop('Content-Type', None)
+        responses.append({
+            'path': subrequest.path_qs,
+            'status': 200,
+            'headers': headers,
+            'body': {'data': records}
+        })
+    return {'responses': responses}
+
+
+def _fetch_collection(sync_client, collection_name, params, headers):
+    """Return the Sync response along with the records, or the error
+    instead of the response and ``None`` instead of the records.
+    """
+    try:
+        records = sync_client.get_records(collection_name, full=True,
+                                          headers=headers, **params)
+    except RequestException as e:
+        return e, None
+    records = [_convert_record(r) for r in records]
+    return sync_client.raw_resp, records
+
+
+def _collection_subrequest(request, collection_name, querystring):
+    """Build the request of a single collection, in order to convert its
+    Sync response with :func:`syncto.headers.export_headers` or the views of
+    :mod:`syncto.views.errors`.
+    """
+    matchdict = {'bucket_id': request.matchdict['bucket_id'],
+                 'collection_name': collection_name}
+    path = request.route_path(collection.name, _query=querystring,
+                              **matchdict)
+    subrequest = Request.blank(path, base_url=request.application_url)
+    subrequest.registry = request.registry
+    subrequest.matchdict = matchdict
+    mapper = request.registry.getUtility(IRoutesMapper)
+    subrequest.matched_route = mapper.get_route(collection.name)
+    subrequest.response = Response(headerlist=[])
+    # Set by Cornice, used when reapplying CORS on errors.
+    subrequest.info = {}
+    return subrequest
+
+
+def _get_sync_params(request, querystring, location='querystring',
+                     prefix=''):
+    """Convert the Kinto `querystring` parameters into Sync parameters.
+
+    Invalid values are reported at the `location` of the request, under
+    their name preceded with `prefix`.
+    """
     params = {}
-    if '_since' in request.GET:
+    if '_since' in querystring:
         try:
-            params['newer'] = '%.2f' % (int(request.GET['_since']) / 1000.0)
+            params['newer'] = '%.2f' % (int(querystring['_since']) / 1000.0)
         except ValueError:
             error_msg = ("_since should be a number.")
             raise_invalid(request,
-                          location="querystring",
-                          name="_since",
+                          location=location,
+                          name=prefix + '_since',
                           description=error_msg)
 
-    if '_limit' in request.GET:
-        params['limit'] = request.GET['_limit']
+    if '_limit' in querystring:
+        params['limit'] = querystring['_limit']
 
-    if '_token' in request.GET:
-        params['offset'] = request.GET['_token']
+    if '_token' in querystring:
+        params['offset'] = querystring['_token']
 
-    if '_sort' in request.GET:
-        if request.GET['_sort'] in ('-last_modified', 'newest'):
+    if '_sort' in querystring:
+        if querystring['_sort'] in ('-last_modified', 'newest'):
             params['sort'] = 'newest'
 
-        elif request.GET['_sort'] in ('-sortindex', 'index'):
+        elif querystring['_sort'] in ('-sortindex', 'index'):
             params['sort'] = 'index'
 
-        elif request.GET['_sort'] in ('last_modified', 'oldest'):
+        elif querystring['_sort'] in ('last_modified', 'oldest'):
             params['sort'] = 'oldest'
 
         else:
             error_msg = ("_sort should be one of ('-last_modified', 'newest', "
                          "'-sortindex', 'index', 'last_modified', 'oldest')")
             raise_invalid(request,
-                          location="querystring",
-                          name="_sort",
+                          location=location,
+                          name=prefix + '_sort',
                           description=error_msg)
 
-    if 'in_ids' in request.GET:
-        params['ids'] = [record_id.strip() for record_id in
-                         request.GET['in_ids'].split(',') if record_id]
+    if 'in_ids' in querystring:
+        ids = [record_id.strip() for record_id in
+               querystring['in_ids'].split(',') if record_id]
+        params['ids'] = list(OrderedDict.fromkeys(ids))
 
-    records = sync_client.get_records(collection_name, full=True,
-                                      headers=headers, **params)
+    return params
 
-    statsd_count(request, "syncclient.status_code.200")
 
-    for r in records:
-        r['last_modified'] = int(r.pop('modified') * 1000)
+def _get_records(request, sync_client, collection_name, headers, params,
+                 full, chunked):
+    if not chunked:
+        return sync_client.get_records(collection_name, full=full,
+                                       headers=headers, **params)
 
-    # Configure headers
-    export_headers(sync_client.raw_resp, request)
+    settings = request.registry.settings
+    params = params.copy()
+    ids = params.pop('ids')
+    return sync_client.get_records_by_ids(
+        collection_name, ids, full=full, headers=headers,
+        chunk_size=int(settings['sync_max_ids_per_request']),
+        max_workers=int(settings['sync_max_parallel_requests']),
+        **params)
+
+
+def _export_headers(sync_response, request):
+    export_headers(sync_response, request)
 
     if '_limit' in request.GET and 'Total-Records' in request.response.headers:
         del request.response.headers['Total-Records']
 
-    return {'data': records or []}
+
+def _body_response(request, body):
+    response = request.response
+    response.content_type = 'application/json'
+    response.body = body
+    return response
+
+
+def _convert_record(record):
+    record['last_modified'] = int(record.pop('modified') * 1000)
+    return record
+
+
+def _filter_fields(record, fields):
+    """Keep the `fields` of the record, along with its id and timestamp.
+
+    Not used for ``_fields=id`` when only the ids are listed by Sync.
+    """
+    fields = set(fields) | set(['id', 'last_modified'])
+    return dict((k, v) for k, v in record.items() if k in fields)
+
+
+def _stream_records_body(records, fields=None):
+    """Render ``{"data": [...]}`` by chunks, converting records one at a
+    time as they are read from the Sync response.
+    """
+    chunk = ['{"data":[']
+    size = 0
+    for i, record in enumerate(records):
+        record = _convert_record(record)
+        if fields:
+            record = _filter_fields(record, fields)
+        serialized = json_serializer(record)
+        chunk.append(',' + serialized if i else serialized)
+        size += len(serialized)
+        if size >= STREAM_BODY_CHUNK_SIZE:
+            yield ''.join(chunk).encode('utf-8')
+            chunk, size = [], 0
+    chunk.append(']}')
+    yield ''.join(chunk).encode('utf-8')
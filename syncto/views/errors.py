@@ -9,6 +9,7 @@ from cliquet.statsd import statsd_count
 from cliquet.utils import reapply_cors
 from cliquet.views.errors import service_unavailable
 
+from syncto.client import CircuitOpenError
 from syncto.headers import export_headers
 
 
@@ -69,6 +70,17 @@ def response_error(context, request):
 @view_config(context=RequestException, permission=NO_PERMISSION_REQUIRED)
 def request_error(context, request):
     """Catch requests errors when issuing a request to Sync."""
+    if isinstance(context, CircuitOpenError):
+        # The service was not called.
+        statsd_count(request, "tokenserver.circuit_open")
+        error_msg = "Service temporary unavailable, please retry later."
+        response = http_error(httpexceptions.HTTPServiceUnavailable(),
+                              errno=ERRORS.BACKEND,
+                              message=error_msg)
+        response = service_unavailable(response, request)
+        response.headers['Retry-After'] = str(context.retry_after)
+        return response
+
     logger.error(context, exc_info=True)
 
     error_msg = ("Unable to reach the service. "
@@ -3,12 +3,22 @@ import re
 import colander
 from pyramid import httpexceptions
 from pyramid.security import NO_PERMISSION_REQUIRED
+from requests.exceptions import HTTPError
 
-from cliquet import Service, schema, errors
+from cliquet import Service, schema, errors, utils
 from cliquet.statsd import statsd_count
+from cornice.schemas import CorniceSchema, validate_colander_schema
 
 from syncto.authentication import build_sync_client
+from syncto.batching import (get_record_batch, get_record_write_batch,
+                             match_subrequest, record_batch_key)
 from syncto.headers import import_headers, export_headers
+from syncto.info_collections import (get_not_modified_response,
+                                     invalidate_collections_timestamps)
+from syncto.record_cache import (get_cached_record, cache_record,
+                                 invalidate_records, is_record_missing,
+                                 cache_missing_record)
+from syncto.snapshots import invalidate_snapshot
 
 
 SYNC_ID_FORMAT = re.compile(r'^[a-zA-Z0-9_-]{12}$')  # 9 bytes URL safe base64
@@ -26,14 +36,65 @@ class PayloadSchema(colander.MappingSchema):
         return colander.Mapping(unknown='raise')
 
 
+PAYLOAD_SCHEMA = CorniceSchema.from_colander(PayloadSchema)
+
+
+def _body_size(request):
+    if request.content_length is not None:
+        return request.content_length
+    return len(request.body)
+
+
+def _get_payload_data(request):
+    """Return the record of a body shaped like those of Sync clients, which
+    ``PayloadSchema`` accepts as it is, or ``None``.
+    """
+    if request.content_type != 'application/json' or request.GET:
+        return None
+    try:
+        body = utils.json.loads(request.body)
+    except ValueError:
+        return None
+    if type(body) is not dict or len(body) != 1:
+        return None
+    data = body.get('data')
+    return dict(data) if type(data) is dict else None
+
+
+def validate_payload(request):
+    """Refuse bodies larger than ``record_put_max_body_bytes`` before
+    parsing them, and validate the others as ``PayloadSchema`` does.
+
+    Bodies sent by Sync clients are decoded once, with the JSON decoder of
+    *Cliquet*, and are not deserialized through colander.
+    """
+    settings = request.registry.settings
+    max_bytes = int(settings['record_put_max_body_bytes'])
+    if _body_size(request) > max_bytes:
+        error_msg = 'Request body is limited to %s bytes.' % max_bytes
+        raise errors.http_error(httpexceptions.HTTPRequestEntityTooLarge(),
+                                errno=errors.ERRORS.REQUEST_TOO_LARGE,
+                                message=error_msg)
+
+    data = _get_payload_data(request)
+    if data is not None:
+        request.validated['data'] = data
+        return
+
+    # Same error reporting as with the schema given to the service.
+    validate_colander_schema(PAYLOAD_SCHEMA, request)
+
+
+def _is_endpoint_enabled(request, collection_name, method):
+    settings = request.registry.settings
+    setting_key = 'record_%s_%s_enabled' % (collection_name, method.lower())
+    return settings.get(setting_key, False)
+
+
 def assert_endpoint_enabled(request, collection_name):
     """Check that endpoint is not disabled from configuration.
     """
-    settings = request.registry.settings
-    method = request.method.lower()
-    setting_key = 'record_%s_%s_enabled' % (collection_name, method)
-    enabled = settings.get(setting_key, False)
-    if not enabled:
+    if not _is_endpoint_enabled(request, collection_name, request.method):
         error_msg = 'Endpoint disabled for this collection in configuration.'
         response = errors.http_error(httpexceptions.HTTPMethodNotAllowed(),
                                      errno=errors.ERRORS.METHOD_NOT_ALLOWED,
@@ -41,6 +102,18 @@ def assert_endpoint_enabled(request, collection_name):
         raise response
 
 
+def _record_not_found(request, record_id):
+    """Same response as for a Sync ``404 Not Found``, see
+    :func:`syncto.views.errors.response_error`.
+    """
+    error_msg = 'Record %s was not found.' % record_id
+    response = errors.http_error(httpexceptions.HTTPNotFound(),
+                                 errno=errors.ERRORS.INVALID_RESOURCE_ID,
+                                 message=error_msg)
+    request.response = response
+    return utils.reapply_cors(request, response)
+
+
 record = Service(name='record',
                  description='Firefox Sync Collection Record service',
                  path=('/buckets/{bucket_id}/collections/'
@@ -55,20 +128,59 @@ def record_get(request):
 
     sync_client = build_sync_client(request)
     headers = import_headers(request)
-    record = sync_client.get_record(collection_name, record_id,
-                                    headers=headers)
+    not_modified = get_not_modified_response(request, sync_client,
+                                             collection_name, headers,
+                                             record_id=record_id)
+    if not_modified is not None:
+        return not_modified
+
+    # Clients probe for records that do not exist yet, like meta/global.
+    if is_record_missing(request, sync_client, collection_name, record_id,
+                         headers):
+        return _record_not_found(request, record_id)
+
+    cached = get_cached_record(request, sync_client, collection_name,
+                               record_id, headers)
+    if isinstance(cached, httpexceptions.HTTPNotModified):
+        return cached
+    # Records read by a batch are fetched together.
+    record_batch = get_record_batch(request, collection_name, record_id)
+    if cached is not None:
+        record, sync_response = cached
+    elif record_batch is not None:
+        record, sync_response = record_batch.get_record(
+            request, sync_client, collection_name, record_id, headers)
+        if record is None:
+            statsd_count(request, "syncclient.status_code.404")
+            cache_missing_record(request, sync_client, collection_name,
+                                 record_id)
+            return _record_not_found(request, record_id)
+    else:
+        try:
+            record = sync_client.get_record(collection_name, record_id,
+                                            headers=headers)
+        except HTTPError as e:
+            if e.response.status_code == 404:
+                cache_missing_record(request, sync_client, collection_name,
+                                     record_id)
+            raise
+        sync_response = sync_client.raw_resp
+
+    if cached is None:
+        cache_record(request, sync_client, collection_name, record_id,
+                     record['modified'], dict(record))
 
     record['last_modified'] = int(record.pop('modified') * 1000)
 
     # Configure headers
-    export_headers(sync_client.raw_resp, request)
+    export_headers(sync_response, request)
 
     statsd_count(request, "syncclient.status_code.200")
 
     return {'data': record}
 
 
-@record.put(permission=NO_PERMISSION_REQUIRED, schema=PayloadSchema)
+@record.put(permission=NO_PERMISSION_REQUIRED, validators=(validate_payload,))
 def record_put(request):
     collection_name = request.matchdict['collection_name']
 
@@ -85,19 +197,74 @@ def record_put(request):
     record.pop('last_modified', None)
 
     sync_client = build_sync_client(request)
-    last_modified = sync_client.put_record(collection_name, record,
-                                           headers=headers)
+
+    # Records written by a batch are sent together.
+    record_write_batch = get_record_write_batch(request, collection_name)
+    if record_write_batch is not None:
+        last_modified, reasons, sync_response = record_write_batch.put_record(
+            request, sync_client, collection_name, record_id, headers)
+        if last_modified is None:
+            statsd_count(request, "syncclient.status_code.400")
+            error_msg = 'Record was not stored: %s' % ', '.join(reasons)
+            raise errors.http_error(httpexceptions.HTTPBadRequest(),
+                                    errno=errors.ERRORS.INVALID_PARAMETERS,
+                                    message=error_msg)
+    else:
+        try:
+            last_modified = sync_client.put_record(collection_name, record,
+                                                   headers=headers)
+        finally:
+            invalidate_collections_timestamps(request, sync_client)
+            invalidate_records(request, sync_client, collection_name,
+                               [record_id])
+        sync_response = sync_client.raw_resp
+
+    # Only the timestamp is known, since Sync merges the given fields.
+    # Records expiring on Sync are read from it again.
+    if 'ttl' not in record:
+        cache_record(request, sync_client, collection_name, record_id,
+                     last_modified)
     record['last_modified'] = int(last_modified * 1000)
     record['id'] = record_id
 
     # Configure headers
-    export_headers(sync_client.raw_resp, request)
+    export_headers(sync_response, request)
 
     statsd_count(request, "syncclient.status_code.200")
 
     return {'data': record}
 
 
+def get_batched_write(request, subrequest):
+    """Return the record id and data of a batch subrequest that can be sent
+    to Sync along with the others sharing the returned key, or ``None``.
+    """
+    if subrequest.method not in ('PUT', 'DELETE'):
+        return None
+    match = match_subrequest(request, subrequest, record.name)
+    if match is None:
+        return None
+    collection_name = match['collection_name']
+    if not _is_endpoint_enabled(request, collection_name, subrequest.method):
+        return None
+
+    data = None
+    if subrequest.method == 'PUT':
+        # Other bodies are refused by validate_payload().
+        max_bytes = int(request.registry.settings['record_put_max_body_bytes'])
+        if _body_size(subrequest) > max_bytes:
+            return None
+        data = _get_payload_data(subrequest)
+        if data is None:
+            return None
+        data['id'] = match['record_id']
+        data.pop('last_modified', None)
+
+    key = record_batch_key(match['bucket_id'], collection_name,
+                           subrequest.headers)
+    return (subrequest.method, key), match['record_id'], data
+
+
 @record.delete(permission=NO_PERMISSION_REQUIRED)
 def record_delete(request):
     collection_name = request.matchdict['collection_name']
@@ -109,7 +276,24 @@ def record_delete(request):
 
     headers = import_headers(request)
     sync_client = build_sync_client(request)
-    sync_client.delete_record(collection_name, sync_id, headers=headers)
+
+    # Records deleted by a batch are deleted together.
+    record_delete_batch = get_record_write_batch(request, collection_name)
+    if record_delete_batch is not None:
+        existed = record_delete_batch.delete_record(
+            request, sync_client, collection_name, record_id, headers)
+        if not existed:
+            statsd_count(request, "syncclient.status_code.404")
+            return _record_not_found(request, record_id)
+    else:
+        try:
+            sync_client.delete_record(collection_name, sync_id,
+                                      headers=headers)
+        finally:
+            invalidate_collections_timestamps(request, sync_client)
+            invalidate_snapshot(request, sync_client, collection_name)
+            invalidate_records(request, sync_client, collection_name,
+                               [record_id])
 
     statsd_count(request, "syncclient.status_code.204")
 